@@ -17,9 +17,12 @@
 import six
 import sys
 import time
+import errno
 import socket
+import select
 import struct
 import logging
+import collections
 try:
     import cPickle as pickle
 except ImportError:
@@ -27,6 +30,8 @@ except ImportError:
 
 import bucky.client as client
 import bucky.names as names
+from bucky.errors import ConfigError
+from bucky.hashring import ConsistentHashRing
 
 
 if six.PY3:
@@ -36,6 +41,12 @@ if six.PY3:
 log = logging.getLogger(__name__)
 
 
+def release(view):
+    """Release a memoryview, Python 2 views are released when freed"""
+    if hasattr(view, "release"):
+        view.release()
+
+
 class DebugSocket(object):
     def sendall(self, data):
         sys.stdout.write(data)
@@ -97,6 +108,16 @@ class PlaintextClient(CarbonClient):
     def send(self, host, name, value, mtime):
         stat = names.statname(host, name)
         mesg = "%s %s %s\n" % (stat, value, mtime)
+        self.transmit(mesg)
+
+    def send_batch(self, samples):
+        statname = names.statname
+        mesg = "".join(["%s %s %s\n" % (statname(host, name), value, mtime)
+                        for host, name, value, mtime in samples])
+        if mesg:
+            self.transmit(mesg)
+
+    def transmit(self, mesg):
         for i in xrange(self.max_reconnects):
             try:
                 self.sock.sendall(mesg)
@@ -111,21 +132,64 @@ class PlaintextClient(CarbonClient):
 
 
 class PickleClient(CarbonClient):
+    """Carbon client for the pickle protocol
+
+    Metrics are buffered and sent as one pickle once the buffer reaches
+    about graphite_pickle_buffer_bytes (or graphite_pickle_buffer_size
+    metrics, if set) or its oldest metric waited graphite_pickle_max_latency
+    seconds, so the size of the pickles follows the incoming rate. Buffered
+    metrics are sent on shutdown.
+    """
+
+    # Approximate pickled size of a metric on top of its name
+    ENTRY_OVERHEAD = 32
+
     def __init__(self, cfg, pipe):
         super(PickleClient, self).__init__(cfg, pipe)
         self.buffer_size = cfg.graphite_pickle_buffer_size
+        self.buffer_bytes = cfg.graphite_pickle_buffer_bytes
+        self.max_latency = cfg.graphite_pickle_max_latency
         self.buffer = []
+        self.pending_bytes = 0
+        self.deadline = None
 
     def send(self, host, name, value, mtime):
-        stat = names.statname(host, name)
-        self.buffer.append((stat, (mtime, value)))
-        if len(self.buffer) >= self.buffer_size:
+        self.send_batch([(host, name, value, mtime)])
+
+    def send_batch(self, samples):
+        statname = names.statname
+        buffer = self.buffer
+        buffer_size = self.buffer_size
+        overhead = self.ENTRY_OVERHEAD
+        for host, name, value, mtime in samples:
+            stat = statname(host, name)
+            buffer.append((stat, (mtime, value)))
+            self.pending_bytes += len(stat) + overhead
+            if self.pending_bytes >= self.buffer_bytes or \
+                    (buffer_size > 0 and len(buffer) >= buffer_size):
+                self.transmit()
+        if buffer and self.deadline is None:
+            self.deadline = time.time() + self.max_latency
+
+    def poll_timeout(self):
+        if self.deadline is None:
+            return None
+        return self.deadline - time.time()
+
+    def tick(self):
+        if self.buffer:
+            self.transmit()
+
+    def pre_shutdown(self):
+        if self.buffer:
             self.transmit()
 
     def transmit(self):
         payload = pickle.dumps(self.buffer, protocol=-1)
         header = struct.pack("!L", len(payload))
-        self.buffer = []
+        del self.buffer[:]
+        self.pending_bytes = 0
+        self.deadline = None
         for i in xrange(self.max_reconnects):
             try:
                 self.sock.sendall(header + payload)
@@ -137,3 +201,312 @@ class PickleClient(CarbonClient):
                 except socket.error as err:
                     log.error("Failed reconnect to Carbon server: %s", err)
         log.error("Dropping buffer!")
+
+
+class CarbonConnection(object):
+    """Non-blocking connection to a Carbon server with a bounded buffer
+
+    `write` only appends a complete message to the buffer and never blocks,
+    `flush` writes as much of the buffer as the socket accepts. While the
+    server is unreachable connection attempts are made from `flush`, with
+    the delay between them growing by graphite_backoff_factor.
+
+    The buffer holds at most graphite_buffer_max bytes. Messages that do
+    not fit are dropped whole, keeping the data already buffered, and the
+    number of dropped bytes is logged once the buffer drains again.
+
+    A message stays in the buffer until it was written completely. When the
+    connection breaks in the middle of a message, the next connection
+    starts with the whole message again, so the stream never begins with
+    the tail of a line or of a pickle frame.
+    """
+
+    RETRY_INTERVAL = 0.05
+
+    def __init__(self, ip, port, cfg):
+        self.ip = ip
+        self.port = port
+        self.debug = cfg.debug
+        self.reconnect_delay = cfg.graphite_reconnect_delay
+        self.backoff_factor = cfg.graphite_backoff_factor
+        self.backoff_max = cfg.graphite_backoff_max
+        self.max_buffer = cfg.graphite_buffer_max
+        self.buffer = bytearray()
+        # Lengths of the buffered messages and the bytes written of the first
+        self.lengths = collections.deque()
+        self.sent = 0
+        self.sock = None
+        self.connected = False
+        self.delay = self.reconnect_delay
+        self.next_connect = 0
+        self.dropped = 0
+
+    def write(self, data):
+        """Buffer `data`, returns False if it was dropped"""
+        if len(self.buffer) + len(data) > self.max_buffer:
+            if not self.dropped:
+                log.error("Buffer for Carbon at %s:%s is full, dropping data",
+                          self.ip, self.port)
+            self.dropped += len(data)
+            return False
+        self.buffer += data
+        self.lengths.append(len(data))
+        return True
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.debug:
+            sys.stdout.write(self.buffer.decode("utf-8", "replace"))
+            del self.buffer[:]
+            self.lengths.clear()
+            return
+        if not self.connected and not self.connect():
+            return
+        try:
+            while self.buffer:
+                # A view does not copy the unsent rest of the buffer, it
+                # has to be released before consume() resizes the buffer
+                data = memoryview(self.buffer)[self.sent:]
+                try:
+                    sent = self.sock.send(data)
+                finally:
+                    release(data)
+                self.consume(sent)
+        except socket.error as err:
+            if err.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                log.error("Failed to send data to Carbon server %s:%s: %s",
+                          self.ip, self.port, err)
+                self.disconnect()
+            return
+        if self.dropped:
+            log.error("Dropped %d bytes for Carbon at %s:%s", self.dropped,
+                      self.ip, self.port)
+            self.dropped = 0
+
+    def consume(self, sent):
+        """Remove the messages completed by writing `sent` more bytes"""
+        sent += self.sent
+        lengths = self.lengths
+        done = 0
+        while lengths and lengths[0] <= sent - done:
+            done += lengths.popleft()
+        if done:
+            del self.buffer[:done]
+        self.sent = sent - done
+
+    def connect(self):
+        """Advance the connection attempt, returns True once connected"""
+        if self.sock is None:
+            if time.time() < self.next_connect:
+                return False
+            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.sock.setblocking(False)
+            err = self.sock.connect_ex((self.ip, self.port))
+            if err not in (0, errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+                self.connect_failed(err)
+                return False
+        writable = select.select([], [self.sock], [], 0)[1]
+        if not writable:
+            return False
+        err = self.sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+        if err:
+            self.connect_failed(err)
+            return False
+        log.info("Connected to Carbon at %s:%s", self.ip, self.port)
+        self.connected = True
+        self.delay = self.reconnect_delay
+        return True
+
+    def connect_failed(self, err):
+        log.error("Failed to connect to %s:%s: %s", self.ip, self.port,
+                  errno.errorcode.get(err, err))
+        self.close()
+        self.next_connect = time.time() + self.delay
+        if self.backoff_factor:
+            self.delay *= self.backoff_factor
+            if self.backoff_max:
+                self.delay = min(self.delay, self.backoff_max)
+
+    def disconnect(self):
+        self.close()
+        self.next_connect = 0
+
+    def wait_time(self):
+        """Seconds until `flush` has work to do without new data"""
+        if not self.buffer or self.debug:
+            return None
+        if self.sock is None:
+            return max(self.next_connect - time.time(), 0)
+        return self.RETRY_INTERVAL
+
+    def drain(self, timeout):
+        """Try to write the whole buffer within `timeout` seconds"""
+        deadline = time.time() + timeout
+        self.flush()
+        while self.buffer and time.time() < deadline:
+            time.sleep(min(self.wait_time() or self.RETRY_INTERVAL,
+                           max(deadline - time.time(), 0)))
+            self.flush()
+        if self.buffer:
+            log.error("Dropping %d unsent bytes for Carbon at %s:%s",
+                      len(self.buffer), self.ip, self.port)
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except Exception:
+                pass
+        self.sock = None
+        self.connected = False
+        # A new connection starts with the whole partly written message
+        self.sent = 0
+
+
+class AsyncPlaintextClient(client.Client):
+    """Plaintext Carbon client that never blocks on the Carbon server
+
+    Batches are formatted into one message that is appended to the buffer of
+    a CarbonConnection and written without blocking. Reconnecting happens in
+    the background, meanwhile samples are buffered up to graphite_buffer_max
+    bytes and dropped beyond that. On shutdown the buffer is written for up
+    to process_join_timeout seconds.
+    """
+
+    def __init__(self, cfg, pipe):
+        super(AsyncPlaintextClient, self).__init__(pipe)
+        self.conn = CarbonConnection(cfg.graphite_ip, cfg.graphite_port, cfg)
+        self.shutdown_timeout = cfg.process_join_timeout
+
+    def send(self, host, name, value, mtime):
+        self.send_batch([(host, name, value, mtime)])
+
+    def send_batch(self, samples):
+        statname = names.statname
+        mesg = "".join(["%s %s %s\n" % (statname(host, name), value, mtime)
+                        for host, name, value, mtime in samples])
+        if not mesg:
+            return
+        if not isinstance(mesg, bytes):
+            mesg = mesg.encode("utf-8")
+        self.conn.write(mesg)
+        self.conn.flush()
+
+    def poll_timeout(self):
+        return self.conn.wait_time()
+
+    def tick(self):
+        self.conn.flush()
+
+    def pre_shutdown(self):
+        self.conn.drain(self.shutdown_timeout)
+        self.conn.close()
+
+
+def parse_destinations(destinations):
+    """Parse "host:port[:instance]" strings into (host, port, instance)"""
+    parsed = []
+    for dest in destinations:
+        parts = dest.strip().split(":")
+        if len(parts) not in (2, 3):
+            raise ConfigError("Invalid graphite destination: %r" % dest)
+        host, port = parts[0], parts[1]
+        instance = parts[2] if len(parts) == 3 else None
+        try:
+            port = int(port)
+        except ValueError:
+            raise ConfigError("Invalid port in graphite destination: %r" % dest)
+        parsed.append((host, port, instance))
+    return parsed
+
+
+class MultiCarbonClient(client.Client):
+    """Send metrics to several Carbon servers without a carbon-relay
+
+    Metrics are sharded over graphite_destinations with the consistent hash
+    ring of carbon-relay, the ring nodes are (host, instance) just like
+    there, so a metric lands on the same server as it would behind a relay
+    with the same DESTINATIONS. Every metric is sent to
+    graphite_replication_factor distinct destinations.
+
+    Each destination has its own non-blocking CarbonConnection and buffer,
+    the plaintext or (with graphite_pickle_enabled) pickle protocol is used
+    for all of them. A pickle is sent per destination and batch.
+    """
+
+    # Number of metric names whose destinations are remembered
+    ROUTE_CACHE_SIZE = 100000
+
+    def __init__(self, cfg, pipe):
+        super(MultiCarbonClient, self).__init__(pipe)
+        destinations = parse_destinations(cfg.graphite_destinations)
+        if not destinations:
+            raise ConfigError("No graphite destinations configured")
+        self.ring = ConsistentHashRing()
+        self.conns = {}
+        for host, port, instance in destinations:
+            node = (host, instance)
+            if node in self.conns:
+                raise ConfigError("Duplicate graphite destination: %s:%s" % node)
+            self.ring.add_node(node)
+            self.conns[node] = CarbonConnection(host, port, cfg)
+        self.replication_factor = max(cfg.graphite_replication_factor, 1)
+        self.pickle = cfg.graphite_pickle_enabled
+        self.shutdown_timeout = cfg.process_join_timeout
+        self.routes = {}
+
+    def route(self, stat):
+        conns = self.routes.get(stat)
+        if conns is None:
+            if len(self.routes) >= self.ROUTE_CACHE_SIZE:
+                self.routes.clear()
+            nodes = self.ring.get_nodes(stat, self.replication_factor)
+            conns = self.routes[stat] = [self.conns[node] for node in nodes]
+        return conns
+
+    def send(self, host, name, value, mtime):
+        self.send_batch([(host, name, value, mtime)])
+
+    def send_batch(self, samples):
+        statname = names.statname
+        route = self.route
+        outgoing = {}
+        for host, name, value, mtime in samples:
+            stat = statname(host, name)
+            if self.pickle:
+                entry = (stat, (mtime, value))
+            else:
+                entry = "%s %s %s\n" % (stat, value, mtime)
+            for conn in route(stat):
+                entries = outgoing.get(conn)
+                if entries is None:
+                    entries = outgoing[conn] = []
+                entries.append(entry)
+        for conn, entries in six.iteritems(outgoing):
+            conn.write(self.encode(entries))
+            conn.flush()
+
+    def encode(self, entries):
+        if self.pickle:
+            payload = pickle.dumps(entries, protocol=-1)
+            return struct.pack("!L", len(payload)) + payload
+        mesg = "".join(entries)
+        if not isinstance(mesg, bytes):
+            mesg = mesg.encode("utf-8")
+        return mesg
+
+    def poll_timeout(self):
+        timeouts = [conn.wait_time() for conn in self.conns.values()]
+        timeouts = [timeout for timeout in timeouts if timeout is not None]
+        return min(timeouts) if timeouts else None
+
+    def tick(self):
+        for conn in self.conns.values():
+            conn.flush()
+
+    def pre_shutdown(self):
+        deadline = time.time() + self.shutdown_timeout
+        for conn in self.conns.values():
+            conn.drain(max(deadline - time.time(), 0))
+            conn.close()
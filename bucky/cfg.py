@@ -6,6 +6,15 @@ uid = None
 gid = None
 directory = "/var/lib/bucky"
 process_join_timeout = 2
+sample_batch_size = 1000
+sample_transport = "queue"
+sample_transport_ring_size = 65536
+# seconds a full shared memory ring waits for its consumer before the
+# batch is dropped
+sample_transport_timeout = 10.0
+sample_topology = "fanout"
+udp_recv_batch = 64
+udp_use_recvmmsg = True
 
 sentry_enabled = False
 sentry_dsn = None
@@ -26,6 +35,13 @@ collectd_converters = []
 collectd_use_entry_points = True
 collectd_counter_eq_derive = False
 collectd_workers = 1
+# let every worker receive on its own SO_REUSEPORT socket instead of
+# relaying the packets through one process
+collectd_reuse_port = False
+# seconds between moving sources from overloaded to idle workers (0 disables)
+collectd_rebalance_interval = 60
+# a worker is overloaded with this many times the mean load
+collectd_rebalance_threshold = 1.5
 
 collectd_security_level = 0
 collectd_auth_file = None
@@ -34,19 +50,46 @@ statsd_ip = "127.0.0.1"
 statsd_port = 8125
 statsd_enabled = True
 statsd_flush_time = 10.0
+# number of processes receiving on the statsd port with SO_REUSEPORT,
+# their aggregates are merged at every flush
+statsd_workers = 1
+# optional listeners for newline separated StatsD lines on TCP (statsd_tcp_ip
+# defaults to statsd_ip) and on a Unix socket of type "stream" or "dgram"
+statsd_tcp_ip = None
+statsd_tcp_port = None
+statsd_unix_socket = None
+statsd_unix_socket_type = "stream"
 statsd_legacy_namespace = True
 statsd_global_prefix = "stats"
 statsd_prefix_counter = "counters"
 statsd_prefix_timer = "timers"
 statsd_prefix_set = "sets"
 statsd_prefix_gauge = "gauges"
+# timers report the largest value below each of these percentiles as
+# upper_<percentile>, their mean only covers the values below the first one,
+# percentiles have to be between 0 and 100
+statsd_timer_percentiles = [90]
+# timers whose key matches one of these regular expressions keep a DDSketch
+# with this relative accuracy instead of every value, [""] matches all keys
+statsd_timer_sketch_patterns = []
+statsd_timer_sketch_accuracy = 0.01
+# sets whose key starts with one of these prefixes are counted with a
+# HyperLogLog of 2 ** precision registers (precision 4 to 16), [""] matches
+# all keys
+statsd_set_hll_prefixes = []
+statsd_set_hll_precision = 14
 statsd_persistent_gauges = False
 statsd_gauges_savefile = "gauges.save"
+# changed gauges are appended to "<savefile>.log" at every flush and
+# folded into a new snapshot of the savefile at this interval in seconds
+statsd_gauges_snapshot_interval = 300.0
 statsd_delete_idlestats = False
 # the following settings are only relevant if `statsd_delete_idlestats` is `True`
 statsd_delete_counters = True
 statsd_delete_timers = True
 statsd_delete_sets = True
+# number of flushes without samples after which a key is deleted
+statsd_idlestats_ttl = 1
 # statsd_delete_gauges = False
 # `statsd_delete_gauges = True` would make gauges in practice useless,
 # except if you get an absolute(!) value every flush-interval which would makes this setting irrelevant
@@ -61,7 +104,21 @@ graphite_reconnect_delay = 1
 graphite_backoff_factor = 1.5
 graphite_backoff_max = 60
 graphite_pickle_enabled = False
-graphite_pickle_buffer_size = 500
+# a pickle is sent once the buffered metrics take about this many bytes,
+# hold graphite_pickle_buffer_size metrics (0 for no limit) or the oldest
+# one waited graphite_pickle_max_latency seconds
+graphite_pickle_buffer_bytes = 256 * 1024
+graphite_pickle_buffer_size = 0
+graphite_pickle_max_latency = 1.0
+# buffer plaintext output and write it without ever blocking on Carbon,
+# reconnecting in the background
+graphite_nonblocking = False
+# bytes buffered while Carbon is slow or down, more data is dropped
+graphite_buffer_max = 16 * 1024 * 1024
+# "host:port[:instance]" Carbon servers to shard the metrics over with the
+# consistent hashing of carbon-relay, replacing graphite_ip/graphite_port
+graphite_destinations = []
+graphite_replication_factor = 1
 
 full_trace = False
 
@@ -72,6 +129,8 @@ name_postfix_parts = None
 name_replace_char = '_'
 name_strip_duplicates = True
 name_host_trim = []
+# stat names are cached, this many per generation
+name_cache_size = 100000
 
 custom_clients = []
 
@@ -37,12 +37,45 @@ class Client(multiprocessing.Process):
         setproctitle("bucky: %s" % self.__class__.__name__)
         while True:
             try:
-                sample = self.pipe.recv()
+                timeout = self.poll_timeout()
+                if timeout is not None:
+                    if timeout <= 0 or not self.pipe.poll(timeout):
+                        self.tick()
+                        continue
+                batch = self.pipe.recv()
             except KeyboardInterrupt:
                 continue
-            if sample is None:
+            if batch is None:
                 break
-            self.send(*sample)
+            self.send_batch(batch)
+        try:
+            self.pre_shutdown()
+        except Exception:
+            log.exception("Failed pre_shutdown method for %s",
+                          self.__class__.__name__)
+
+    def poll_timeout(self):
+        """Seconds until `tick` should be called, None to wait for samples only"""
+        return None
+
+    def tick(self):
+        """Periodic work hook, called once the `poll_timeout` expired"""
+        pass
+
+    def pre_shutdown(self):
+        """ Pre shutdown hook """
+        pass
+
+    def send_batch(self, samples):
+        """Send a list of (host, name, value, time) samples
+
+        The default implementation calls `send` for every sample so that
+        clients which only implement `send` keep working. Clients that can
+        do better with a whole batch at once should override this.
+        """
+        send = self.send
+        for sample in samples:
+            send(*sample)
 
     def send(self, host, name, value, time):
         raise NotImplementedError()
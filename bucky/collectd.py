@@ -15,8 +15,10 @@
 import os
 import six
 import copy
+import time
 import struct
 import signal
+import socket
 import logging
 import multiprocessing
 
@@ -33,10 +35,16 @@ except ImportError:
 
 from bucky.errors import ConfigError, ProtocolError
 from bucky.udpserver import UDPServer
+from bucky.hashring import ConsistentHashRing
 from bucky.helpers import FileMonitor
 
 log = logging.getLogger(__name__)
 
+# Kinds of messages from CollectDServerMP to its workers
+MSG_PACKETS = "packets"
+MSG_EXPORT = "export"
+MSG_IMPORT = "import"
+
 
 class CPUConverter(object):
     PRIORITY = -1
@@ -438,6 +446,9 @@ class CollectDHandler(object):
         self.converter = CollectDConverter(cfg)
         self.prev_samples = {}
         self.last_sample = None
+        # Set collecting the hosts of the parsed samples, a CollectDWorker
+        # uses it to know which state belongs to which source
+        self.hosts = None
 
     def parse(self, data):
         try:
@@ -445,6 +456,7 @@ class CollectDHandler(object):
         except ProtocolError as e:
             log.error("Protocol error in CollectDCrypto: %s", e)
             return
+        hosts = self.hosts
         try:
             for sample in self.parser.parse(data):
                 self.last_sample = sample
@@ -456,6 +468,8 @@ class CollectDHandler(object):
                 host, name, vtype, val, time = sample
                 if not name.strip():
                     continue
+                if hosts is not None:
+                    hosts.add(host)
                 val = self.calculate(host, name, vtype, val, time)
                 val = self.check_range(stype, vname, val)
                 if val is not None:
@@ -465,6 +479,23 @@ class CollectDHandler(object):
             if self.last_sample is not None:
                 log.info("Last sample: %s", self.last_sample)
 
+    def export_state(self, hosts):
+        """Return the previous samples of `hosts`"""
+        state = {}
+        for key, value in six.iteritems(self.prev_samples):
+            if key[0] in hosts:
+                state[key] = value
+        return state
+
+    def import_state(self, state):
+        self.prev_samples.update(state)
+
+    def drop_state(self, hosts):
+        """Forget the previous samples of `hosts`"""
+        prev_samples = self.prev_samples
+        for key in [key for key in prev_samples if key[0] in hosts]:
+            del prev_samples[key]
+
     def check_range(self, stype, vname, val):
         if val is None:
             return
@@ -548,20 +579,39 @@ class CollectDHandler(object):
 class CollectDServer(UDPServer):
     """Single processes CollectDServer"""
 
-    def __init__(self, queue, cfg):
+    def __init__(self, queue, cfg, reuse_port=False, stop_event=None):
         super(CollectDServer, self).__init__(cfg.collectd_ip,
-                                             cfg.collectd_port)
+                                             cfg.collectd_port,
+                                             reuse_port, stop_event)
         self.handler = CollectDHandler(cfg)
         self.queue = queue
 
     def handle(self, data, addr):
-        for sample in self.handler.parse(data):
-            self.queue.put(sample)
+        samples = list(self.handler.parse(data))
+        if samples:
+            self.queue.put(samples)
+        return True
+
+    def handle_batch(self, packets):
+        samples = []
+        for data, addr in packets:
+            samples.extend(self.handler.parse(data))
+        if samples:
+            self.queue.put(samples)
         return True
 
 
 class CollectDWorker(multiprocessing.Process):
-    """CollectDWorker plugs a CollectDHandler between a pipe and a queue"""
+    """CollectDWorker plugs a CollectDHandler between a pipe and a queue
+
+    Messages on the pipe are (kind, arg) tuples. MSG_PACKETS carries a list
+    of (source ip, data) packets. MSG_EXPORT and MSG_IMPORT move the COUNTER,
+    DERIVE and ABSOLUTE state of a source to another worker, an export is
+    answered on the pipe with ((kind, arg), result).
+
+    The packet and sample counters are kept in shared memory, so the relay
+    process reads them without waiting for the worker.
+    """
 
     def __init__(self, pipe, queue, cfg, id_num=-1):
         super(CollectDWorker, self).__init__()
@@ -570,20 +620,60 @@ class CollectDWorker(multiprocessing.Process):
         self.pipe = pipe
         self.queue = queue
         self.cfg = cfg
+        self.handler = None
+        # Hosts seen in the packets of every source ip
+        self.sources = {}
+        # Packets and samples handled, written by the worker only
+        self.counters = multiprocessing.Array('L', 2, lock=False)
 
     def run(self):
         log.info("CollectDWorker up and running")
         setproctitle("bucky: %s" % self.name)
-        handler = CollectDHandler(self.cfg)
+        self.handler = CollectDHandler(self.cfg)
         while True:
             try:
-                data = self.pipe.recv()
+                msg = self.pipe.recv()
             except KeyboardInterrupt:
                 continue
-            if data is None:
+            if msg is None:
                 break
-            for sample in handler.parse(data):
-                self.queue.put(sample)
+            self.handle_message(msg)
+
+    def handle_message(self, msg):
+        kind, arg = msg
+        if kind == MSG_PACKETS:
+            self.handle_packets(arg)
+        elif kind == MSG_EXPORT:
+            hosts = self.sources.pop(arg, set())
+            state = self.handler.export_state(hosts)
+            self.pipe.send((msg, (hosts, state)))
+            # Hosts also reported by another source stay with that source
+            for others in six.itervalues(self.sources):
+                hosts = hosts - others
+            self.handler.drop_state(hosts)
+        elif kind == MSG_IMPORT:
+            ip, hosts, state = arg
+            self.sources.setdefault(ip, set()).update(hosts)
+            self.handler.import_state(state)
+        else:
+            log.error("Unknown message for %s: %r", self.name, kind)
+
+    def handle_packets(self, packets):
+        handler = self.handler
+        sources = self.sources
+        samples = []
+        for ip, data in packets:
+            hosts = sources.get(ip)
+            if hosts is None:
+                hosts = sources[ip] = set()
+            handler.hosts = hosts
+            samples.extend(handler.parse(data))
+        handler.hosts = None
+        counters = self.counters
+        counters[0] += len(packets)
+        counters[1] += len(samples)
+        if samples:
+            self.queue.put(samples)
 
 
 class CollectDServerMP(UDPServer):
@@ -591,9 +681,16 @@ class CollectDServerMP(UDPServer):
 
     Starts a configurable (cfg.collectd_workers) number of worker processes.
     Routing of incoming packets to worker subsprocesses is performed by
-    consistent hashing, meaning that all packets from a given IP address will
-    always go to the same worker.
-
+    consistent hashing, meaning that all packets from a given IP address
+    go to the same worker.
+
+    The hash ring is stable across restarts. Every
+    cfg.collectd_rebalance_interval seconds the packets received from each
+    source are compared, and while the busiest worker gets more than
+    cfg.collectd_rebalance_threshold times the mean load its sources are
+    moved to the least busy worker, together with their COUNTER/DERIVE
+    state. A single source can not be split, so a source that is hotter
+    than the rest combined stays where it is.
     """
 
     def __init__(self, queue, cfg):
@@ -603,33 +700,129 @@ class CollectDServerMP(UDPServer):
         self.queue = queue
         self.cfg = cfg
         self.workers = []
+        self.ring = None
+        self.routes = {}
+        self.loads = {}
+        self.rebalance_interval = cfg.collectd_rebalance_interval
+        self.rebalance_threshold = cfg.collectd_rebalance_threshold
+        self.next_rebalance = None
 
     def run(self):
         def sigterm_handler(signum, frame):
             log.info("Received SIGTERM")
             self.close()
 
+        self.start_workers()
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        super(CollectDServerMP, self).run()
+
+    def start_workers(self):
         self.workers = []
         for i in range(self.cfg.collectd_workers):
             recv, send = multiprocessing.Pipe()
             worker = CollectDWorker(recv, self.queue, self.cfg, i)
             worker.start()
             self.workers.append((worker, send))
-
-        signal.signal(signal.SIGTERM, sigterm_handler)
-        super(CollectDServerMP, self).run()
+        self.ring = ConsistentHashRing(range(len(self.workers)))
+        self.routes = {}
+        self.loads = {}
+        if self.rebalance_interval:
+            self.next_rebalance = time.time() + self.rebalance_interval
+
+    def route(self, ip_addr):
+        index = self.routes.get(ip_addr)
+        if index is None:
+            index = self.routes[ip_addr] = self.ring.get_node(ip_addr)
+        return index
 
     def handle(self, data, addr):
-        ip_addr, port = addr
-        # deterministically map source ip address to worker
-        index = hash(ip_addr) % len(self.workers)
-        worker, pipe = self.workers[index]
-        pipe.send(data)
+        return self.handle_batch([(data, addr)])
+
+    def handle_batch(self, packets):
+        routes = self.routes
+        loads = self.loads
+        batches = {}
+        for data, addr in packets:
+            ip_addr = addr[0]
+            loads[ip_addr] = loads.get(ip_addr, 0) + 1
+            index = routes.get(ip_addr)
+            if index is None:
+                index = self.route(ip_addr)
+            batch = batches.get(index)
+            if batch is None:
+                batch = batches[index] = []
+            batch.append((ip_addr, data))
+        for index, batch in six.iteritems(batches):
+            worker, pipe = self.workers[index]
+            pipe.send((MSG_PACKETS, batch))
         # check if all is running
         for worker, pipe in self.workers:
             if not worker.is_alive():
                 log.error("Worker %s died, stopping server.", worker)
                 return
+        if self.next_rebalance is not None and time.time() >= self.next_rebalance:
+            self.rebalance()
+        return True
+
+    def request(self, index, kind, arg=None):
+        """Send a request to a worker and wait for its answer"""
+        worker, pipe = self.workers[index]
+        pipe.send((kind, arg))
+        while pipe.poll(self.cfg.process_join_timeout):
+            msg, result = pipe.recv()
+            # Skip answers to earlier requests that timed out
+            if msg == (kind, arg):
+                return result
+        log.error("Worker %s did not answer %s request", worker, kind)
+
+    def worker_stats(self):
+        """Return (worker name, packets, samples) for every worker"""
+        return [(worker.name, worker.counters[0], worker.counters[1])
+                for worker, pipe in self.workers]
+
+    def rebalance(self):
+        if self.rebalance_interval:
+            self.next_rebalance = time.time() + self.rebalance_interval
+        loads, self.loads = self.loads, {}
+        nworkers = len(self.workers)
+        worker_loads = [0] * nworkers
+        sources = [[] for i in range(nworkers)]
+        for ip_addr, load in six.iteritems(loads):
+            index = self.route(ip_addr)
+            worker_loads[index] += load
+            sources[index].append((load, ip_addr))
+        for name, packets, samples in self.worker_stats():
+            log.info("%s: %d packets, %d samples", name, packets, samples)
+        mean = sum(worker_loads) / float(nworkers)
+        for i in range(len(loads)):
+            hot = worker_loads.index(max(worker_loads))
+            cold = worker_loads.index(min(worker_loads))
+            if not mean or worker_loads[hot] <= mean * self.rebalance_threshold:
+                break
+            # Moving a source only helps if it is lighter than the gap
+            gap = worker_loads[hot] - worker_loads[cold]
+            candidates = [src for src in sources[hot] if src[0] < gap]
+            if not candidates:
+                break
+            load, ip_addr = max(candidates)
+            if not self.migrate(ip_addr, hot, cold):
+                break
+            sources[hot].remove((load, ip_addr))
+            sources[cold].append((load, ip_addr))
+            worker_loads[hot] -= load
+            worker_loads[cold] += load
+
+    def migrate(self, ip_addr, src, dst):
+        """Route `ip_addr` to worker `dst` and hand its state over"""
+        exported = self.request(src, MSG_EXPORT, ip_addr)
+        if exported is None:
+            return False
+        hosts, state = exported
+        worker, pipe = self.workers[dst]
+        pipe.send((MSG_IMPORT, (ip_addr, hosts, state)))
+        self.routes[ip_addr] = dst
+        log.info("Moved source %s from %s to %s", ip_addr,
+                 self.workers[src][0].name, worker.name)
         return True
 
     def pre_shutdown(self):
@@ -645,7 +838,66 @@ class CollectDServerMP(UDPServer):
             child.join(1)
 
 
+class CollectDServerReusePort(CollectDServer):
+    """Multiprocess CollectD server without a relay process
+
+    The server and cfg.collectd_workers - 1 worker servers each bind their
+    own socket to the collectd port with SO_REUSEPORT. The kernel picks the
+    socket by hashing the source and destination address and port, so the
+    packets of one collectd instance keep landing on the same process and
+    the COUNTER/DERIVE state in its handler stays consistent, as long as
+    the set of processes does not change. The server stops when a worker
+    dies for that reason.
+    """
+
+    def __init__(self, queue, cfg):
+        super(CollectDServerReusePort, self).__init__(queue, cfg, reuse_port=True)
+        self.daemon = False
+        self.cfg = cfg
+        self.workers = []
+
+    def run(self):
+        def sigterm_handler(signum, frame):
+            log.info("Received SIGTERM")
+            self.close()
+
+        self.workers = []
+        for i in range(1, self.cfg.collectd_workers):
+            worker = CollectDServer(self.queue, self.cfg, True, self.stop_event)
+            worker.name = "CollectDServer%d" % i
+            worker.start()
+            # Only the worker may keep its socket in the SO_REUSEPORT group
+            worker.sock.close()
+            self.workers.append(worker)
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        super(CollectDServerReusePort, self).run()
+
+    def handle_batch(self, packets):
+        super(CollectDServerReusePort, self).handle_batch(packets)
+        for worker in self.workers:
+            if not worker.is_alive():
+                log.error("Worker %s died, stopping server.", worker)
+                return False
+        return True
+
+    def pre_shutdown(self):
+        log.info("Shutting down CollectDServer")
+        self.stop_event.set()
+        for worker in self.workers:
+            worker.join(self.cfg.process_join_timeout)
+        for child in multiprocessing.active_children():
+            log.error("Child %s didn't die gracefully, terminating", child)
+            child.terminate()
+            child.join(1)
+
+
 def getCollectDServer(queue, cfg):
     """Get the appropriate collectd server (multi processed or not)"""
-    server = CollectDServerMP if cfg.collectd_workers > 1 else CollectDServer
-    return server(queue, cfg)
+    if cfg.collectd_workers <= 1:
+        return CollectDServer(queue, cfg)
+    if cfg.collectd_reuse_port:
+        if hasattr(socket, "SO_REUSEPORT"):
+            return CollectDServerReusePort(queue, cfg)
+        log.warning("SO_REUSEPORT is not supported, relaying packets to the workers")
+    return CollectDServerMP(queue, cfg)
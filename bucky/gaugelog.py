@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+"""Binary files of gauge values
+
+Snapshots and the log share one record format: the value as a little
+endian double, the length of the UTF-8 encoded key as an unsigned 32 bit
+int and the key. Snapshots start with MAGIC, files without it are read as
+the JSON object written by older versions.
+"""
+
+import os
+import json
+import struct
+
+import six
+
+
+MAGIC = b"BUCKYGAUGES1\n"
+RECORD = struct.Struct("<dI")
+CHUNK_SIZE = 65536
+
+
+def pack_records(items):
+    chunks = []
+    for key, value in items:
+        if not isinstance(key, bytes):
+            key = key.encode("utf-8")
+        chunks.append(RECORD.pack(value, len(key)))
+        chunks.append(key)
+    return b"".join(chunks)
+
+
+def iter_records(f):
+    """Yield the (key, value) records of a file object in chunks
+
+    A torn record at the end, as left by a crash during a write, is
+    ignored.
+    """
+    buf = b""
+    header = RECORD.size
+    while True:
+        chunk = f.read(CHUNK_SIZE)
+        if not chunk:
+            return
+        buf = buf + chunk if buf else chunk
+        pos = 0
+        end = len(buf)
+        while pos + header <= end:
+            value, length = RECORD.unpack_from(buf, pos)
+            if pos + header + length > end:
+                break
+            key = buf[pos + header:pos + header + length].decode("utf-8")
+            pos += header + length
+            yield key, value
+        buf = buf[pos:]
+
+
+def read_gauges(filename):
+    """Yield the (key, value) pairs of a snapshot file"""
+    with open(filename, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            f.seek(0)
+            data = f.read().decode("utf-8")
+            for item in six.iteritems(json.loads(data)):
+                yield item
+            return
+        for item in iter_records(f):
+            yield item
+
+
+def write_gauges(filename, items):
+    """Atomically replace `filename` with a snapshot of `items`
+
+    The snapshot is written to a temporary file which is synced and then
+    renamed over the old one, so a crash leaves either the old or the new
+    snapshot in place.
+    """
+    tmp = filename + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(MAGIC)
+        batch = []
+        for item in items:
+            batch.append(item)
+            if len(batch) >= 4096:
+                f.write(pack_records(batch))
+                batch = []
+        f.write(pack_records(batch))
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp, filename)
+
+
+class GaugeLog(object):
+    """Append-only log of gauge values written since the last snapshot
+
+    Every append is synced before it returns. Records hold absolute values,
+    so replaying the log over the snapshot restores the latest values.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.size = 0
+
+    def append(self, items):
+        data = pack_records(items)
+        with open(self.filename, "ab") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        self.size += len(data)
+
+    def stored_size(self):
+        """Return the size of the log file, including a torn record"""
+        if not os.path.isfile(self.filename):
+            return 0
+        return os.path.getsize(self.filename)
+
+    def replay(self):
+        if not os.path.isfile(self.filename):
+            return
+        with open(self.filename, "rb") as f:
+            for item in iter_records(f):
+                yield item
+
+    def clear(self):
+        if os.path.isfile(self.filename):
+            os.unlink(self.filename)
+        self.size = 0
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import bisect
+from hashlib import md5
+
+
+def compact_hash(key):
+    """Position of `key` on the ring, the first 16 bits of its md5 digest"""
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return int(md5(key).hexdigest()[:4], 16)
+
+
+class ConsistentHashRing(object):
+    """Consistent hash ring with virtual nodes
+
+    Every node is placed `replica_count` times on the ring, at the positions
+    of "<node>:<i>". The layout matches the ring of carbon-relay, so keys
+    map to the same nodes as they would behind a carbon relay configured
+    with the same destinations. Unlike the builtin hash() the positions do
+    not change between interpreter runs.
+    """
+
+    def __init__(self, nodes=(), replica_count=100):
+        self.ring = []
+        self.positions = set()
+        self.nodes = []
+        self.replica_count = replica_count
+        for node in nodes:
+            self.add_node(node)
+
+    def add_node(self, node):
+        self.nodes.append(node)
+        for i in range(self.replica_count):
+            position = compact_hash("%s:%d" % (node, i))
+            while position in self.positions:
+                position += 1
+            self.positions.add(position)
+            bisect.insort(self.ring, (position, self.nodes.index(node)))
+
+    def remove_node(self, node):
+        index = self.nodes.index(node)
+        self.ring = [e for e in self.ring if e[1] != index]
+        self.positions = set(e[0] for e in self.ring)
+        # Ring entries refer to nodes by index, renumber the ones after it
+        self.ring = [(p, i - 1 if i > index else i) for p, i in self.ring]
+        del self.nodes[index]
+
+    def _index(self, key):
+        position = compact_hash(key)
+        return bisect.bisect_left(self.ring, (position, -1)) % len(self.ring)
+
+    def get_node(self, key):
+        if not self.ring:
+            raise KeyError("Empty hash ring")
+        return self.nodes[self.ring[self._index(key)][1]]
+
+    def get_nodes(self, key, count=None):
+        """Return up to `count` distinct nodes for `key`, in ring order"""
+        if not self.ring:
+            return []
+        if count is None or count > len(self.nodes):
+            count = len(self.nodes)
+        ring = self.ring
+        start = index = self._index(key)
+        found = []
+        while len(found) < count:
+            node = ring[index][1]
+            if node not in found:
+                found.append(node)
+            index = (index + 1) % len(ring)
+            if index == start:
+                break
+        return [self.nodes[i] for i in found]
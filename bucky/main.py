@@ -19,6 +19,7 @@ import multiprocessing
 import os
 import six
 import sys
+import time
 import pwd
 import grp
 import signal
@@ -37,7 +38,8 @@ import bucky.collectd as collectd
 import bucky.metricsd as metricsd
 import bucky.statsd as statsd
 import bucky.processor as processor
-from bucky.errors import BuckyError
+import bucky.transport as transport
+from bucky.errors import BuckyError, ConfigError
 
 
 log = logging.getLogger(__name__)
@@ -241,43 +243,82 @@ def main():
 
 class Bucky(object):
     def __init__(self, cfg):
-        self.sampleq = multiprocessing.Queue()
-
         stypes = []
+        producers = 0
         if cfg.metricsd_enabled:
             stypes.append(metricsd.MetricsDServer)
+            producers += len(cfg.metricsd_handlers) + 1
         if cfg.collectd_enabled:
             stypes.append(collectd.getCollectDServer)
+            producers += max(cfg.collectd_workers, 1)
         if cfg.statsd_enabled:
-            stypes.append(statsd.StatsDServer)
+            stypes.append(statsd.getStatsDServer)
+            producers += 1
+
+        if cfg.sample_topology not in ("fanout", "direct"):
+            raise ConfigError("Invalid sample_topology: %s" % cfg.sample_topology)
+
+        if cfg.graphite_destinations:
+            carbon_client = carbon.MultiCarbonClient
+        elif cfg.graphite_pickle_enabled:
+            carbon_client = carbon.PickleClient
+        elif cfg.graphite_nonblocking:
+            carbon_client = carbon.AsyncPlaintextClient
+        else:
+            carbon_client = carbon.PlaintextClient
+        client_types = cfg.custom_clients + [carbon_client]
+
+        self.transports = []
+        self.publisher = None
+        inboxes = None
+        if cfg.sample_topology == "direct":
+            # The servers (or the processor) publish straight to the client
+            # inboxes and the main process only supervises.
+            pproducers = 1 if cfg.processor is not None else producers
+            self.publisher, inboxes = transport.make_broadcast(cfg, pproducers, len(client_types))
+            self.transports.append(self.publisher)
+
+        if cfg.processor is not None or self.publisher is None:
+            self.sampleq = transport.make_queue(cfg, producers)
+            self.transports.append(self.sampleq)
+        else:
+            self.sampleq = self.publisher
 
         self.servers = []
         for stype in stypes:
             self.servers.append(stype(self.sampleq, cfg))
 
         if cfg.processor is not None:
-            self.psampleq = multiprocessing.Queue()
+            if self.publisher is not None:
+                self.psampleq = self.publisher
+            else:
+                self.psampleq = transport.make_queue(cfg)
+                self.transports.append(self.psampleq)
             self.proc = processor.CustomProcessor(self.sampleq, self.psampleq,
                                                   cfg)
         else:
             self.proc = None
             self.psampleq = self.sampleq
 
-        if cfg.graphite_pickle_enabled:
-            carbon_client = carbon.PickleClient
-        else:
-            carbon_client = carbon.PlaintextClient
-
         self.clients = []
-        for client in cfg.custom_clients + [carbon_client]:
-            send, recv = multiprocessing.Pipe()
+        for i, client in enumerate(client_types):
+            if inboxes is not None:
+                send, recv = None, inboxes[i]
+            else:
+                send, recv = transport.make_pipe(cfg)
+                if send is recv:
+                    self.transports.append(send)
             instance = client(cfg, recv)
             self.clients.append((instance, send))
+        self.stopping = False
 
     def run(self):
         def sigterm_handler(signum, frame):
             log.info("Received SIGTERM")
-            self.psampleq.put(None)
+            if self.publisher is not None:
+                self.stopping = True
+            else:
+                self.psampleq.put(None)
 
         for server in self.servers:
             server.start()
@@ -288,15 +329,22 @@ class Bucky(object):
 
         signal.signal(signal.SIGTERM, sigterm_handler)
 
+        if self.publisher is not None:
+            self.supervise()
+        else:
+            self.fanout()
+        self.shutdown()
+
+    def fanout(self):
         while True:
             try:
-                sample = self.psampleq.get(True, 1)
-                if not sample:
+                batch = self.psampleq.get(True, 1)
+                if batch is None:
                     break
                 for instance, pipe in self.clients:
                     if not instance.is_alive():
                         self.shutdown("Client process died. Exiting.")
-                    pipe.send(sample)
+                    pipe.send(batch)
             except queue.Empty:
                 pass
             except IOError as exc:
@@ -305,12 +353,25 @@ class Bucky(object):
                 continue
             except KeyboardInterrupt:
                 break
-            for srv in self.servers:
-                if not srv.is_alive():
-                    self.shutdown("Server thread died. Exiting.")
-            if self.proc is not None and not self.proc.is_alive():
-                self.shutdown("Processor thread died. Exiting.")
-        self.shutdown()
+            self.check_children()
+
+    def supervise(self):
+        while not self.stopping:
+            try:
+                time.sleep(1)
+            except KeyboardInterrupt:
+                break
+            for instance, pipe in self.clients:
+                if not instance.is_alive():
+                    self.shutdown("Client process died. Exiting.")
+            self.check_children()
+
+    def check_children(self):
+        for srv in self.servers:
+            if not srv.is_alive():
+                self.shutdown("Server thread died. Exiting.")
+        if self.proc is not None and not self.proc.is_alive():
+            self.shutdown("Processor thread died. Exiting.")
 
     def shutdown(self, err=''):
         log.info("Shutting down")
@@ -322,15 +383,20 @@ class Bucky(object):
             log.info("Stopping processor %s", self.proc)
             self.sampleq.put(None)
             self.proc.join(cfg.process_join_timeout)
+        if self.publisher is not None:
+            self.publisher.put(None)
         for client, pipe in self.clients:
             log.info("Stopping client %s", client)
-            pipe.send(None)
+            if pipe is not None:
+                pipe.send(None)
             client.join(cfg.process_join_timeout)
         children = [child for child in multiprocessing.active_children() if not child.name.startswith("SyncManager")]
         for child in children:
             log.error("Child %s didn't die gracefully, terminating", child)
             child.terminate()
             child.join(1)
+        for trans in self.transports:
+            trans.close()
         if children and not err:
             err = "Not all children died gracefully: %s" % children
         if err:
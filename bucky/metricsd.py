@@ -106,7 +106,7 @@ class MetricsDParser(object):
             value, data = self.parse_number(data)
         else:
             value = None
-        stat = names.statname(hostname, name.split("."))
+        stat = names.statname(hostname, name)
         cmd = MetricsDCommand(stat, mtype, action, value)
         return cmd, data
 
@@ -182,14 +182,20 @@ class MetricsDHandler(multiprocessing.Process):
 
     if six.PY3:
         def flush_updates(self):
+            batch = []
             for _, metric in self.metrics.items():
                 for v in metric.metrics():
-                    self.outbox.put((v.name, v.value, v.time))
+                    batch.append((v.name, v.value, v.time))
+            if batch:
+                self.outbox.put(batch)
     else:
         def flush_updates(self):
+            batch = []
             for _, metric in self.metrics.iteritems():
                 for v in metric.metrics():
-                    self.outbox.put((v.name, v.value, v.time))
+                    batch.append((v.name, v.value, v.time))
+            if batch:
+                self.outbox.put(batch)
 
 
 class MetricsDServer(UDPServer):
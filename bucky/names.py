@@ -20,32 +20,59 @@ import bucky.cfg as cfg
 __host_trim__ = None
 
 
+class HostTrimmer(object):
+    """Reverse the labels of host names and trim the name_host_trim suffixes
+
+    The rules are compiled into a trie of reversed labels, so trimming a
+    host walks at most one trie node per label however many rules there
+    are. When several rules match, the first one in the configuration
+    wins. Results are memoized per host, the memo is cleared once it holds
+    `size` hosts.
+    """
+
+    def __init__(self, rules, size):
+        self.trie = {}
+        for index, rule in enumerate(rules):
+            node = self.trie
+            for label in reversed([p.strip() for p in rule.split(".")]):
+                node = node.setdefault(label, {})
+            # None marks the end of a rule, keep the first of duplicates
+            node.setdefault(None, index)
+        self.size = size
+        self.memo = {}
+
+    def __call__(self, host):
+        parts = self.memo.get(host)
+        if parts is None:
+            if len(self.memo) >= self.size:
+                self.memo.clear()
+            parts = self.memo[host] = self.trim(host)
+        return parts
+
+    def trim(self, host):
+        parts = tuple(reversed([p.strip() for p in host.split(".")]))
+        node = self.trie
+        best, trim_len = None, 0
+        for depth, label in enumerate(parts):
+            node = node.get(label)
+            if node is None:
+                break
+            index = node.get(None)
+            if index is not None and (best is None or index < best):
+                best, trim_len = index, depth + 1
+        return parts[trim_len:]
+
+
 def _get_host_trim():
     global __host_trim__
     if __host_trim__ is not None:
         return __host_trim__
-    host_trim = cfg.name_host_trim
-    __host_trim__ = []
-    for s in host_trim:
-        s = list(reversed([p.strip() for p in s.split(".")]))
-        __host_trim__.append(s)
+    __host_trim__ = HostTrimmer(cfg.name_host_trim, cfg.name_cache_size)
     return __host_trim__
 
 
 def hostname(host):
-    host_trim = _get_host_trim()
-    parts = host.split(".")
-    parts = list(reversed([p.strip() for p in parts]))
-    for s in host_trim:
-        same = True
-        for i, p in enumerate(s):
-            if p != parts[i]:
-                same = False
-                break
-        if same:
-            parts = parts[len(s):]
-            return parts
-    return parts
+    return list(_get_host_trim()(host))
 
 
 def strip_duplicates(parts):
@@ -56,22 +83,117 @@ def strip_duplicates(parts):
     return ret
 
 
-def statname(host, name):
-    nameparts = name.split('.')
-    parts = []
+def compile_builder():
+    """Return a function that builds stat names with the current cfg
+
+    The name settings are read once. Host and name parts are split on "."
+    and can't contain one, so the replace char only needs to be applied
+    to the prefix and postfix parts, which is done here.
+    """
+    prefix = []
     if cfg.name_prefix:
-        parts.append(cfg.name_prefix)
+        prefix.append(cfg.name_prefix)
     if cfg.name_prefix_parts:
-        parts.extend(cfg.name_prefix_parts)
-    if host:
-        parts.extend(hostname(host))
-    parts.extend(nameparts)
+        prefix.extend(cfg.name_prefix_parts)
+    postfix = []
     if cfg.name_postfix_parts:
-        parts.extend(cfg.name_postfix_parts)
+        postfix.extend(cfg.name_postfix_parts)
     if cfg.name_postfix:
-        parts.append(cfg.name_postfix)
-    if cfg.name_replace_char is not None:
-        parts = [p.replace(".", cfg.name_replace_char) for p in parts]
-    if cfg.name_strip_duplicates:
-        parts = strip_duplicates(parts)
-    return ".".join(parts)
+        postfix.append(cfg.name_postfix)
+    replace_char = cfg.name_replace_char
+    if replace_char is not None:
+        prefix = [p.replace(".", replace_char) for p in prefix]
+        postfix = [p.replace(".", replace_char) for p in postfix]
+    strip = cfg.name_strip_duplicates
+    trim = _get_host_trim()
+
+    def build(host, name):
+        parts = list(prefix)
+        if host:
+            parts.extend(trim(host))
+        parts.extend(name.split("."))
+        parts.extend(postfix)
+        if strip:
+            parts = strip_duplicates(parts)
+        return ".".join(parts)
+    return build
+
+
+class StatNameCache(object):
+    """Generational cache of the stat names of (host, name) pairs
+
+    Names are kept in two dicts. Once the current one holds `size` names
+    it becomes the previous one and a new current dict is started, names
+    found in the previous dict are moved to the current one. Names that
+    are not used for a whole generation are dropped this way, at most
+    2 * `size` names are kept.
+    """
+
+    def __init__(self, build, size):
+        self.build = build
+        self.size = size
+        self.current = {}
+        self.previous = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __call__(self, host, name):
+        key = (host, name)
+        stat = self.current.get(key)
+        if stat is not None:
+            self.hits += 1
+            return stat
+        stat = self.previous.get(key)
+        if stat is None:
+            self.misses += 1
+            stat = self.build(host, name)
+        else:
+            self.hits += 1
+        if len(self.current) >= self.size:
+            self.previous = self.current
+            self.current = {}
+        self.current[key] = stat
+        return stat
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0,
+            "size": len(self.current) + len(self.previous),
+        }
+
+
+__statname__ = None
+
+
+def _get_statname():
+    global __statname__
+    if __statname__ is not None:
+        return __statname__
+    __statname__ = StatNameCache(compile_builder(), cfg.name_cache_size)
+    return __statname__
+
+
+def statname(host, name):
+    cache = __statname__
+    if cache is None:
+        cache = _get_statname()
+    return cache(host, name)
+
+
+def statname_stats():
+    """Return the hits, misses, hit rate and size of the stat name cache"""
+    return _get_statname().stats()
+
+
+def reset():
+    """Forget the compiled name settings and cached names
+
+    The cfg name settings are read on first use, call this after changing
+    them.
+    """
+    global __statname__, __host_trim__
+    __statname__ = None
+    __host_trim__ = None
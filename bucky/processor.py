@@ -28,20 +28,28 @@ class Processor(multiprocessing.Process):
         setproctitle("bucky: %s" % self.__class__.__name__)
         while True:
             try:
-                sample = self.in_queue.get(True, 1)
-                if sample is None:
+                batch = self.in_queue.get(True, 1)
+                if batch is None:
                     break
             except queue.Empty:
                 pass
             else:
-                try:
-                    sample = self.process(*sample)
-                except Exception as exc:
-                    log.error("Error processing sample %s: %r", sample, exc)
-                    if self.drop_on_error:
-                        sample = None
-                if sample is not None:
-                    self.out_queue.put(sample)
+                batch = self.process_batch(batch)
+                if batch:
+                    self.out_queue.put(batch)
+
+    def process_batch(self, samples):
+        ret = []
+        for sample in samples:
+            try:
+                sample = self.process(*sample)
+            except Exception as exc:
+                log.error("Error processing sample %s: %r", sample, exc)
+                if self.drop_on_error:
+                    sample = None
+            if sample is not None:
+                ret.append(sample)
+        return ret
 
     def process(self, host, name, val, time):
         raise NotImplementedError()
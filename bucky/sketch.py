@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import math
+
+import six
+
+
+class DDSketch(object):
+    """Quantile sketch with a relative accuracy guarantee
+
+    Values are counted in bins whose bounds grow by a factor of
+    gamma = (1 + accuracy) / (1 - accuracy), so every value estimated from
+    a bin is within `accuracy` of the true value relative to its size
+    (Masson et al., "DDSketch", VLDB 2019). Memory depends on the range of
+    the values and not on their count. When more than `max_bins` bins are
+    in use the lowest ones are collapsed, which only costs accuracy for the
+    smallest values. Count, sum, lower and upper are kept exactly.
+    """
+
+    def __init__(self, accuracy=0.01, max_bins=2048):
+        self.gamma = (1.0 + accuracy) / (1.0 - accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.max_bins = max_bins
+        self.bins = {}
+        self.negative_bins = {}
+        self.zeros = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.lower = float("inf")
+        self.upper = float("-inf")
+
+    def __len__(self):
+        return self.count
+
+    def append(self, value):
+        if value > 0:
+            bins = self.bins
+            index = int(math.ceil(math.log(value) / self.log_gamma))
+        elif value < 0:
+            bins = self.negative_bins
+            index = int(math.ceil(math.log(-value) / self.log_gamma))
+        else:
+            bins = None
+            self.zeros += 1
+        if bins is not None:
+            n = bins.get(index)
+            if n is None:
+                bins[index] = 1
+                if len(bins) > self.max_bins:
+                    self.collapse(bins)
+            else:
+                bins[index] = n + 1
+        self.count += 1
+        self.sum += value
+        self.sum_squares += value * value
+        if value < self.lower:
+            self.lower = value
+        if value > self.upper:
+            self.upper = value
+
+    def extend(self, values):
+        """Add a sequence of values or merge another sketch"""
+        if not isinstance(values, DDSketch):
+            for value in values:
+                self.append(value)
+            return
+        for bins, other in ((self.bins, values.bins),
+                            (self.negative_bins, values.negative_bins)):
+            for index, n in six.iteritems(other):
+                bins[index] = bins.get(index, 0) + n
+            while len(bins) > self.max_bins:
+                self.collapse(bins)
+        self.zeros += values.zeros
+        self.count += values.count
+        self.sum += values.sum
+        self.sum_squares += values.sum_squares
+        self.lower = min(self.lower, values.lower)
+        self.upper = max(self.upper, values.upper)
+
+    def collapse(self, bins):
+        lowest = min(bins)
+        n = bins.pop(lowest)
+        second = min(bins)
+        bins[second] += n
+
+    def bin_value(self, index):
+        return 2.0 * self.gamma ** index / (self.gamma + 1.0)
+
+    def walk(self):
+        """Yield (estimated value, count) of all bins in ascending order"""
+        lower, upper = self.lower, self.upper
+        for index in sorted(self.negative_bins, reverse=True):
+            value = -self.bin_value(index)
+            yield min(max(value, lower), upper), self.negative_bins[index]
+        if self.zeros:
+            yield 0.0, self.zeros
+        for index in sorted(self.bins):
+            value = self.bin_value(index)
+            yield min(max(value, lower), upper), self.bins[index]
+
+    def values_at(self, ranks):
+        """Return the estimated values at the 0-based `ranks`"""
+        values = [None] * len(ranks)
+        order = iter(sorted(range(len(ranks)), key=ranks.__getitem__))
+        pos = next(order, None)
+        seen = 0
+        for value, n in self.walk():
+            seen += n
+            while pos is not None and ranks[pos] < seen:
+                values[pos] = value
+                pos = next(order, None)
+            if pos is None:
+                break
+        return values
+
+    def sum_lowest(self, count):
+        """Return the estimated sum of the `count` smallest values"""
+        total = 0.0
+        for value, n in self.walk():
+            if n >= count:
+                return total + value * count
+            total += value * n
+            count -= n
+        return total
+
+    def stddev(self):
+        mean = self.sum / self.count
+        return math.sqrt(max(self.sum_squares / self.count - mean * mean, 0.0))
+
+
+MASK64 = (1 << 64) - 1
+
+
+def mix64(value):
+    """Spread the bits of the builtin hash of `value` over 64 bits"""
+    h = hash(value) & MASK64
+    h ^= h >> 33
+    h = (h * 0xff51afd7ed558ccd) & MASK64
+    h ^= h >> 33
+    h = (h * 0xc4ceb9fe1a85ec53) & MASK64
+    return h ^ (h >> 33)
+
+
+class HyperLogLog(object):
+    """Cardinality estimate of a set in a fixed amount of memory
+
+    Uses 2 ** precision one byte registers, the standard error of the
+    estimate is about 1.04 / sqrt(2 ** precision), so 0.8% with the
+    default precision of 14 and 16KB per set. Small sets are kept as
+    exact sets of members until they would take about as much memory as
+    the registers.
+
+    Members are hashed with the builtin hash(), which is randomized per
+    interpreter on Python 3. Sketches are only comparable and mergeable
+    between processes forked from the same interpreter.
+    """
+
+    MIN_PRECISION = 4
+    MAX_PRECISION = 16
+
+    def __init__(self, precision=14):
+        if not self.MIN_PRECISION <= precision <= self.MAX_PRECISION:
+            raise ValueError("HyperLogLog precision has to be between %d and %d" %
+                             (self.MIN_PRECISION, self.MAX_PRECISION))
+        self.precision = precision
+        self.members = set()
+        self.registers = None
+        self.threshold = (1 << precision) >> 6
+        self.bits = 64 - precision
+        self.mask = (1 << self.bits) - 1
+
+    def __len__(self):
+        if self.registers is None:
+            return len(self.members)
+        return int(round(self.estimate()))
+
+    def add(self, value):
+        if self.registers is None:
+            self.members.add(value)
+            if len(self.members) > self.threshold:
+                self.to_registers()
+            return
+        h = mix64(value)
+        bits = self.bits
+        rest = h & self.mask
+        # Position of the first set bit of the remaining bits
+        rank = bits - len(bin(rest)) + 3 if rest else bits + 1
+        index = h >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def to_registers(self):
+        members = self.members
+        self.registers = bytearray(1 << self.precision)
+        self.members = None
+        for value in members:
+            self.add(value)
+
+    def update(self, values):
+        """Add a sequence of members or merge another sketch"""
+        if not isinstance(values, HyperLogLog):
+            for value in values:
+                self.add(value)
+            return
+        if values.registers is None:
+            self.update(values.members)
+            return
+        if self.registers is None:
+            self.to_registers()
+        registers = self.registers
+        for index, rank in enumerate(values.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def estimate(self):
+        registers = self.registers
+        m = len(registers)
+        if m >= 128:
+            alpha = 0.7213 / (1 + 1.079 / m)
+        else:
+            alpha = {16: 0.673, 32: 0.697, 64: 0.709}[m]
+        total = 0.0
+        for rank in range(max(registers) + 1):
+            count = registers.count(six.int2byte(rank))
+            if count:
+                total += count * 2.0 ** -rank
+        estimate = alpha * m * m / total
+        zeros = registers.count(b"\x00")
+        if estimate <= 2.5 * m and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(float(m) / zeros)
+        return estimate
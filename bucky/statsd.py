@@ -16,47 +16,176 @@
 
 import os
 import re
+import sys
 import six
 import math
 import time
-import json
+import signal
+import socket
 import logging
 import threading
+import multiprocessing
+from array import array
 import bucky.udpserver as udpserver
+import bucky.streamserver as streamserver
+from bucky.sketch import DDSketch, HyperLogLog
+from bucky.store import Expiry, SlotStore, dirty_slots
+from bucky.gaugelog import GaugeLog, read_gauges, write_gauges
+from bucky.errors import ConfigError
 
 log = logging.getLogger(__name__)
 
 try:
-    from io import open
+    import numpy
 except ImportError:
-    # Python <2.6
-    _open = open
+    numpy = None
 
-    def open(*args, **kwargs):
-        """
-        Wrapper around open which does not support 'encoding' keyword in
-        older versions of Python
-        """
-        kwargs.pop("encoding")
-        return _open(*args, **kwargs)
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python <3.3
+    monotonic = time.time
 
+# Whitespace runs become "_", "/" becomes "-" and anything else that is not
+# allowed in a key is removed. Replacements are never matched again, so one
+# pass gives the same result as applying the three substitutions in turn.
+KEY_RE = re.compile(r"(\s+)|(/)|[^a-zA-Z_\-0-9\.]")
+KEY_REPL = {1: "_", 2: "-"}
+# Number of raw keys whose sanitized form is remembered
+KEY_CACHE_SIZE = 100000
 
-if six.PY3:
-    def read_json_file(gauges_filename):
-        with open(gauges_filename, mode='r', encoding='utf-8') as f:
-            return json.load(f)
 
-    def write_json_file(gauges_filename, gauges):
-        with open(gauges_filename, mode='w', encoding='utf-8') as f:
-            json.dump(gauges, f)
+# Sample types produced by StatsDHandler.parse
+TIMER, GAUGE, GAUGE_DELTA, SET, COUNTER = range(5)
+
+
+if six.PY3:
+    def decode(raw):
+        if isinstance(raw, bytes):
+            return raw.decode("utf-8", "replace")
+        return raw
 else:
-    def read_json_file(gauges_filename):
-        with open(gauges_filename, mode='rb') as f:
-            return json.load(f)
+    def decode(raw):
+        return raw
+
+
+def _key_repl(match):
+    return KEY_REPL.get(match.lastindex, "")
+
+
+def sanitize_key(key):
+    return KEY_RE.sub(_key_repl, key)
+
+
+def merge_gauges(updates, gauges):
+    """Apply the [absolute value or None, delta] gauge updates of a shard"""
+    for k, (value, delta) in six.iteritems(updates):
+        if value is None:
+            value = gauges.get(k, 0.0)
+        gauges.set(k, value + delta)
+
+
+def merge_counters(updates, counters):
+    for k, v in six.iteritems(updates):
+        counters.add(k, v)
+
+
+def merge_samples(snapshot, timers, sets):
+    """Add the timers and sets of a shard snapshot"""
+    shard_timers, shard_counters, shard_sets, shard_gauges = snapshot
+    for k, v in six.iteritems(shard_timers):
+        timer = timers.get(k)
+        if timer is None:
+            timers[k] = v
+        else:
+            timer.extend(v)
+    for k, v in six.iteritems(shard_sets):
+        members = sets.get(k)
+        if members is None:
+            sets[k] = v
+        else:
+            members.update(v)
+
+
+# Timers with fewer values are cheaper to aggregate without numpy
+NUMPY_MIN_VALUES = 128
+
 
-    def write_json_file(gauges_filename, gauges):
-        with open(gauges_filename, mode='wb') as f:
-            json.dump(gauges, f)
+def percentile_index(percentile, count):
+    """Number of the smallest of `count` values below `percentile`"""
+    return max(int(math.floor(percentile / 100.0 * count)), 1)
+
+
+def timer_stats(values, percentiles):
+    """Aggregate the values of a timer
+
+    Returns (count, lower, upper, sum, mean, stddev, median, uppers) where
+    `uppers` holds the largest value below each of `percentiles`. The mean
+    only covers the values below the first percentile, like the mean of
+    the original statsd. Large timers are handled with numpy if available.
+    """
+    if isinstance(values, DDSketch):
+        return sketch_timer_stats(values, percentiles)
+    count = len(values)
+    if numpy is not None and count >= NUMPY_MIN_VALUES:
+        return numpy_timer_stats(values, percentiles)
+    v = sorted(values)
+    vsum = sum(v)
+    indexes = [percentile_index(p, count) for p in percentiles]
+    uppers = [v[i - 1] for i in indexes]
+    if indexes:
+        mean = sum(v[:indexes[0]]) / float(indexes[0])
+    else:
+        mean = vsum / float(count)
+    mid = count // 2
+    median = v[mid] if count % 2 else (v[mid - 1] + v[mid]) / 2.0
+    avg = vsum / float(count)
+    stddev = math.sqrt(sum((x - avg) ** 2 for x in v) / count)
+    return count, v[0], v[-1], vsum, mean, stddev, median, uppers
+
+
+def numpy_timer_stats(values, percentiles):
+    if isinstance(values, array):
+        v = numpy.frombuffer(values, dtype=numpy.float64)
+    else:
+        v = numpy.asarray(values, dtype=numpy.float64)
+    count = len(v)
+    indexes = [percentile_index(p, count) for p in percentiles]
+    mid = count // 2
+    # Partial sort: only the positions that are reported end up in place,
+    # with all smaller values in front of them
+    kth = set([0, count - 1, mid, max(mid - 1, 0)])
+    kth.update(i - 1 for i in indexes)
+    v = numpy.partition(v, sorted(kth))
+    vsum = float(v.sum())
+    uppers = [float(v[i - 1]) for i in indexes]
+    if indexes:
+        mean = float(v[:indexes[0]].sum()) / indexes[0]
+    else:
+        mean = vsum / count
+    median = float(v[mid]) if count % 2 else (float(v[mid - 1]) + float(v[mid])) / 2.0
+    return count, float(v[0]), float(v[-1]), vsum, mean, float(v.std()), median, uppers
+
+
+def sketch_timer_stats(sketch, percentiles):
+    count = len(sketch)
+    indexes = [percentile_index(p, count) for p in percentiles]
+    mid = count // 2
+    values = sketch.values_at([i - 1 for i in indexes] + [max(mid - 1, 0), mid])
+    uppers = values[:len(indexes)]
+    median = values[-1] if count % 2 else (values[-2] + values[-1]) / 2.0
+    if indexes:
+        mean = sketch.sum_lowest(indexes[0]) / float(indexes[0])
+    else:
+        mean = sketch.sum / float(count)
+    return (count, sketch.lower, sketch.upper, sketch.sum, mean,
+            sketch.stddev(), median, uppers)
+
+
+def percentile_suffix(percentile):
+    if percentile == int(percentile):
+        return "%d" % percentile
+    return str(percentile).replace(".", "_")
 
 
 def make_name(parts):
@@ -67,29 +196,44 @@ def make_name(parts):
     return name
 
 
-class StatsDHandler(threading.Thread):
+class StatsDHandler(object):
     def __init__(self, queue, cfg):
-        super(StatsDHandler, self).__init__()
-        self.daemon = True
+        self.thread = None
         self.queue = queue
         self.cfg = cfg
         self.lock = threading.Lock()
         self.timers = {}
-        self.gauges = {}
-        self.counters = {}
+        self.gauges = SlotStore()
+        self.counters = SlotStore()
         self.sets = {}
+        self.shards = []
+        self.shards_lock = threading.Lock()
+        self.batch = []
+        self.batch_size = cfg.sample_batch_size
         self.flush_time = cfg.statsd_flush_time
+        self.last_flush = monotonic()
+        self.last_boundary = None
+        self.percentiles = list(cfg.statsd_timer_percentiles)
+        for percentile in self.percentiles:
+            if not 0 <= percentile <= 100:
+                raise ConfigError("Invalid statsd_timer_percentiles value: %r" % percentile)
+        self.sketch_accuracy = cfg.statsd_timer_sketch_accuracy
+        self.sketch_re = None
+        if cfg.statsd_timer_sketch_patterns:
+            self.sketch_re = re.compile("|".join("(?:%s)" % pattern for pattern in
+                                                 cfg.statsd_timer_sketch_patterns))
+        self.hll_prefixes = tuple(cfg.statsd_set_hll_prefixes)
+        self.hll_precision = cfg.statsd_set_hll_precision
+        if not HyperLogLog.MIN_PRECISION <= self.hll_precision <= HyperLogLog.MAX_PRECISION:
+            raise ConfigError("Invalid statsd_set_hll_precision: %r, it has to be between %d and %d" %
+                              (self.hll_precision, HyperLogLog.MIN_PRECISION, HyperLogLog.MAX_PRECISION))
         self.legacy_namespace = cfg.statsd_legacy_namespace
         self.global_prefix = cfg.statsd_global_prefix
         self.prefix_counter = cfg.statsd_prefix_counter
         self.prefix_timer = cfg.statsd_prefix_timer
         self.prefix_gauge = cfg.statsd_prefix_gauge
         self.prefix_set = cfg.statsd_prefix_set
-        self.key_res = (
-            (re.compile("\s+"), "_"),
-            (re.compile("\/"), "-"),
-            (re.compile("[^a-zA-Z_\-0-9\.]"), "")
-        )
+        self.keys = {}
 
         if self.legacy_namespace:
             self.name_global = 'stats.'
@@ -107,248 +251,677 @@ class StatsDHandler(threading.Thread):
 
         self.statsd_persistent_gauges = cfg.statsd_persistent_gauges
         self.gauges_filename = os.path.join(self.cfg.directory, self.cfg.statsd_gauges_savefile)
+        self.gauges_log = GaugeLog(self.gauges_filename + ".log")
+        self.gauges_lock = threading.Lock()
+        self.snapshot_interval = cfg.statsd_gauges_snapshot_interval
+        self.last_snapshot = monotonic()
+
+        # Output names of every key, built when the key is first flushed
+        self.timer_names = {}
+        self.counter_names = {}
+        self.gauge_names = {}
+        self.set_names = {}
 
-        self.keys_seen = set()
         self.delete_idlestats = cfg.statsd_delete_idlestats
         self.delete_counters = self.delete_idlestats and cfg.statsd_delete_counters
         self.delete_timers = self.delete_idlestats and cfg.statsd_delete_timers
         self.delete_sets = self.delete_idlestats and cfg.statsd_delete_sets
         self.onlychanged_gauges = self.delete_idlestats and cfg.statsd_onlychanged_gauges
+        self.counter_expiry = Expiry(cfg.statsd_idlestats_ttl)
+        self.timer_expiry = Expiry(cfg.statsd_idlestats_ttl)
+        self.set_expiry = Expiry(cfg.statsd_idlestats_ttl)
 
     def load_gauges(self):
+        """Load the gauge snapshot and replay the log written after it"""
         if not self.statsd_persistent_gauges:
             return
-        if not os.path.isfile(self.gauges_filename):
-            return
-        log.info("StatsD: Loading saved gauges %s", self.gauges_filename)
         try:
-            gauges = read_json_file(self.gauges_filename)
-        except IOError:
-            log.exception("StatsD: IOError")
-        else:
-            self.gauges.update(gauges)
-            self.keys_seen.update(gauges.keys())
+            if os.path.isfile(self.gauges_filename):
+                log.info("StatsD: Loading saved gauges %s", self.gauges_filename)
+                for k, v in read_gauges(self.gauges_filename):
+                    self.gauges.set(k, v)
+            for k, v in self.gauges_log.replay():
+                self.gauges.set(k, v)
+            stored = self.gauges_log.stored_size()
+        except (IOError, OSError, ValueError):
+            log.exception("StatsD: Failed to load gauges")
+            return
+        if stored:
+            # Fold the log into a new snapshot. This also drops a torn record
+            # at the end of the log, even if it is all the log holds, before
+            # anything is appended after it.
+            self.save_gauges()
 
     def save_gauges(self):
+        """Write a snapshot of all gauges and start a new log"""
         if not self.statsd_persistent_gauges:
             return
-        try:
-            write_json_file(self.gauges_filename, self.gauges)
-        except IOError:
-            log.exception("StatsD: IOError")
+        with self.lock:
+            items = self.gauges.items()
+        self.write_snapshot(items)
+
+    def write_snapshot(self, items):
+        with self.gauges_lock:
+            try:
+                write_gauges(self.gauges_filename, items)
+                self.gauges_log.clear()
+            except (IOError, OSError):
+                log.exception("StatsD: Failed to save gauges")
+            self.last_snapshot = monotonic()
+
+    def persist_gauges(self, keys, values, dirty):
+        """Log the changed gauges and take a snapshot every interval
+
+        Called by the flush thread with the detached gauge arrays. The
+        snapshot is taken from the same arrays as the last log records, so
+        the log never holds values older than the snapshot.
+        """
+        changed = [(keys[slot], values[slot]) for slot in dirty_slots(dirty)
+                   if keys[slot] is not None]
+        if changed:
+            with self.gauges_lock:
+                try:
+                    self.gauges_log.append(changed)
+                except (IOError, OSError):
+                    log.exception("StatsD: Failed to log gauges")
+        if self.gauges_log.size and monotonic() - self.last_snapshot >= self.snapshot_interval:
+            self.write_snapshot([(k, values[slot]) for slot, k in enumerate(keys) if k is not None])
+
+    def start(self):
+        # The flush thread is created here rather than in __init__: the
+        # handler is created before the server process is forked and a
+        # thread object that crossed a fork may report itself as stopped.
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def is_alive(self):
+        return self.thread is not None and self.thread.is_alive()
 
     def run(self):
-        name_global_numstats = self.name_global + "numStats"
+        self.last_flush = monotonic()
         while True:
-            time.sleep(self.flush_time)
-            stime = int(time.time())
+            stime, lag = self.wait_flush()
+            self.flush(stime, lag)
+
+    def wait_flush(self):
+        """Sleep until the next multiple of the flush time on the wall clock
+
+        Aligned flushes put the stats of all bucky instances with the same
+        flush time in the same Graphite buckets. The sleep is measured on
+        the monotonic clock so clock steps do not stretch it. Returns the
+        timestamp of the boundary and how late the wakeup was. If the wall
+        clock stepped back, the timestamp is one flush time after the last
+        one, so a bucket is never written twice.
+        """
+        now = time.time()
+        boundary = (math.floor(now / self.flush_time) + 1) * self.flush_time
+        deadline = monotonic() + boundary - now
+        remaining = boundary - now
+        while remaining > 0:
+            time.sleep(remaining)
+            remaining = deadline - monotonic()
+        lag = time.time() - boundary
+        if self.last_boundary is not None:
+            boundary = max(boundary, self.last_boundary + self.flush_time)
+        self.last_boundary = boundary
+        return int(boundary), lag
+
+    def flush(self, stime, lag=0.0):
+        """Emit the stats of the last interval
+
+        Only swapping the timer and set maps for empty ones and taking the
+        counter and gauge arrays happens under the lock, so receiving is
+        not held up while the stats are computed from the detached data.
+        The timer and set keys to report are remembered by the output name
+        caches, which only the flush thread uses. Rates are computed over
+        the measured time since the previous swap.
+        """
+        start = monotonic()
+        snapshots = self.collect_shards() if self.shards else []
+        with self.lock:
+            for snapshot in snapshots:
+                merge_counters(snapshot[1], self.counters)
+                merge_gauges(snapshot[3], self.gauges)
+            timers, sets = self.timers, self.sets
+            self.timers, self.sets = {}, {}
+            counters, counters_dirty = self.counters.take(reset=True)
+            gauges, gauges_dirty = self.gauges.take()
+            counter_keys = self.counters.keys[:len(counters)]
+            gauge_keys = self.gauges.keys[:len(gauges)]
+            now = monotonic()
+        interval = now - self.last_flush
+        self.last_flush = now
+        for snapshot in snapshots:
+            merge_samples(snapshot, timers, sets)
+        self.delete_idle_stats(timers, sets, counter_keys, counters_dirty)
+        num_stats = self.enqueue_timers(timers, stime, interval)
+        num_stats += self.enqueue_counters(counter_keys, counters, stime, interval)
+        num_stats += self.enqueue_gauges(gauge_keys, gauges, gauges_dirty, stime)
+        num_stats += self.enqueue_sets(sets, stime)
+        if self.statsd_persistent_gauges:
+            self.persist_gauges(gauge_keys, gauges, gauges_dirty)
+        self.enqueue(self.name_global + "numStats", num_stats, stime)
+        self.enqueue(self.name_global + "flushLag", lag, stime)
+        self.enqueue(self.name_global + "flushDuration", monotonic() - start, stime)
+        self.flush_batch()
+
+    def delete_idle_stats(self, timers, sets, counter_keys, counters_dirty):
+        """Forget the keys that were idle for `statsd_idlestats_ttl` flushes
+
+        Takes the detached data of the flushed interval. Only the keys that
+        are due in this flush are checked, see Expiry.
+        """
+        if self.delete_timers:
+            self.timer_expiry.touch(timers)
+            for k in self.timer_expiry.expire():
+                self.timer_names.pop(k, None)
+        if self.delete_sets:
+            self.set_expiry.touch(sets)
+            for k in self.set_expiry.expire():
+                self.set_names.pop(k, None)
+        if self.delete_counters:
+            expiry = self.counter_expiry
+            expiry.touch(counter_keys[slot] for slot in dirty_slots(counters_dirty))
+            expired = expiry.expire()
+            if not expired:
+                return
+            slots = self.counters.slots
             with self.lock:
-                if self.delete_timers:
-                    rem_keys = set(self.timers.keys()) - self.keys_seen
-                    for k in rem_keys:
-                        del self.timers[k]
-                if self.delete_counters:
-                    rem_keys = set(self.counters.keys()) - self.keys_seen
-                    for k in rem_keys:
-                        del self.counters[k]
-                if self.delete_sets:
-                    rem_keys = set(self.sets.keys()) - self.keys_seen
-                    for k in rem_keys:
-                        del self.sets[k]
-                num_stats = self.enqueue_timers(stime)
-                num_stats += self.enqueue_counters(stime)
-                num_stats += self.enqueue_gauges(stime)
-                num_stats += self.enqueue_sets(stime)
-                self.enqueue(name_global_numstats, num_stats, stime)
-                self.keys_seen = set()
+                for k in expired:
+                    slot = slots[k]
+                    if self.counters.dirty[slot]:
+                        # Updated since the swap, it is not idle after all
+                        expiry.touch([k])
+                        continue
+                    self.counters.remove(k)
+                    if slot < len(counter_keys):
+                        counter_keys[slot] = None
+            for k in expired:
+                if k not in slots:
+                    self.counter_names.pop(k, None)
+
+    def collect_shards(self):
+        """Return the snapshots of the worker processes
+
+        Every shard is a pipe to a StatsDShardHandler. All workers are asked
+        for their snapshot first so they swap their maps at about the same
+        time, then the answers are collected.
+        """
+        snapshots = []
+        with self.shards_lock:
+            pipes = []
+            for pipe in self.shards:
+                try:
+                    pipe.send(True)
+                    pipes.append(pipe)
+                except (IOError, EOFError):
+                    log.error("StatsD: Lost connection to a worker")
+            for pipe in pipes:
+                try:
+                    if not pipe.poll(self.flush_time):
+                        log.error("StatsD: Worker did not answer in time")
+                        continue
+                    # A late answer to a previous request may be queued as well
+                    while pipe.poll():
+                        snapshots.append(pipe.recv())
+                except (IOError, EOFError):
+                    log.error("StatsD: Lost connection to a worker")
+        return snapshots
+
+    def merge_shards(self):
+        """Fold the aggregates of the worker processes into this handler"""
+        snapshots = self.collect_shards()
+        with self.lock:
+            for snapshot in snapshots:
+                self.merge(snapshot)
+
+    def merge(self, snapshot):
+        merge_counters(snapshot[1], self.counters)
+        merge_gauges(snapshot[3], self.gauges)
+        merge_samples(snapshot, self.timers, self.sets)
 
     def enqueue(self, name, stat, stime):
         # No hostnames on statsd
-        self.queue.put((None, name, stat, stime))
+        self.batch.append((None, name, stat, stime))
+        if len(self.batch) >= self.batch_size:
+            self.flush_batch()
+
+    def flush_batch(self):
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def make_timer_names(self, k):
+        prefix = "%s%s." % (self.name_timer, k)
+        names = self.timer_names[k] = (
+            prefix + "mean",
+            prefix + "upper",
+            tuple(prefix + "upper_" + percentile_suffix(p) for p in self.percentiles),
+            prefix + "lower",
+            prefix + "count",
+            prefix + "count_ps",
+            prefix + "sum",
+            prefix + "std",
+            prefix + "median",
+        )
+        return names
 
-    def enqueue_timers(self, stime):
-        ret = 0
-        iteritems = self.timers.items() if six.PY3 else self.timers.iteritems()
-        for k, v in iteritems:
+    def make_counter_names(self, k):
+        if self.legacy_namespace:
+            names = ("%s%s" % (self.name_legacy_rate, k),
+                     "%s%s" % (self.name_legacy_count, k))
+        else:
+            names = ("%s%s.rate" % (self.name_counter, k),
+                     "%s%s.count" % (self.name_counter, k))
+        self.counter_names[k] = names
+        return names
+
+    def make_set_name(self, k):
+        name = self.set_names[k] = "%s%s.count" % (self.name_set, k)
+        return name
+
+    def enqueue_timers(self, timers, stime, interval=None):
+        interval = interval or self.flush_time
+        percentiles = self.percentiles
+        timer_names = self.timer_names
+        for k in timers:
+            if k not in timer_names:
+                self.make_timer_names(k)
+        iteritems = timer_names.items() if six.PY3 else timer_names.iteritems()
+        for k, names in iteritems:
+            v = timers.get(k)
+            (name_mean, name_upper, names_thresh, name_lower, name_count,
+             name_count_ps, name_sum, name_std, name_median) = names
             # Skip timers that haven't collected any values
             if not v:
-                self.enqueue("%s%s.count" % (self.name_timer, k), 0, stime)
-                self.enqueue("%s%s.count_ps" % (self.name_timer, k), 0.0, stime)
+                self.enqueue(name_count, 0, stime)
+                self.enqueue(name_count_ps, 0.0, stime)
             else:
-                v.sort()
-                pct_thresh = 90
-                count = len(v)
-                vmin, vmax = v[0], v[-1]
-                mean, vthresh = vmin, vmax
-
-                if count > 1:
-                    thresh_idx = int(math.floor(pct_thresh / 100.0 * count))
-                    v = v[:thresh_idx]
-                    vthresh = v[-1]
-                    vsum = sum(v)
-                    mean = vsum / float(len(v))
-
-                self.enqueue("%s%s.mean" % (self.name_timer, k), mean, stime)
-                self.enqueue("%s%s.upper" % (self.name_timer, k), vmax, stime)
-                t = int(pct_thresh)
-                self.enqueue("%s%s.upper_%s" % (self.name_timer, k, t), vthresh, stime)
-                self.enqueue("%s%s.lower" % (self.name_timer, k), vmin, stime)
-                self.enqueue("%s%s.count" % (self.name_timer, k), count, stime)
-                self.enqueue("%s%s.count_ps" % (self.name_timer, k), float(count) / self.flush_time, stime)
-            self.timers[k] = []
-            ret += 1
-
-        return ret
-
-    def enqueue_sets(self, stime):
+                count, vmin, vmax, vsum, mean, stddev, median, uppers = timer_stats(v, percentiles)
+                self.enqueue(name_mean, mean, stime)
+                self.enqueue(name_upper, vmax, stime)
+                for name, value in zip(names_thresh, uppers):
+                    self.enqueue(name, value, stime)
+                self.enqueue(name_lower, vmin, stime)
+                self.enqueue(name_count, count, stime)
+                self.enqueue(name_count_ps, float(count) / interval, stime)
+                self.enqueue(name_sum, vsum, stime)
+                self.enqueue(name_std, stddev, stime)
+                self.enqueue(name_median, median, stime)
+        return len(timer_names)
+
+    def enqueue_sets(self, sets, stime):
+        set_names = self.set_names
+        for k in sets:
+            if k not in set_names:
+                self.make_set_name(k)
+        iteritems = set_names.items() if six.PY3 else set_names.iteritems()
+        for k, name in iteritems:
+            v = sets.get(k)
+            self.enqueue(name, len(v) if v else 0, stime)
+        return len(set_names)
+
+    def enqueue_gauges(self, keys, values, dirty, stime):
+        gauge_names = self.gauge_names
+        # only send a value if there was an update if `delete_idlestats` is `True`
+        if self.onlychanged_gauges:
+            slots = dirty_slots(dirty)
+        else:
+            slots = range(len(keys))
         ret = 0
-        iteritems = self.sets.items() if six.PY3 else self.sets.iteritems()
-        for k, v in iteritems:
-            self.enqueue("%s%s.count" % (self.name_set, k), len(v), stime)
+        for slot in slots:
+            k = keys[slot]
+            if k is None:
+                continue
+            name = gauge_names.get(k)
+            if name is None:
+                name = gauge_names[k] = "%s%s" % (self.name_gauge, k)
+            self.enqueue(name, values[slot], stime)
             ret += 1
-            self.sets[k] = set()
-        return ret
-
-    def enqueue_gauges(self, stime):
-        ret = 0
-        iteritems = self.gauges.items() if six.PY3 else self.gauges.iteritems()
-        for k, v in iteritems:
-            # only send a value if there was an update if `delete_idlestats` is `True`
-            if not self.onlychanged_gauges or k in self.keys_seen:
-                self.enqueue("%s%s" % (self.name_gauge, k), v, stime)
-                ret += 1
         return ret
 
-    def enqueue_counters(self, stime):
+    def enqueue_counters(self, keys, values, stime, interval=None):
+        interval = interval or self.flush_time
+        counter_names = self.counter_names
+        enqueue = self.enqueue
         ret = 0
-        iteritems = self.counters.items() if six.PY3 else self.counters.iteritems()
-        for k, v in iteritems:
-            if self.legacy_namespace:
-                stat_rate = "%s%s" % (self.name_legacy_rate, k)
-                stat_count = "%s%s" % (self.name_legacy_count, k)
-            else:
-                stat_rate = "%s%s.rate" % (self.name_counter, k)
-                stat_count = "%s%s.count" % (self.name_counter, k)
-            self.enqueue(stat_rate, v / self.flush_time, stime)
-            self.enqueue(stat_count, v, stime)
-            self.counters[k] = 0
+        for k, v in zip(keys, values):
+            if k is None:
+                continue
+            names = counter_names.get(k) or self.make_counter_names(k)
+            enqueue(names[0], v / interval, stime)
+            # Counts of whole numbers are reported without a fraction
+            enqueue(names[1], int(v) if v.is_integer() else v, stime)
             ret += 1
         return ret
 
     def handle(self, data):
-        # Adding a bit of extra sauce so clients can
-        # send multiple samples in a single UDP
-        # packet.
-        for line in data.splitlines():
-            self.line = line
-            if not line.strip():
-                continue
-            self.handle_line(line)
+        self.apply(self.parse(data))
 
     def handle_line(self, line):
-        bits = line.split(":")
-        key = self.handle_key(bits.pop(0))
+        self.apply(self.parse(line))
 
-        if not bits:
-            self.bad_line()
-            return
+    def parse(self, data):
+        """Parse a packet into a list of (key, value, type, rate) samples
 
-        # I'm not sure if statsd is doing this on purpose
-        # but the code allows for name:v1|t1:v2|t2 etc etc.
-        # In the interest of compatibility, I'll maintain
-        # the behavior.
-        for sample in bits:
-            if "|" not in sample:
-                self.bad_line()
+        Works on the raw bytes of the packet, str is encoded first. Clients
+        can send multiple samples in a single packet, one per line, and
+        like statsd every line may hold several values for a key:
+        name:v1|t1:v2|t2. Counter values are already divided by the sample
+        rate, which is kept in the tuple. Invalid samples are logged and
+        skipped.
+        """
+        if not isinstance(data, bytes):
+            data = data.encode("utf-8")
+        samples = []
+        append = samples.append
+        handle_key = self.handle_key
+        for line in data.splitlines():
+            if not line.strip():
                 continue
-            fields = sample.split("|")
-            if fields[1] == "ms":
-                self.handle_timer(key, fields)
-            elif fields[1] == "g":
-                self.handle_gauge(key, fields)
-            elif fields[1] == "s":
-                self.handle_set(key, fields)
-            else:
-                self.handle_counter(key, fields)
+            bits = line.split(b":")
+            key = handle_key(bits[0])
+            if len(bits) < 2:
+                self.bad_line(line)
+                continue
+            for sample in bits[1:]:
+                fields = sample.split(b"|")
+                if len(fields) < 2:
+                    self.bad_line(line)
+                    continue
+                stype = fields[1]
+                try:
+                    if stype == b"ms":
+                        append((key, float(fields[0] or 0), TIMER, 1.0))
+                    elif stype == b"g":
+                        valstr = fields[0] or b"0"
+                        if valstr[:1] in (b"+", b"-"):
+                            append((key, float(valstr), GAUGE_DELTA, 1.0))
+                        else:
+                            append((key, float(valstr), GAUGE, 1.0))
+                    elif stype == b"s":
+                        append((key, decode(fields[0] or b"0"), SET, 1.0))
+                    else:
+                        rate = 1.0
+                        if len(fields) > 2 and fields[2][:1] == b"@":
+                            try:
+                                rate = float(fields[2][1:].strip())
+                            except ValueError:
+                                rate = 1.0
+                        append((key, int(float(fields[0] or 0) / rate), COUNTER, rate))
+                except (ValueError, ZeroDivisionError, OverflowError):
+                    self.bad_line(line)
+        return samples
+
+    def apply(self, samples):
+        """Apply parsed samples to the maps under a single lock acquisition"""
+        add_timer = self.add_timer
+        add_counter = self.add_counter
+        add_set = self.add_set
+        set_gauge = self.set_gauge
+        with self.lock:
+            for key, value, stype, rate in samples:
+                if stype == TIMER:
+                    add_timer(key, value)
+                elif stype == COUNTER:
+                    add_counter(key, value)
+                elif stype == SET:
+                    add_set(key, value)
+                else:
+                    set_gauge(key, value, stype == GAUGE_DELTA)
 
     def handle_key(self, key):
-        for (rexp, repl) in self.key_res:
-            key = rexp.sub(repl, key)
-        self.keys_seen.add(key)
-        return key
-
-    def handle_timer(self, key, fields):
-        try:
-            val = float(fields[0] or 0)
-            with self.lock:
-                self.timers.setdefault(key, []).append(val)
-        except:
-            self.bad_line()
+        clean = self.keys.get(key)
+        if clean is None:
+            if len(self.keys) >= KEY_CACHE_SIZE:
+                self.keys.clear()
+            clean = self.keys[key] = sanitize_key(decode(key))
+        return clean
+
+    def add_timer(self, key, value):
+        timer = self.timers.get(key)
+        if timer is None:
+            if self.sketch_re is not None and self.sketch_re.match(key):
+                timer = self.timers[key] = DDSketch(self.sketch_accuracy)
+                timer.append(value)
+            else:
+                self.timers[key] = array("d", [value])
+        else:
+            timer.append(value)
 
-    def handle_gauge(self, key, fields):
-        valstr = fields[0] or "0"
-        try:
-            val = float(valstr)
-        except:
-            self.bad_line()
-            return
-        delta = valstr[0] in ["+", "-"]
-        with self.lock:
-            if delta and key in self.gauges:
-                self.gauges[key] = self.gauges[key] + val
+    def set_gauge(self, key, value, delta):
+        if delta:
+            self.gauges.add(key, value)
+        else:
+            self.gauges.set(key, value)
+
+    def add_set(self, key, value):
+        members = self.sets.get(key)
+        if members is None:
+            if self.hll_prefixes and key.startswith(self.hll_prefixes):
+                members = self.sets[key] = HyperLogLog(self.hll_precision)
+                members.add(value)
             else:
-                self.gauges[key] = val
+                self.sets[key] = set([value])
+        else:
+            members.add(value)
 
-    def handle_set(self, key, fields):
-        valstr = fields[0] or "0"
-        with self.lock:
-            if key not in self.sets:
-                self.sets[key] = set()
-            self.sets[key].add(valstr)
+    def add_counter(self, key, value):
+        self.counters.add(key, value)
+
+    def bad_line(self, line):
+        log.error("StatsD: Invalid line: '%s'", decode(line.strip()))
+
+
+class StatsDShardHandler(StatsDHandler):
+    """Aggregates the samples of one StatsDWorker
+
+    Instead of flushing on its own the handler thread serves snapshot
+    requests from the pipe: the maps are swapped for empty ones and sent to
+    the StatsDServerMP process, which merges all shards before it flushes.
+    Raw timer values and set members are shipped so percentiles and set
+    cardinality are computed over all shards. Gauges are kept as
+    [absolute value or None, sum of deltas] so the merge can apply them on
+    top of the gauges of the main handler. Counters and gauges only live
+    for one interval here, so they are plain dicts instead of slot stores.
+    """
 
-    def handle_counter(self, key, fields):
-        rate = 1.0
-        if len(fields) > 2 and fields[2][:1] == "@":
+    def __init__(self, pipe, cfg):
+        super(StatsDShardHandler, self).__init__(None, cfg)
+        self.pipe = pipe
+        self.counters = {}
+        self.gauges = {}
+
+    def run(self):
+        while True:
             try:
-                rate = float(fields[2][1:].strip())
-            except:
-                rate = 1.0
-        try:
-            val = int(float(fields[0] or 0) / rate)
-        except:
-            self.bad_line()
-            return
+                request = self.pipe.recv()
+            except (IOError, EOFError):
+                break
+            except KeyboardInterrupt:
+                continue
+            if request is None:
+                break
+            self.pipe.send(self.snapshot())
+
+    def snapshot(self):
         with self.lock:
-            if key not in self.counters:
-                self.counters[key] = 0
-            self.counters[key] += val
+            snapshot = (self.timers, self.counters, self.sets, self.gauges)
+            self.timers, self.counters, self.sets, self.gauges = {}, {}, {}, {}
+        return snapshot
+
+    def set_gauge(self, key, value, delta):
+        if not delta:
+            self.gauges[key] = [value, 0.0]
+        elif key in self.gauges:
+            self.gauges[key][1] += value
+        else:
+            self.gauges[key] = [None, value]
 
-    def bad_line(self):
-        log.error("StatsD: Invalid line: '%s'", self.line.strip())
+    def add_counter(self, key, value):
+        self.counters[key] = self.counters.get(key, 0) + value
 
 
 class StatsDServer(udpserver.UDPServer):
-    def __init__(self, queue, cfg):
-        super(StatsDServer, self).__init__(cfg.statsd_ip, cfg.statsd_port)
-        self.handler = StatsDHandler(queue, cfg)
+    """StatsD server on UDP with optional TCP and Unix socket listeners
+
+    The listeners are threads of the server process that feed the same
+    handler, see bucky.streamserver.
+    """
+
+    handler_class = StatsDHandler
+
+    def __init__(self, queue, cfg, reuse_port=False, stop_event=None):
+        super(StatsDServer, self).__init__(cfg.statsd_ip, cfg.statsd_port,
+                                           reuse_port, stop_event)
+        self.handler = self.handler_class(queue, cfg)
+        self.listeners = self.make_listeners(cfg)
+
+    def make_listeners(self, cfg):
+        listeners = []
+        try:
+            if cfg.statsd_tcp_port:
+                sock = streamserver.tcp_socket(cfg.statsd_tcp_ip or cfg.statsd_ip,
+                                               cfg.statsd_tcp_port)
+                listeners.append(streamserver.StreamListener(sock, self.handler.handle))
+                log.info("Listening for StatsD on TCP port %s", cfg.statsd_tcp_port)
+            if cfg.statsd_unix_socket:
+                if cfg.statsd_unix_socket_type == "dgram":
+                    sock = streamserver.unix_socket(cfg.statsd_unix_socket, socket.SOCK_DGRAM)
+                    listener = streamserver.DatagramListener(sock, self.handler.handle)
+                else:
+                    sock = streamserver.unix_socket(cfg.statsd_unix_socket)
+                    listener = streamserver.StreamListener(sock, self.handler.handle)
+                listeners.append(listener)
+                log.info("Listening for StatsD on %s", cfg.statsd_unix_socket)
+        except (socket.error, OSError):
+            log.exception("Error binding StatsD listener")
+            sys.exit(1)
+        return listeners
 
     def pre_shutdown(self):
+        for listener in self.listeners:
+            listener.close()
         self.handler.save_gauges()
 
     def run(self):
         self.handler.load_gauges()
         self.handler.start()
+        for listener in self.listeners:
+            listener.start()
         super(StatsDServer, self).run()
 
-    if six.PY3:
-        def handle(self, data, addr):
-            self.handler.handle(data.decode())
-            if not self.handler.is_alive():
-                return False
-            return True
-    else:
-        def handle(self, data, addr):
-            self.handler.handle(data)
-            if not self.handler.is_alive():
+    def handle(self, data, addr):
+        self.handler.handle(data)
+        if not self.handler.is_alive():
+            return False
+        return True
+
+    def handle_batch(self, packets):
+        # Parse the whole batch without the lock, then apply it at once
+        parse = self.handler.parse
+        samples = []
+        for data, addr in packets:
+            samples.extend(parse(data))
+        if samples:
+            self.handler.apply(samples)
+        return self.handler.is_alive()
+
+
+class StatsDWorker(StatsDServer):
+    """Receives a share of the StatsD traffic on its own SO_REUSEPORT socket"""
+
+    handler_class = StatsDShardHandler
+
+    def __init__(self, pipe, cfg, stop_event, id_num=-1):
+        super(StatsDWorker, self).__init__(pipe, cfg, True, stop_event)
+        self.name = "StatsDWorker%d" % id_num
+
+    def make_listeners(self, cfg):
+        # TCP and Unix socket clients are served by the StatsDServerMP
+        return []
+
+    def run(self):
+        self.handler.start()
+        udpserver.UDPServer.run(self)
+
+    def pre_shutdown(self):
+        pass
+
+
+class StatsDServerMP(StatsDServer):
+    """Multiprocess StatsD server
+
+    The server and cfg.statsd_workers - 1 StatsDWorker processes each bind
+    their own socket to the StatsD port with SO_REUSEPORT, the kernel
+    spreads the datagrams between them without a relay. Every worker
+    aggregates its share and the flush thread of this process merges the
+    snapshots of all workers before computing the stats, so the output is
+    the same as with a single process.
+
+    Gauge updates of one key that reach different processes within a flush
+    interval are merged in worker order, which is not necessarily the order
+    in which they were sent.
+    """
+
+    def __init__(self, queue, cfg):
+        super(StatsDServerMP, self).__init__(queue, cfg, reuse_port=True)
+        self.daemon = False
+        self.cfg = cfg
+        self.workers = []
+
+    def run(self):
+        def sigterm_handler(signum, frame):
+            log.info("Received SIGTERM")
+            self.close()
+
+        self.workers = []
+        for i in range(1, self.cfg.statsd_workers):
+            recv, send = multiprocessing.Pipe()
+            worker = StatsDWorker(recv, self.cfg, self.stop_event, i)
+            worker.start()
+            # Only the worker may keep its socket in the SO_REUSEPORT group
+            worker.sock.close()
+            self.workers.append((worker, send))
+        self.handler.shards = [pipe for worker, pipe in self.workers]
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        super(StatsDServerMP, self).run()
+
+    def handle_batch(self, packets):
+        if not super(StatsDServerMP, self).handle_batch(packets):
+            return False
+        for worker, pipe in self.workers:
+            if not worker.is_alive():
+                log.error("Worker %s died, stopping server.", worker)
                 return False
-            return True
+        return True
+
+    def pre_shutdown(self):
+        log.info("Shutting down StatsDServer")
+        # Pick up the last gauge updates of the workers before saving them
+        self.handler.merge_shards()
+        super(StatsDServerMP, self).pre_shutdown()
+        self.stop_event.set()
+        for worker, pipe in self.workers:
+            log.info("Stopping worker %s", worker)
+            try:
+                pipe.send(None)
+            except (IOError, EOFError):
+                pass
+        for worker, pipe in self.workers:
+            worker.join(self.cfg.process_join_timeout)
+        for child in multiprocessing.active_children():
+            log.error("Child %s didn't die gracefully, terminating", child)
+            child.terminate()
+            child.join(1)
+
+
+def getStatsDServer(queue, cfg):
+    """Get the appropriate statsd server (multi processed or not)"""
+    if cfg.statsd_workers > 1:
+        if hasattr(socket, "SO_REUSEPORT"):
+            return StatsDServerMP(queue, cfg)
+        log.warning("SO_REUSEPORT is not supported, running a single StatsD process")
+    return StatsDServer(queue, cfg)
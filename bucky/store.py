@@ -0,0 +1,165 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from array import array
+
+import six
+
+
+DIRTY = b"\x01"
+
+
+def dirty_slots(dirty):
+    """Yield the slots flagged in `dirty`, skipping the others in C"""
+    find = dirty.find
+    slot = find(DIRTY)
+    while slot >= 0:
+        yield slot
+        slot = find(DIRTY, slot + 1)
+
+
+class SlotStore(object):
+    """Float values of many keys packed in one array
+
+    Every key gets a slot in an array('d'), so the values are not boxed
+    floats in a dict and resetting or copying all of them is a single C
+    level operation. A byte per slot flags the slots written since the
+    flags were last taken, so a consumer can visit only those. Slots of
+    removed keys are reused by new keys. `keys` maps slots back to keys,
+    with None for free slots.
+    """
+
+    def __init__(self):
+        self.slots = {}
+        self.keys = []
+        self.values = array("d")
+        self.dirty = bytearray()
+        self.free = []
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __contains__(self, key):
+        return key in self.slots
+
+    def __getitem__(self, key):
+        return self.values[self.slots[key]]
+
+    def get(self, key, default=None):
+        slot = self.slots.get(key)
+        if slot is None:
+            return default
+        return self.values[slot]
+
+    def items(self):
+        values = self.values
+        return [(key, values[slot]) for key, slot in six.iteritems(self.slots)]
+
+    def slot(self, key):
+        slot = self.slots.get(key)
+        if slot is None:
+            if self.free:
+                slot = self.free.pop()
+                self.keys[slot] = key
+            else:
+                slot = len(self.keys)
+                self.keys.append(key)
+                self.values.append(0.0)
+                self.dirty.append(0)
+            self.slots[key] = slot
+        return slot
+
+    def add(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slot(key)
+        self.values[slot] += value
+        self.dirty[slot] = 1
+
+    def set(self, key, value):
+        slot = self.slots.get(key)
+        if slot is None:
+            slot = self.slot(key)
+        self.values[slot] = value
+        self.dirty[slot] = 1
+
+    def remove(self, key):
+        slot = self.slots.pop(key)
+        self.keys[slot] = None
+        self.values[slot] = 0.0
+        self.dirty[slot] = 0
+        self.free.append(slot)
+
+    def take(self, reset=False):
+        """Return the values and dirty flags and clear the flags
+
+        With `reset` the values are zeroed for the next interval and the
+        returned array is the old one, otherwise it is a copy.
+        """
+        values, dirty = self.values, self.dirty
+        self.dirty = bytearray(len(dirty))
+        if reset:
+            self.values = array("d", [0.0]) * len(values)
+        else:
+            values = values[:]
+        return values, dirty
+
+
+class Expiry(object):
+    """Generation based index of idle keys
+
+    The owner touches the keys it saw in the current generation and calls
+    `expire` once per generation. A key is checked `ttl` generations after
+    it was first touched, and a key that was touched again in between is
+    rescheduled instead of expired. So every generation only looks at the
+    keys due in it, not at every known key.
+    """
+
+    def __init__(self, ttl=1):
+        self.ttl = ttl
+        self.generation = 0
+        self.seen = {}
+        self.due = {}
+
+    def __len__(self):
+        return len(self.seen)
+
+    def touch(self, keys):
+        generation = self.generation
+        seen = self.seen
+        new = []
+        for key in keys:
+            if seen.get(key) is None:
+                new.append(key)
+            seen[key] = generation
+        if new:
+            self.due.setdefault(generation + self.ttl, []).extend(new)
+
+    def expire(self):
+        """Return the keys idle for `ttl` generations and start the next one"""
+        generation = self.generation
+        ttl = self.ttl
+        seen = self.seen
+        expired = []
+        for key in self.due.pop(generation, ()):
+            last = seen.get(key)
+            if last is None:
+                continue
+            if last + ttl <= generation:
+                del seen[key]
+                expired.append(key)
+            else:
+                self.due.setdefault(last + ttl, []).append(key)
+        self.generation = generation + 1
+        return expired
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import stat
+import errno
+import socket
+import select
+import logging
+import threading
+
+
+log = logging.getLogger(__name__)
+
+RECV_SIZE = 65536
+MAX_LINE = 65536
+STOP_POLL_INTERVAL = 1.0
+
+
+def tcp_socket(ip, port):
+    addrinfo = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_STREAM)
+    af, socktype, proto, canonname, addr = addrinfo[0]
+    sock = socket.socket(af, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind(addr[:2])
+    sock.listen(128)
+    return sock
+
+
+def unix_socket(path, socktype=socket.SOCK_STREAM):
+    # A socket file left behind by a previous run would fail the bind
+    if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+        os.unlink(path)
+    sock = socket.socket(socket.AF_UNIX, socktype)
+    sock.bind(path)
+    if socktype == socket.SOCK_STREAM:
+        sock.listen(128)
+    return sock
+
+
+class Listener(threading.Thread):
+    """Thread passing the data received on a socket to `handle`
+
+    `handle` is called synchronously, so while it is busy nothing more is
+    read. The kernel buffers fill up and the senders block: stream clients
+    on the TCP window, Unix datagram clients on the receive queue of the
+    socket, instead of the data being dropped.
+    """
+
+    def __init__(self, sock, handle):
+        super(Listener, self).__init__()
+        self.daemon = True
+        self.sock = sock
+        self.handle = handle
+        self.running = True
+
+    def stop(self):
+        self.running = False
+
+    def close(self):
+        """Stop the thread and remove the socket file of a Unix socket
+
+        The thread finishes within STOP_POLL_INTERVAL, the socket itself is
+        left to be closed with the process.
+        """
+        self.stop()
+        if self.sock.family == socket.AF_UNIX:
+            path = self.sock.getsockname()
+            if path and os.path.exists(path):
+                os.unlink(path)
+
+
+class DatagramListener(Listener):
+    """Receives one or more lines per datagram, like the UDP server"""
+
+    def run(self):
+        sock = self.sock
+        sock.settimeout(STOP_POLL_INTERVAL)
+        while self.running:
+            try:
+                data = sock.recv(RECV_SIZE)
+            except socket.timeout:
+                continue
+            except socket.error as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                if self.running:
+                    log.exception("Error receiving on %s", sock.getsockname())
+                break
+            if data:
+                self.handle(data)
+
+
+class StreamListener(Listener):
+    """Accepts stream connections and reads newline framed lines from them
+
+    All connections are served by this thread with poll(2). Only complete
+    lines are passed to `handle`, the rest is kept until the next read. A
+    connection whose line grows beyond `max_line` bytes is closed.
+    """
+
+    def __init__(self, sock, handle, max_line=MAX_LINE):
+        super(StreamListener, self).__init__(sock, handle)
+        self.max_line = max_line
+        self.conns = {}
+        self.buffers = {}
+
+    def run(self):
+        sock = self.sock
+        sock.setblocking(False)
+        poller = select.poll()
+        poller.register(sock.fileno(), select.POLLIN)
+        timeout = int(STOP_POLL_INTERVAL * 1000)
+        while self.running:
+            try:
+                events = poller.poll(timeout)
+            except (IOError, OSError, select.error) as exc:
+                if exc.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == sock.fileno():
+                    self.accept(poller)
+                else:
+                    self.read(poller, fd)
+        for fd in list(self.conns):
+            self.disconnect(poller, fd)
+
+    def accept(self, poller):
+        try:
+            conn, addr = self.sock.accept()
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            raise
+        conn.setblocking(False)
+        fd = conn.fileno()
+        self.conns[fd] = conn
+        self.buffers[fd] = b""
+        poller.register(fd, select.POLLIN)
+
+    def read(self, poller, fd):
+        conn = self.conns[fd]
+        try:
+            data = conn.recv(RECV_SIZE)
+        except socket.error as exc:
+            if exc.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.EINTR):
+                return
+            data = b""
+        if not data:
+            # A last line does not need a newline before the connection closes
+            if self.buffers[fd]:
+                self.handle(self.buffers[fd])
+            self.disconnect(poller, fd)
+            return
+        buf = self.buffers[fd] + data if self.buffers[fd] else data
+        end = buf.rfind(b"\n")
+        if end < 0:
+            if len(buf) > self.max_line:
+                log.error("Line longer than %d bytes, closing connection", self.max_line)
+                self.disconnect(poller, fd)
+                return
+            self.buffers[fd] = buf
+            return
+        self.buffers[fd] = buf[end + 1:]
+        self.handle(buf[:end])
+
+    def disconnect(self, poller, fd):
+        poller.unregister(fd)
+        self.conns.pop(fd).close()
+        del self.buffers[fd]
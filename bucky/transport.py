@@ -0,0 +1,611 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import os
+import copy
+import operator
+import time
+import struct
+import bisect
+import logging
+import multiprocessing
+from array import array
+
+import six
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:
+    shared_memory = None
+
+from bucky.errors import BuckyError, ConfigError
+
+
+log = logging.getLogger(__name__)
+
+
+def make_queue(cfg, producers=1):
+    """Create the queue the servers (or the processor) put sample batches on
+
+    `producers` is the number of processes that will put on the queue.
+    """
+    if cfg.sample_transport == "queue":
+        return multiprocessing.Queue()
+    if cfg.sample_transport == "shm":
+        return ShmQueue(producers, cfg.sample_transport_ring_size,
+                        cfg.sample_batch_size, timeout=cfg.sample_transport_timeout)
+    raise ConfigError("Invalid sample_transport: %s" % cfg.sample_transport)
+
+
+def make_broadcast(cfg, producers, consumers):
+    """Create a queue whose batches are delivered to every consumer
+
+    Returns the queue producers put on and a list with the pipe like
+    reading end of every consumer.
+    """
+    if cfg.sample_transport == "queue":
+        inboxes = [QueueInbox() for i in range(consumers)]
+        return Broadcast(inboxes), inboxes
+    if cfg.sample_transport == "shm":
+        shmq = ShmQueue(producers, cfg.sample_transport_ring_size,
+                        cfg.sample_batch_size, consumers, cfg.sample_transport_timeout)
+        return shmq, [shmq.reader(i) for i in range(consumers)]
+    raise ConfigError("Invalid sample_transport: %s" % cfg.sample_transport)
+
+
+def make_pipe(cfg):
+    """Create a (send, recv) pair used to hand sample batches to a client"""
+    if cfg.sample_transport == "queue":
+        return multiprocessing.Pipe()
+    if cfg.sample_transport == "shm":
+        ring = ShmRing(cfg.sample_transport_ring_size, cfg.sample_batch_size,
+                       timeout=cfg.sample_transport_timeout)
+        return ring, ring
+    raise ConfigError("Invalid sample_transport: %s" % cfg.sample_transport)
+
+
+REC_SIZE = 32
+REC_BATCH = 1
+REC_NAME = 2
+REC_RESET = 3
+REC_STOP = 4
+
+INT_TYPES = frozenset([int])
+
+# Every group of records starts with a header record:
+#   batch: kind, column types, number of samples, 0, 0, 0
+#   name:  kind, 0, string id, length of the utf-8 string that follows
+#          in the next records, 0, 0
+# The samples of a batch follow their header as columns: host ids, metric
+# name ids, values and times. The low two bits of the column types are
+# the type of the value column, the next two the type of the time column.
+RECORD = struct.Struct("<BBxxIIxxxxdd")
+ID_TYPE = "I"
+# Column of doubles, of int64 or of doubles followed by a byte per value
+# that is set for the values that were ints
+COL_FLOATS = 0
+COL_INTS = 1
+COL_MIXED = 2
+# Largest size of a sample in a batch
+SAMPLE_BYTES = 26
+POS_STRUCT = struct.Struct("<Q")
+ZERO_RECORD = bytes(REC_SIZE) if six.PY3 else b"\0" * REC_SIZE
+RESET_RECORD = RECORD.pack(REC_RESET, 0, 0, 0, 0, 0)
+STOP_RECORD = RECORD.pack(REC_STOP, 0, 0, 0, 0, 0)
+
+# The head and every consumer's tail get a cache line of their own
+HEAD_OFFSET = 0
+POS_SPACING = 64
+
+MAX_INTERNED = (1 << 20)
+HOST, NAME, VALUE, TIME = [operator.itemgetter(i) for i in range(4)]
+
+
+def column_size(coltype, count):
+    return count * 9 if coltype == COL_MIXED else count * 8
+
+
+def batch_size(coltypes, count):
+    """Number of bytes of the columns of a batch"""
+    values = column_size(coltypes & 3, count)
+    return count * 8 + values + column_size(coltypes >> 2, count)
+
+
+def group_records(kind, flags, first, second):
+    """Number of records of the group starting with a header record"""
+    if kind == REC_BATCH:
+        return 1 + (batch_size(flags, first) + REC_SIZE - 1) // REC_SIZE
+    if kind == REC_NAME:
+        return 1 + (second + REC_SIZE - 1) // REC_SIZE
+    return 1
+
+
+def encode_column(column):
+    """Return the type and the bytes of a column of numbers
+
+    Ints beyond the range of int64 are stored as doubles and lose
+    precision like floats do. Raises TypeError or OverflowError if a value
+    is not a number.
+    """
+    try:
+        return COL_INTS, array("q", column).tobytes()
+    except (TypeError, OverflowError):
+        pass
+    data = array("d", column).tobytes()
+    flags = bytes(map(INT_TYPES.__contains__, map(type, column)))
+    if 1 in flags:
+        return COL_MIXED, data + flags
+    return COL_FLOATS, data
+
+
+def decode_column(coltype, data, count):
+    """Return the numbers of a column encoded by `encode_column`"""
+    numbers = array("q" if coltype == COL_INTS else "d")
+    numbers.frombytes(data[:count * 8])
+    if coltype != COL_MIXED:
+        return numbers
+    flags = data[count * 8:count * 9]
+    return [int(v) if flag else v for v, flag in zip(numbers, flags)]
+
+
+class ShmRing(object):
+    """Single producer ring of sample batches
+
+    The ring lives in a `multiprocessing.shared_memory` block and is made of
+    fixed size records. A batch is written as one group of records holding
+    its samples column by column, so encoding and decoding it is a few
+    C level array operations rather than a struct call per sample. Host
+    and metric names are interned per ring: the first time the producer
+    sees a string it writes a name record holding the string, after which
+    samples refer to it by id. The producer only writes the head position
+    and the consumer only writes the tail position, so no locking is
+    needed as long as exactly one process puts and one process gets.
+
+    A ring can have several consumers, each with a tail of its own, which
+    turns it into a broadcast: every consumer sees every record and the
+    producer waits for the slowest one. Consumers other than the first
+    use a copy of the ring returned by `reader`.
+
+    When the ring stays full for `timeout` seconds, because a consumer
+    stopped reading or died, the rest of the batch is dropped instead of
+    waiting forever.
+
+    The object is created before the processes are forked and offers both
+    the queue (put/get) and the pipe (send/recv/poll) interfaces.
+    """
+
+    def __init__(self, size, batch_size, consumers=1, timeout=None):
+        if shared_memory is None:
+            raise ConfigError("sample_transport 'shm' requires Python 3.8+")
+        self.capacity = size
+        self.batch_size = batch_size
+        self.consumers = consumers
+        self.timeout = timeout
+        self.offset = POS_SPACING * (consumers + 1)
+        self.shm = shared_memory.SharedMemory(create=True, size=self.offset + size * REC_SIZE)
+        self.buf = self.shm.buf
+        for i in range(consumers + 1):
+            POS_STRUCT.pack_into(self.buf, i * POS_SPACING, 0)
+        self.owner = os.getpid()
+        # Producer side state, a group takes at most half of the ring
+        self.head = 0
+        self.ids = {None: 0}
+        self.reset = False
+        self.group_size = max(min(batch_size, (size // 2 - 1) * REC_SIZE // SAMPLE_BYTES), 1)
+        # Consumer side state
+        self.tail_offset = POS_SPACING
+        self.tail = 0
+        self.names = {0: None}
+
+    def reader(self, index):
+        """Return a copy of the ring that consumes as consumer `index`"""
+        if not 0 <= index < self.consumers:
+            raise BuckyError("Invalid consumer %s for the sample ring" % index)
+        ring = copy.copy(self)
+        ring.tail_offset = POS_SPACING * (index + 1)
+        ring.names = {0: None}
+        return ring
+
+    def _min_tail(self):
+        buf = self.buf
+        return min([POS_STRUCT.unpack_from(buf, POS_SPACING * (i + 1))[0]
+                    for i in range(self.consumers)])
+
+    def put(self, batch):
+        if len(self.ids) > MAX_INTERNED:
+            self.ids = {None: 0}
+            self.reset = True
+        if self.reset:
+            if not self._write(RESET_RECORD, 0):
+                return
+            self.reset = False
+        if batch is None:
+            self._write(STOP_RECORD, 0)
+            return
+        step = self.group_size
+        for i in range(0, len(batch), step):
+            names = bytearray()
+            ends = []
+            data = self._encode(batch[i:i + step], names, ends)
+            if names and not self._write(names, len(names) // REC_SIZE, ends):
+                return
+            if data and not self._write(data, len(data) // REC_SIZE, [len(data) // REC_SIZE]):
+                return
+
+    send = put
+
+    def _encode(self, samples, names, ends):
+        """Return the batch group of `samples`
+
+        Names not interned yet are added to `names`, with the end of every
+        name group in `ends`. Invalid samples are logged and dropped.
+        """
+        try:
+            host_ids = self._ids(samples, HOST, names, ends)
+            name_ids = self._ids(samples, NAME, names, ends)
+            value_type, values = encode_column(list(map(VALUE, samples)))
+            time_type, stimes = encode_column(list(map(TIME, samples)))
+        except (TypeError, ValueError, AttributeError, IndexError, OverflowError) as exc:
+            if len(samples) == 1:
+                log.error("Dropping sample %s: %r", samples[0], exc)
+                return b""
+            # Find the invalid ones, the names of the valid ones stay interned
+            samples = [sample for sample in samples if self._encode([sample], names, ends)]
+            if not samples:
+                return b""
+            return self._encode(samples, names, ends)
+        count = len(samples)
+        coltypes = value_type | time_type << 2
+        data = [RECORD.pack(REC_BATCH, coltypes, count, 0, 0, 0),
+                host_ids.tobytes(), name_ids.tobytes(), values, stimes]
+        padding = -batch_size(coltypes, count) % REC_SIZE
+        if padding:
+            data.append(ZERO_RECORD[:padding])
+        return b"".join(data)
+
+    def _ids(self, samples, column, names, ends):
+        """Return the ids of the strings in `column` of `samples`"""
+        ids = self.ids
+        try:
+            return array(ID_TYPE, map(ids.get, map(column, samples)))
+        except TypeError:
+            # Some are not interned yet
+            pass
+        intern = self._intern
+        return array(ID_TYPE, [ids[string] if string in ids else intern(names, ends, string)
+                               for string in map(column, samples)])
+
+    def _intern(self, data, ends, string):
+        raw = string.encode("utf-8")
+        nrecs = 1 + (len(raw) + REC_SIZE - 1) // REC_SIZE
+        if nrecs > self.capacity:
+            raise ValueError("name too long for the ring")
+        sid = len(self.ids)
+        data += RECORD.pack(REC_NAME, 0, sid, len(raw), 0, 0)
+        data += raw
+        data += ZERO_RECORD[:(nrecs - 1) * REC_SIZE - len(raw)]
+        ends.append(len(data) // REC_SIZE)
+        self.ids[string] = sid
+        return sid
+
+    def _write(self, data, grouped, ends=None):
+        """Copy records into the ring and publish them
+
+        The first `grouped` records are made of groups (a header record
+        with the records that belong to it) that end at the record offsets
+        in `ends`. A group is never published partially, so the consumer
+        always sees complete groups. All other records stand on their own.
+
+        Returns False if the ring stayed full for `timeout` seconds. The
+        rest of the records are dropped then and the interned names are
+        reset, as some of them may never have reached the consumer.
+        """
+        buf = self.buf
+        count = len(data) // REC_SIZE
+        done = 0
+        delay = 0.0001
+        deadline = None
+        while done < count:
+            tail = self._min_tail()
+            limit = done + self.capacity - (self.head - tail)
+            if limit >= grouped:
+                upto = min(limit, count)
+            else:
+                idx = bisect.bisect_right(ends, limit)
+                upto = ends[idx - 1] if idx else 0
+            if upto <= done:
+                # Ring is full, wait for the consumer
+                if self.timeout is not None:
+                    now = time.time()
+                    if deadline is None:
+                        deadline = now + self.timeout
+                    elif now >= deadline:
+                        log.error("Sample ring full for %s seconds, dropping %d records",
+                                  self.timeout, count - done)
+                        self.ids = {None: 0}
+                        self.reset = True
+                        return False
+                time.sleep(delay)
+                delay = min(delay * 2, 0.01)
+                continue
+            delay = 0.0001
+            deadline = None
+            self._copy_in(data, done, upto)
+            self.head += upto - done
+            POS_STRUCT.pack_into(buf, HEAD_OFFSET, self.head)
+            done = upto
+        return True
+
+    def _copy_in(self, data, start, end):
+        idx = self.head % self.capacity
+        first = min(end - start, self.capacity - idx)
+        off = self.offset + idx * REC_SIZE
+        self.buf[off:off + first * REC_SIZE] = data[start * REC_SIZE:(start + first) * REC_SIZE]
+        if first < end - start:
+            rest = end - start - first
+            self.buf[self.offset:self.offset + rest * REC_SIZE] = \
+                data[(start + first) * REC_SIZE:end * REC_SIZE]
+
+    def _copy_out(self, start, end):
+        idx = start % self.capacity
+        first = min(end - start, self.capacity - idx)
+        off = self.offset + idx * REC_SIZE
+        data = bytes(self.buf[off:off + first * REC_SIZE])
+        if first < end - start:
+            data += bytes(self.buf[self.offset:self.offset + (end - start - first) * REC_SIZE])
+        return data
+
+    def poll(self, timeout=0):
+        deadline = None if timeout is None else time.time() + timeout
+        delay = 0.0001
+        while POS_STRUCT.unpack_from(self.buf, HEAD_OFFSET)[0] == self.tail:
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+        return True
+
+    def get(self, block=True, timeout=None):
+        """Return a list of at most `batch_size` samples, or None on stop"""
+        while True:
+            if not self.poll(timeout if block else 0):
+                raise queue.Empty()
+            batch = self._read_batch()
+            if batch is None or batch:
+                return batch
+
+    def recv(self):
+        return self.get(True, None)
+
+    def _read_batch(self):
+        head = POS_STRUCT.unpack_from(self.buf, HEAD_OFFSET)[0]
+        want = self.batch_size
+        while True:
+            end = min(head, self.tail + want)
+            data = self._copy_out(self.tail, end)
+            batch, used = self._decode(data)
+            if used or end == head:
+                break
+            # The group at the tail does not fit, read all of it
+            want = group_records(*RECORD.unpack_from(data)[:4])
+        self.tail += used
+        POS_STRUCT.pack_into(self.buf, self.tail_offset, self.tail)
+        return batch
+
+    def _decode(self, data):
+        """Decode records, returning the batch and the number of records used
+
+        Whole batch groups are decoded as long as the batch stays within
+        `batch_size` samples.
+        """
+        names = self.names
+        batch = []
+        count = len(data) // REC_SIZE
+        idx = 0
+        while idx < count:
+            kind, flags, first, second = RECORD.unpack_from(data, idx * REC_SIZE)[:4]
+            nrecs = group_records(kind, flags, first, second)
+            if idx + nrecs > count:
+                break
+            start = (idx + 1) * REC_SIZE
+            if kind == REC_BATCH:
+                if batch and len(batch) + first > self.batch_size:
+                    break
+                batch.extend(self._decode_samples(data, start, flags, first))
+            elif kind == REC_NAME:
+                names[first] = data[start:start + second].decode("utf-8")
+            elif kind == REC_RESET:
+                self.names = names = {0: None}
+            elif kind == REC_STOP:
+                if not batch:
+                    return None, idx + 1
+                break
+            else:
+                raise BuckyError("Corrupt record %s in sample ring" % kind)
+            idx += nrecs
+        return batch, idx
+
+    def _decode_samples(self, data, start, coltypes, count):
+        data = memoryview(data)
+        ids = array(ID_TYPE)
+        ids.frombytes(data[start:start + 8 * count])
+        start += 8 * count
+        values = decode_column(coltypes & 3, data[start:], count)
+        start += column_size(coltypes & 3, count)
+        stimes = decode_column(coltypes >> 2, data[start:], count)
+        lookup = self.names.__getitem__
+        return zip(map(lookup, ids[:count]), map(lookup, ids[count:]), values, stimes)
+
+    def close(self):
+        self.buf = None
+        self.shm.close()
+        if os.getpid() == self.owner:
+            self.shm.unlink()
+
+
+class ShmQueue(object):
+    """Multi producer queue made of one ShmRing per producer process
+
+    Every process that puts on the queue claims a ring of its own the first
+    time it does so, which keeps every ring single producer. The consumer
+    reads the rings in turn. With several consumers every ring is a
+    broadcast ring and each consumer reads through its own `reader`.
+    """
+
+    def __init__(self, producers, size, batch_size, consumers=1, timeout=None):
+        # One extra ring for the stop sentinel put by the main process
+        self.rings = [ShmRing(size, batch_size, consumers, timeout)
+                      for i in range(producers + 1)]
+        self.claimed = multiprocessing.Value('i', 0)
+        self.ring = None
+        self.pid = None
+        self.next = 0
+        self.stopped = False
+
+    def reader(self, index):
+        """Return a copy of the queue that consumes as consumer `index`"""
+        shmq = copy.copy(self)
+        shmq.rings = [ring.reader(index) for ring in self.rings]
+        return shmq
+
+    def put(self, batch):
+        if self.pid != os.getpid():
+            with self.claimed.get_lock():
+                idx = self.claimed.value
+                if idx >= len(self.rings):
+                    raise BuckyError("More producers than rings in the sample queue")
+                self.claimed.value = idx + 1
+            self.ring = self.rings[idx]
+            self.pid = os.getpid()
+        self.ring.put(batch)
+
+    send = put
+
+    def poll(self, timeout=0):
+        deadline = None if timeout is None else time.time() + timeout
+        delay = 0.0001
+        while True:
+            for ring in self.rings:
+                if ring.poll(0):
+                    return True
+            if deadline is not None and time.time() >= deadline:
+                return False
+            time.sleep(delay)
+            delay = min(delay * 2, 0.01)
+
+    def get(self, block=True, timeout=None):
+        """Return the next batch, or None once stopped and drained
+
+        A stop put by one producer does not end the queue before the
+        batches already written to the other rings are consumed.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        delay = 0.0001
+        nrings = len(self.rings)
+        while True:
+            for i in range(nrings):
+                ring = self.rings[(self.next + i) % nrings]
+                try:
+                    batch = ring.get(False)
+                except queue.Empty:
+                    continue
+                self.next = (self.next + i + 1) % nrings
+                if batch is None:
+                    self.stopped = True
+                    break
+                return batch
+            else:
+                if self.stopped:
+                    return None
+                if not block or (deadline is not None and time.time() >= deadline):
+                    raise queue.Empty()
+                time.sleep(delay)
+                delay = min(delay * 2, 0.01)
+
+    def recv(self):
+        return self.get(True, None)
+
+    def close(self):
+        for ring in self.rings:
+            ring.close()
+
+
+# Marks an empty `QueueInbox.pending`, None is the stop sentinel
+_EMPTY = object()
+
+
+class QueueInbox(object):
+    """Pipe like reading end of a client's inbox queue
+
+    Batches broadcast to the inboxes are pickled once by `Broadcast` and
+    unpickled here.
+    """
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.pending = _EMPTY
+
+    def put(self, payload):
+        self.queue.put(payload)
+
+    def poll(self, timeout=0):
+        if self.pending is not _EMPTY:
+            return True
+        try:
+            self.pending = self.queue.get(True, timeout)
+        except queue.Empty:
+            return False
+        return True
+
+    def recv(self):
+        payload = self.pending
+        if payload is _EMPTY:
+            payload = self.queue.get()
+        else:
+            self.pending = _EMPTY
+        if payload is None:
+            return None
+        return pickle.loads(payload)
+
+    def close(self):
+        self.queue.close()
+
+
+class Broadcast(object):
+    """Puts every batch on the inboxes of all clients"""
+
+    def __init__(self, inboxes):
+        self.inboxes = inboxes
+
+    def put(self, batch):
+        if batch is not None:
+            batch = pickle.dumps(batch, protocol=-1)
+        for inbox in self.inboxes:
+            inbox.put(batch)
+
+    send = put
+
+    def close(self):
+        for inbox in self.inboxes:
+            inbox.close()
@@ -14,7 +14,10 @@
 
 import six
 import sys
+import errno
+import struct
 import socket
+import select
 import logging
 import multiprocessing
 
@@ -26,12 +29,174 @@ except ImportError:
     def setproctitle(title):
         pass
 
+try:
+    import ctypes
+except ImportError:
+    ctypes = None
+
 
 log = logging.getLogger(__name__)
 
+MAX_DATAGRAM = 65535
+MSG_WAITFORONE = 0x10000
+STOP_POLL_INTERVAL = 1.0
+
+
+class RecvIntoReceiver(object):
+    """Receive datagrams in batches with a non-blocking recvfrom_into loop
+
+    A single preallocated buffer is reused for every datagram, only the
+    received bytes are copied out of it. The receiver waits in select for
+    the first datagram and then drains the socket until it would block or
+    `batch` datagrams have been read. With a `timeout` an empty list is
+    returned when nothing arrived in time.
+    """
+
+    def __init__(self, sock, batch, timeout=None):
+        self.sock = sock
+        self.batch = batch
+        self.timeout = timeout
+        self.buf = bytearray(MAX_DATAGRAM)
+        self.view = memoryview(self.buf)
+        sock.setblocking(False)
+
+    def __call__(self):
+        sock = self.sock
+        view = self.view
+        packets = []
+        while len(packets) < self.batch:
+            try:
+                nbytes, addr = sock.recvfrom_into(self.buf)
+            except socket.error as exc:
+                if exc.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise
+                if packets:
+                    break
+                if not select.select([sock], [], [], self.timeout)[0]:
+                    break
+                continue
+            packets.append((view[:nbytes].tobytes(), addr[:2]))
+        return packets
+
+
+if ctypes is not None:
+    class iovec(ctypes.Structure):
+        _fields_ = [
+            ("iov_base", ctypes.c_void_p),
+            ("iov_len", ctypes.c_size_t),
+        ]
+
+    class msghdr(ctypes.Structure):
+        _fields_ = [
+            ("msg_name", ctypes.c_void_p),
+            ("msg_namelen", ctypes.c_uint32),
+            ("msg_iov", ctypes.POINTER(iovec)),
+            ("msg_iovlen", ctypes.c_size_t),
+            ("msg_control", ctypes.c_void_p),
+            ("msg_controllen", ctypes.c_size_t),
+            ("msg_flags", ctypes.c_int),
+        ]
+
+    class mmsghdr(ctypes.Structure):
+        _fields_ = [
+            ("msg_hdr", msghdr),
+            ("msg_len", ctypes.c_uint),
+        ]
+
+
+def get_recvmmsg():
+    if ctypes is None or not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        recvmmsg = libc.recvmmsg
+    except (OSError, AttributeError):
+        return None
+    recvmmsg.argtypes = [ctypes.c_int, ctypes.POINTER(mmsghdr), ctypes.c_uint,
+                         ctypes.c_int, ctypes.c_void_p]
+    recvmmsg.restype = ctypes.c_int
+    return recvmmsg
+
+
+class RecvmmsgReceiver(object):
+    """Receive up to `batch` datagrams with a single recvmmsg(2) call
+
+    The call blocks until the first datagram arrives (MSG_WAITFORONE) and
+    then returns all datagrams that are already queued on the socket. With
+    a `timeout` the wait is bounded by SO_RCVTIMEO and an empty list is
+    returned when nothing arrived in time.
+    """
+
+    ADDR_SIZE = 128  # sizeof(struct sockaddr_storage)
+
+    def __init__(self, sock, batch, recvmmsg, timeout=None):
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.batch = batch
+        self.recvmmsg = recvmmsg
+        self.bufs = [ctypes.create_string_buffer(MAX_DATAGRAM) for i in range(batch)]
+        self.addrs = [ctypes.create_string_buffer(self.ADDR_SIZE) for i in range(batch)]
+        self.iovs = (iovec * batch)()
+        self.msgs = (mmsghdr * batch)()
+        for i in range(batch):
+            self.iovs[i].iov_base = ctypes.addressof(self.bufs[i])
+            self.iovs[i].iov_len = MAX_DATAGRAM
+            hdr = self.msgs[i].msg_hdr
+            hdr.msg_name = ctypes.addressof(self.addrs[i])
+            hdr.msg_iov = ctypes.pointer(self.iovs[i])
+            hdr.msg_iovlen = 1
+        sock.setblocking(True)
+        if timeout is not None:
+            secs = int(timeout)
+            usecs = int((timeout - secs) * 1000000)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVTIMEO,
+                            struct.pack("ll", secs, usecs))
+
+    def __call__(self):
+        msgs = self.msgs
+        for i in range(self.batch):
+            msgs[i].msg_hdr.msg_namelen = self.ADDR_SIZE
+        count = self.recvmmsg(self.fd, msgs, self.batch, MSG_WAITFORONE, None)
+        if count < 0:
+            err = ctypes.get_errno()
+            if err in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return []
+            raise socket.error(err, errno.errorcode.get(err, "recvmmsg failed"))
+        packets = []
+        for i in range(count):
+            data = ctypes.string_at(self.bufs[i], msgs[i].msg_len)
+            packets.append((data, self.parse_addr(self.addrs[i].raw)))
+        return packets
+
+    @staticmethod
+    def parse_addr(raw):
+        family = ctypes.c_ushort.from_buffer_copy(raw[:2]).value
+        port = (six.indexbytes(raw, 2) << 8) | six.indexbytes(raw, 3)
+        if family == socket.AF_INET6:
+            return socket.inet_ntop(socket.AF_INET6, raw[8:24]), port
+        return socket.inet_ntop(socket.AF_INET, raw[4:8]), port
+
+
+def make_receiver(sock, batch, use_recvmmsg=True, timeout=None):
+    """Return a callable that returns a list of (data, addr) datagrams"""
+    if batch > 1 and use_recvmmsg:
+        recvmmsg = get_recvmmsg()
+        if recvmmsg is not None:
+            return RecvmmsgReceiver(sock, batch, recvmmsg, timeout)
+    return RecvIntoReceiver(sock, max(batch, 1), timeout)
+
 
 class UDPServer(multiprocessing.Process):
-    def __init__(self, ip, port):
+    """Process receiving datagrams on a bound UDP socket
+
+    With `reuse_port` the socket is bound with SO_REUSEPORT so several
+    processes can share the port and the kernel spreads the datagrams
+    between them. The EXIT datagram sent by `close` then only reaches one
+    of those sockets, so every server of the group also polls `stop_event`,
+    which `close` sets first.
+    """
+
+    def __init__(self, ip, port, reuse_port=False, stop_event=None):
         super(UDPServer, self).__init__()
         self.daemon = True
         addrinfo = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_DGRAM)
@@ -41,6 +206,11 @@ class UDPServer(multiprocessing.Process):
         self.port = port
         self.sock = socket.socket(af, socket.SOCK_DGRAM)
         self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.stop_event = stop_event
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+            if self.stop_event is None:
+                self.stop_event = multiprocessing.Event()
         try:
             self.sock.bind((ip, port))
             log.info("Bound socket socket %s:%s", ip, port)
@@ -48,9 +218,11 @@ class UDPServer(multiprocessing.Process):
             log.exception("Error binding socket %s:%s.", ip, port)
             sys.exit(1)
 
-        self.sock_recvfrom = self.sock.recvfrom
+        self.recv_batch = cfg.udp_recv_batch
+        self.use_recvmmsg = cfg.udp_use_recvmmsg
+        self.debug = cfg.debug
         if cfg.debug:
-            # When in debug mode replace the send and recvfrom functions to include
+            # When in debug mode replace the send function to include
             # debug logging. In production mode these calls have quite a lot of overhead
             # for statements that will never do anything.
             import functools
@@ -63,24 +235,30 @@ class UDPServer(multiprocessing.Process):
                 return wrapper
             self.send = debugsend(self.send)
 
-            def debugrecvfrom(*args, **kwargs):
-                data, addr = self.sock.recvfrom(65535)
-                log.debug("Received UDP packet from %s:%s" % addr)
-                return data, addr
-            self.sock_recvfrom = debugrecvfrom
-
     def run(self):
         setproctitle("bucky: %s" % self.__class__.__name__)
-        recvfrom = self.sock_recvfrom
+        stop_event = self.stop_event
+        timeout = STOP_POLL_INTERVAL if stop_event is not None else None
+        receive = make_receiver(self.sock, self.recv_batch, self.use_recvmmsg, timeout)
         while True:
+            if stop_event is not None and stop_event.is_set():
+                break
             try:
-                data, addr = recvfrom(65535)
+                packets = receive()
             except (IOError, KeyboardInterrupt):
                 continue
-            addr = addr[:2]  # for compatibility with longer ipv6 tuples
-            if data == b'EXIT':
+            if self.debug:
+                for data, addr in packets:
+                    log.debug("Received UDP packet from %s:%s" % addr)
+            stop = False
+            for i, (data, addr) in enumerate(packets):
+                if data == b'EXIT':
+                    packets = packets[:i]
+                    stop = True
+                    break
+            if packets and not self.handle_batch(packets):
                 break
-            if not self.handle(data, addr):
+            if stop:
                 break
         try:
             self.pre_shutdown()
@@ -88,6 +266,17 @@ class UDPServer(multiprocessing.Process):
             log.exception("Failed pre_shutdown method for %s",
                           self.__class__.__name__)
 
+    def handle_batch(self, packets):
+        """Handle a list of (data, addr) datagrams
+
+        Returns False to stop the server. The default implementation
+        passes every datagram to `handle`.
+        """
+        for data, addr in packets:
+            if not self.handle(data, addr):
+                return False
+        return True
+
     def handle(self, data, addr):
         raise NotImplementedError()
 
@@ -96,6 +285,8 @@ class UDPServer(multiprocessing.Process):
         pass
 
     def close(self):
+        if self.stop_event is not None:
+            self.stop_event.set()
         self.send('EXIT')
 
     if six.PY3:
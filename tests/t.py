@@ -24,6 +24,7 @@ import multiprocessing
 import os
 import time
 import tempfile
+import collections
 from functools import wraps
 from contextlib import contextmanager
 
@@ -48,14 +49,34 @@ class set_cfg(object):
         return run
 
 
+class SampleQueue(object):
+    """Queue for tests that hands out the samples of batches one by one"""
+
+    def __init__(self):
+        self.queue = multiprocessing.Queue()
+        self.pending = collections.deque()
+
+    def put(self, batch):
+        self.queue.put(batch)
+
+    def get(self, block=True, timeout=None):
+        while not self.pending:
+            batch = self.queue.get(block, timeout)
+            if batch is None:
+                return None
+            self.pending.extend(batch)
+        return self.pending.popleft()
+
+
 class udp_srv(object):
-    def __init__(self, stype):
+    def __init__(self, stype, close_timeout=0.5):
         self.stype = stype
+        self.close_timeout = close_timeout
 
     def __call__(self, func):
         @wraps(func)
         def run():
-            q = multiprocessing.Queue()
+            q = SampleQueue()
             s = self.stype(q, cfg)
             s.start()
             try:
@@ -67,7 +88,7 @@ class udp_srv(object):
         return run
 
     def closed(self, s):
-        for i in range(5):
+        for i in range(int(self.close_timeout * 10)):
             if not s.is_alive():
                 return True
             time.sleep(0.1)
@@ -80,6 +101,15 @@ def same_stat(host, name, value, stat):
     gt(stat[3], 0)
 
 
+def same_rate(host, name, count, interval, stat):
+    """Rates are measured over the real flush interval, about `interval`"""
+    eq(name, stat[1])
+    gt(stat[2], 0)
+    measured = count / stat[2]
+    assert measured <= 2 * interval, "%r is not a rate of %r per %r" % (stat[2], count, interval)
+    gt(stat[3], 0)
+
+
 def eq(a, b):
     assert a == b, "%r != %r" % (a, b)
 
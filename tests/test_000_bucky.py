@@ -15,6 +15,8 @@
 # Copyright 2011 Cloudant, Inc.
 
 import os
+import time
+import unittest
 import threading
 
 import t
@@ -22,6 +24,7 @@ import t
 from bucky import cfg
 from bucky.main import Bucky
 from bucky.errors import BuckyError
+from bucky.transport import shared_memory
 
 
 def test_version_number():
@@ -34,3 +37,33 @@ def test_sigterm_handling():
     alarm_thread.start()
     bucky = Bucky(cfg)
     t.not_raises(BuckyError, bucky.run)
+
+
+@t.set_cfg("sample_topology", "direct")
+def test_sigterm_handling_direct():
+    alarm_thread = threading.Timer(2, os.kill, (os.getpid(), 15))
+    alarm_thread.start()
+    bucky = Bucky(cfg)
+    t.not_raises(BuckyError, bucky.run)
+
+
+@t.set_cfg("sample_transport", "shm")
+@t.set_cfg("sample_transport_ring_size", 64)
+@t.set_cfg("sample_transport_timeout", 0.1)
+def test_shutdown_with_dead_client_shm():
+    if shared_memory is None:
+        raise unittest.SkipTest("multiprocessing.shared_memory not available")
+    bucky = Bucky(cfg)
+    for server in bucky.servers:
+        server.start()
+    for client, pipe in bucky.clients:
+        client.start()
+    client, pipe = bucky.clients[0]
+    client.kill()
+    client.join()
+    start = time.time()
+    # Nobody reads the ring of the dead client any more
+    for i in range(5):
+        pipe.send([(None, "gorm", j, j) for j in range(100)])
+    t.raises(BuckyError, bucky.shutdown, "Client process died. Exiting.")
+    t.lt(time.time() - start, 5)
@@ -16,8 +16,17 @@
 
 import t
 import os
+import array
+import re
+import time
+import random
+import socket
+import shutil
+import multiprocessing
 
 import bucky.statsd
+import bucky.gaugelog
+from bucky.errors import ConfigError
 
 
 TIMEOUT = 3
@@ -34,7 +43,7 @@ def test_make_name():
 @t.udp_srv(bucky.statsd.StatsDServer)
 def test_simple_counter(q, s):
     s.send("gorm:1|c")
-    t.same_stat(None, "stats.gorm", 2, q.get(timeout=TIMEOUT))
+    t.same_rate(None, "stats.gorm", 1, 0.5, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats_counts.gorm", 1, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
 
@@ -45,7 +54,7 @@ def test_simple_counter(q, s):
 def test_multiple_messages(q, s):
     s.send("gorm:1|c")
     s.send("gorm:1|c")
-    t.same_stat(None, "stats.gorm", 4, q.get(timeout=TIMEOUT))
+    t.same_rate(None, "stats.gorm", 2, 0.5, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats_counts.gorm", 2, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
 
@@ -55,7 +64,7 @@ def test_multiple_messages(q, s):
 @t.udp_srv(bucky.statsd.StatsDServer)
 def test_larger_count(q, s):
     s.send("gorm:5|c")
-    t.same_stat(None, "stats.gorm", 10, q.get(timeout=TIMEOUT))
+    t.same_rate(None, "stats.gorm", 5, 0.5, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats_counts.gorm", 5, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
 
@@ -67,16 +76,18 @@ def test_multiple_counters(q, s):
     s.send("gorm:1|c")
     s.send("gurm:1|c")
     stats = {
-        "stats.gorm": 2,
+        "stats.gorm": 1,
         "stats_counts.gorm": 1,
-        "stats.gurm": 2,
+        "stats.gurm": 1,
         "stats_counts.gurm": 1
     }
     for i in range(4):
         stat = q.get(timeout=TIMEOUT)
         t.isin(stat[1], stats)
-        t.eq(stats[stat[1]], stat[2])
-        t.gt(stat[2], 0)
+        if stat[1].startswith("stats_counts."):
+            t.same_stat(None, stat[1], stats[stat[1]], stat)
+        else:
+            t.same_rate(None, stat[1], stats[stat[1]], 0.5, stat)
         stats.pop(stat[1])
     t.same_stat(None, "stats.numStats", 2, q.get(timeout=TIMEOUT))
 
@@ -93,17 +104,110 @@ def test_simple_timer(q, s):
     t.same_stat(None, "stats.timers.gorm.upper_90", 1, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.timers.gorm.lower", 1, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.timers.gorm.count", 10, q.get(timeout=TIMEOUT))
-    t.same_stat(None, "stats.timers.gorm.count_ps", 20.0, q.get(timeout=TIMEOUT))
+    t.same_rate(None, "stats.timers.gorm.count_ps", 10, 0.5, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.sum", 11, q.get(timeout=TIMEOUT))
+    stat = q.get(timeout=TIMEOUT)
+    t.eq(stat[1], "stats.timers.gorm.std")
+    t.eq(round(stat[2], 6), 0.3)
+    t.same_stat(None, "stats.timers.gorm.median", 1, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
 
 
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8137)
+@t.set_cfg("statsd_timer_percentiles", [50, 99.9])
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_timer_percentiles(q, s):
+    for i in range(1, 11):
+        s.send("gorm:%d|ms" % i)
+    stats = {}
+    while "stats.numStats" not in stats:
+        stat = q.get(timeout=TIMEOUT)
+        stats[stat[1]] = stat[2]
+    t.eq(stats["stats.timers.gorm.mean"], 3.0)
+    t.eq(stats["stats.timers.gorm.upper_50"], 5.0)
+    t.eq(stats["stats.timers.gorm.upper_99_9"], 9.0)
+    t.eq(stats["stats.timers.gorm.median"], 5.5)
+    t.eq(stats["stats.timers.gorm.sum"], 55.0)
+    t.isnotin("stats.timers.gorm.upper_90", stats)
+
+
+@t.set_cfg("statsd_timer_percentiles", [90, 101])
+def test_invalid_timer_percentiles():
+    t.raises(ConfigError, bucky.statsd.StatsDHandler, None, t.cfg)
+    # Restored by set_cfg
+    t.cfg.statsd_timer_percentiles = [-1]
+    t.raises(ConfigError, bucky.statsd.StatsDHandler, None, t.cfg)
+
+
+@t.set_cfg("statsd_set_hll_precision", 3)
+def test_invalid_hll_precision():
+    t.raises(ConfigError, bucky.statsd.StatsDHandler, None, t.cfg)
+
+
+@t.set_cfg("statsd_timer_sketch_patterns", ["gorm$"])
+def test_sketch_timers():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    for i in range(1, 1001):
+        handler.handle_line("gorm:%d|ms" % i)
+        handler.handle_line("gurm:%d|ms" % i)
+    t.istype(handler.timers["gorm"], bucky.statsd.DDSketch)
+    t.istype(handler.timers["gurm"], array.array)
+    handler.enqueue_timers(handler.timers, 1)
+    stats = dict((stat[1], stat[2]) for stat in handler.batch)
+    t.eq(stats["stats.timers.gorm.count"], 1000)
+    t.eq(stats["stats.timers.gorm.lower"], 1.0)
+    t.eq(stats["stats.timers.gorm.upper"], 1000.0)
+    t.eq(stats["stats.timers.gorm.sum"], 500500.0)
+    for name in ("upper_90", "median", "mean", "std"):
+        exact = stats["stats.timers.gurm." + name]
+        assert abs(stats["stats.timers.gorm." + name] - exact) <= 0.01 * exact
+
+
+@t.set_cfg("statsd_set_hll_prefixes", ["users."])
+def test_hll_sets():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    for i in range(5000):
+        handler.handle_line("users.gorm:%d|s" % i)
+        handler.handle_line("gurm:%d|s" % i)
+    t.istype(handler.sets["users.gorm"], bucky.statsd.HyperLogLog)
+    t.istype(handler.sets["gurm"], set)
+    handler.enqueue_sets(handler.sets, 1)
+    stats = dict((stat[1], stat[2]) for stat in handler.batch)
+    t.eq(stats["stats.sets.gurm.count"], 5000)
+    assert abs(stats["stats.sets.users.gorm.count"] - 5000) < 200
+
+
+def test_timer_stats():
+    values = array.array("d", [random.uniform(0, 1000) for i in range(1001)])
+    stats = bucky.statsd.timer_stats(values, [90, 99])
+    ordered = sorted(values)
+    t.eq(stats[:3], (1001, ordered[0], ordered[-1]))
+    t.eq(stats[6], ordered[500])
+    t.eq(stats[7], [ordered[899], ordered[989]])
+    t.eq(round(stats[4], 6), round(sum(ordered[:900]) / 900, 6))
+    if bucky.statsd.numpy is None:
+        return
+    # The numpy and the pure Python results agree
+    numpy = bucky.statsd.numpy
+    bucky.statsd.numpy = None
+    try:
+        expected = bucky.statsd.timer_stats(values, [90, 99])
+    finally:
+        bucky.statsd.numpy = numpy
+    t.eq(stats[:3], expected[:3])
+    t.eq(stats[6:], expected[6:])
+    for got, want in zip(stats[3:6], expected[3:6]):
+        t.eq(round(got, 6), round(want, 6))
+
+
 @t.set_cfg("statsd_flush_time", 0.5)
 @t.set_cfg("statsd_port", 8131)
 @t.set_cfg("statsd_legacy_namespace", False)
 @t.udp_srv(bucky.statsd.StatsDServer)
 def test_simple_counter_not_legacy_namespace(q, s):
     s.send("gorm:1|c")
-    t.same_stat(None, "stats.counters.gorm.rate", 2, q.get(timeout=TIMEOUT))
+    t.same_rate(None, "stats.counters.gorm.rate", 1, 0.5, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.counters.gorm.count", 1, q.get(timeout=TIMEOUT))
     t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
 
@@ -142,3 +246,315 @@ def test_simple_persistent_gauges(q, s):
         if os.path.isfile(os.path.join(t.cfg.directory, t.cfg.statsd_gauges_savefile)):
             os.unlink(os.path.join(t.cfg.directory, t.cfg.statsd_gauges_savefile))
         os.removedirs(t.cfg.directory)
+
+
+@t.set_cfg("statsd_persistent_gauges", True)
+@t.set_cfg("statsd_gauges_snapshot_interval", 0)
+@t.set_cfg("directory", "/tmp/bucky_test_gauge_log")
+def test_gauge_log():
+    os.makedirs(t.cfg.directory)
+    try:
+        queue = multiprocessing.Queue()
+        handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+        handler.handle_line("gorm:5|g")
+        handler.handle_line("gurm:1|g")
+        handler.flush(1)
+        # Every flush logs the changed gauges, the snapshot follows at
+        # the interval
+        handler.snapshot_interval = 3600
+        handler.handle_line("gorm:+2|g")
+        handler.flush(2)
+        t.eq(list(handler.gauges_log.replay()), [("gorm", 7.0)])
+        # A crash leaves the snapshot and the log behind
+        handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+        handler.load_gauges()
+        t.eq(dict(handler.gauges.items()), {"gorm": 7.0, "gurm": 1.0})
+        t.eq(handler.gauges_log.size, 0)
+        t.eq(list(bucky.statsd.read_gauges(handler.gauges_filename)),
+             [("gorm", 7.0), ("gurm", 1.0)])
+    finally:
+        shutil.rmtree(t.cfg.directory)
+
+
+@t.set_cfg("statsd_persistent_gauges", True)
+@t.set_cfg("directory", "/tmp/bucky_test_gauge_torn_log")
+def test_gauge_log_torn_only():
+    os.makedirs(t.cfg.directory)
+    try:
+        queue = multiprocessing.Queue()
+        handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+        # A crash during the first append leaves only a torn record
+        with open(handler.gauges_log.filename, "wb") as f:
+            f.write(bucky.gaugelog.pack_records([("garm", 1.0)])[:-2])
+        handler.load_gauges()
+        t.eq(dict(handler.gauges.items()), {})
+        t.eq(handler.gauges_log.stored_size(), 0)
+        handler.handle_line("gorm:5|g")
+        handler.flush(1)
+        handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+        handler.load_gauges()
+        t.eq(dict(handler.gauges.items()), {"gorm": 5.0})
+    finally:
+        shutil.rmtree(t.cfg.directory)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8138)
+@t.set_cfg("statsd_tcp_port", 8138)
+@t.set_cfg("statsd_unix_socket", "/tmp/bucky_test_statsd.sock")
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_stream_listeners(q, s):
+    client = socket.create_connection(("127.0.0.1", 8138))
+    client.sendall(b"gorm:1|c\n" * 1000)
+    client.close()
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect("/tmp/bucky_test_statsd.sock")
+    client.sendall(b"gorm:2|c\ngorm:3|c")
+    client.close()
+    s.send("gorm:4|c")
+    count = 0
+    while count < 1009:
+        stat = q.get(timeout=TIMEOUT)
+        if stat[1] == "stats_counts.gorm":
+            count += stat[2]
+    t.eq(count, 1009)
+
+
+def test_merge_shards():
+    recv, send = multiprocessing.Pipe()
+    shard = bucky.statsd.StatsDShardHandler(recv, t.cfg)
+    shard.start()
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    handler.shards = [send]
+    try:
+        handler.handle_line("gorm:1|ms")
+        handler.handle_line("gorm:1|c")
+        handler.handle_line("gurm:a|s")
+        handler.handle_line("garm:5|g")
+        shard.handle_line("gorm:2|ms:3|ms")
+        shard.handle_line("gorm:2|c")
+        shard.handle_line("gurm:a|s")
+        shard.handle_line("gurm:b|s")
+        shard.handle_line("garm:+2|g")
+        shard.handle_line("girm:-1|g")
+        handler.merge_shards()
+        t.eq(sorted(handler.timers["gorm"]), [1.0, 2.0, 3.0])
+        t.eq(handler.counters["gorm"], 3)
+        t.eq(handler.sets["gurm"], set(["a", "b"]))
+        t.eq(dict(handler.gauges.items()), {"garm": 7.0, "girm": -1.0})
+        t.eq(shard.timers, {})
+        t.eq(shard.gauges, {})
+    finally:
+        send.send(None)
+        shard.thread.join(TIMEOUT)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8134)
+@t.set_cfg("statsd_workers", 3)
+@t.udp_srv(bucky.statsd.getStatsDServer, close_timeout=3)
+def test_multiprocess_counter(q, s):
+    t.istype(s, bucky.statsd.StatsDServerMP)
+    # Every send uses a new source port, so the packets are spread over
+    # the processes sharing the port
+    for i in range(20):
+        s.send("gorm:1|c")
+    count = 0
+    while count < 20:
+        stat = q.get(timeout=TIMEOUT)
+        if stat[1] == "stats_counts.gorm":
+            count += stat[2]
+    t.eq(count, 20)
+
+
+@t.set_cfg("statsd_delete_idlestats", True)
+def test_cached_names():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    handler.handle_line("gorm:1|ms")
+    handler.handle_line("gurm:1|c")
+    handler.handle_line("girm:1|s")
+    handler.enqueue_timers(handler.timers, 1)
+    handler.enqueue_counters(handler.counters.keys, handler.counters.values, 1)
+    handler.enqueue_sets(handler.sets, 1)
+    names = [sample[1] for sample in handler.batch]
+    t.eq(names, [
+        "stats.timers.gorm.mean", "stats.timers.gorm.upper",
+        "stats.timers.gorm.upper_90", "stats.timers.gorm.lower",
+        "stats.timers.gorm.count", "stats.timers.gorm.count_ps",
+        "stats.timers.gorm.sum", "stats.timers.gorm.std",
+        "stats.timers.gorm.median", "stats.gurm", "stats_counts.gurm", "stats.sets.girm.count",
+    ])
+    t.eq(handler.timer_names["gorm"][0], "stats.timers.gorm.mean")
+    t.eq(handler.counter_names["gurm"], ("stats.gurm", "stats_counts.gurm"))
+    t.eq(handler.set_names["girm"], "stats.sets.girm.count")
+    handler.delete_idle_stats(handler.timers, handler.sets, [], bytearray())
+    handler.delete_idle_stats({"gorm": [1.0]}, {}, [], bytearray())
+    t.isin("gorm", handler.timer_names)
+    t.eq(handler.set_names, {})
+
+
+def test_flush_detaches_maps():
+    queue = multiprocessing.Queue()
+    handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+    handler.handle_line("gorm:2|ms")
+    handler.handle_line("gurm:3|c")
+    handler.handle_line("girm:a|s")
+    handler.handle_line("garm:4|g")
+    timers, counters = handler.timers, handler.counters.values
+    handler.flush(1)
+    # The samples of the next interval go to fresh maps
+    t.eq(handler.timers, {})
+    t.eq(list(handler.counters.values), [0.0])
+    t.eq(handler.sets, {})
+    t.eq(dict(handler.gauges.items()), {"garm": 4.0})
+    t.eq(list(timers["gorm"]), [2.0])
+    t.eq(list(counters), [3.0])
+    stats = dict((stat[1], stat[2]) for stat in queue.get(timeout=TIMEOUT))
+    t.eq(stats["stats.timers.gorm.upper"], 2.0)
+    t.eq(stats["stats_counts.gurm"], 3)
+    t.eq(stats["stats.sets.girm.count"], 1)
+    t.eq(stats["stats.gauges.garm"], 4.0)
+    t.eq(stats["stats.numStats"], 4)
+    # Known keys are reported without new samples
+    handler.flush(2)
+    stats = dict((stat[1], stat[2]) for stat in queue.get(timeout=TIMEOUT))
+    t.eq(stats["stats_counts.gurm"], 0)
+    t.eq(stats["stats.timers.gorm.count"], 0)
+    t.eq(stats["stats.sets.girm.count"], 0)
+
+
+@t.set_cfg("statsd_flush_time", 1.0)
+def test_flush_schedule():
+    queue = multiprocessing.Queue()
+    handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+    before = time.time()
+    stime, lag = handler.wait_flush()
+    after = time.time()
+    # Flushes happen at multiples of the flush time on the wall clock
+    t.eq(stime, int(before) + 1)
+    assert before < stime + lag <= after, (before, stime, lag, after)
+    handler.handle_line("gorm:1|c")
+    handler.last_flush = bucky.statsd.monotonic() - 1.0
+    handler.flush(stime, lag)
+    stats = queue.get(timeout=TIMEOUT)
+    t.eq([stat[1] for stat in stats[-3:]],
+         ["stats.numStats", "stats.flushLag", "stats.flushDuration"])
+    t.eq(stats[-2][2], lag)
+    # The rate is computed over the measured interval
+    rate = dict((stat[1], stat[2]) for stat in stats)["stats.gorm"]
+    assert 0.8 < rate <= 1.0, rate
+
+
+@t.set_cfg("statsd_flush_time", 1.0)
+def test_flush_schedule_clock_step_back():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    first, lag = handler.wait_flush()
+    # The wall clock is set back by an hour
+    wall = time.time
+    bucky.statsd.time.time = lambda: wall() - 3600
+    try:
+        second, lag = handler.wait_flush()
+    finally:
+        bucky.statsd.time.time = wall
+    t.eq(second, first + 1)
+    assert 0 <= lag < 1, lag
+
+
+@t.set_cfg("statsd_delete_idlestats", True)
+def test_counter_slots():
+    queue = multiprocessing.Queue()
+    handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+    handler.handle_line("gorm:1|c")
+    handler.handle_line("gurm:1|c")
+    handler.handle_line("garm:1|g")
+    handler.handle_line("girm:1|g")
+    handler.flush(1)
+    queue.get(timeout=TIMEOUT)
+    handler.handle_line("gorm:1|c")
+    handler.handle_line("girm:2|g")
+    handler.flush(2)
+    stats = queue.get(timeout=TIMEOUT)
+    names = [stat[1] for stat in stats]
+    # Idle counters are deleted and only changed gauges are sent
+    t.isnotin("stats_counts.gurm", names)
+    t.isnotin("stats.gauges.garm", names)
+    t.isin(("stats.gauges.girm", 2.0), [stat[1:3] for stat in stats])
+    t.eq(handler.counters.keys, ["gorm", None])
+    t.isnotin("gurm", handler.counter_names)
+    # The slot of the deleted counter is reused
+    handler.handle_line("germ:1|c")
+    t.eq(handler.counters.keys, ["gorm", "germ"])
+    t.eq(handler.counters["germ"], 1.0)
+
+
+@t.set_cfg("statsd_delete_idlestats", True)
+@t.set_cfg("statsd_idlestats_ttl", 2)
+def test_idlestats_ttl():
+    queue = multiprocessing.Queue()
+    handler = bucky.statsd.StatsDHandler(queue, t.cfg)
+    names = []
+    for i in range(6):
+        # gorm reports every other flush, gurm only once
+        if i % 2 == 0:
+            handler.handle_line("gorm:1|c")
+            handler.handle_line("gorm:1|ms")
+        if i == 0:
+            handler.handle_line("gurm:1|c")
+            handler.handle_line("gurm:1|ms")
+        handler.flush(i)
+        names.append([stat[1] for stat in queue.get(timeout=TIMEOUT)])
+    for i in (1, 3, 5):
+        t.isin("stats_counts.gorm", names[i])
+        t.isin("stats.timers.gorm.count", names[i])
+    t.isin("stats_counts.gurm", names[1])
+    t.isin("stats.timers.gurm.count", names[1])
+    t.isnotin("stats_counts.gurm", names[2])
+    t.isnotin("stats.timers.gurm.count", names[2])
+    t.eq(handler.counters.keys, ["gorm", None])
+    t.eq(sorted(handler.timer_names), ["gorm"])
+
+
+def test_sanitize_key():
+    old_res = (
+        (re.compile(r"\s+"), "_"),
+        (re.compile(r"\/"), "-"),
+        (re.compile(r"[^a-zA-Z_\-0-9\.]"), "")
+    )
+    rand = random.Random(42)
+    chars = "ab.-_/ \t\n\x00:|@#%\xe9"
+    keys = ["foo.bar", "foo bar", "a  /b", " \x00 ", "x\t\n/y//z", ""]
+    keys += ["".join(rand.choice(chars) for i in range(rand.randint(0, 12))) for j in range(2000)]
+    for key in keys:
+        expected = key
+        for rexp, repl in old_res:
+            expected = rexp.sub(repl, expected)
+        t.eq(bucky.statsd.sanitize_key(key), expected)
+
+
+def test_key_cache():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    t.eq(handler.handle_key("foo bar/baz"), "foo_bar-baz")
+    t.eq(handler.keys, {"foo bar/baz": "foo_bar-baz"})
+    t.eq(handler.handle_key("foo bar/baz"), "foo_bar-baz")
+
+
+def test_parse():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    samples = handler.parse(b"gorm:1|c|@0.5\n\ngurm:2|ms:3|ms\r\n"
+                            b"girm:+4|g\ngarm:5|g\ngerm:a|s\nbad\nbad:1\nbad:x|ms\n"
+                            b"my key:1|c|@x\n")
+    t.eq(samples, [
+        ("gorm", 2, bucky.statsd.COUNTER, 0.5),
+        ("gurm", 2.0, bucky.statsd.TIMER, 1.0),
+        ("gurm", 3.0, bucky.statsd.TIMER, 1.0),
+        ("girm", 4.0, bucky.statsd.GAUGE_DELTA, 1.0),
+        ("garm", 5.0, bucky.statsd.GAUGE, 1.0),
+        ("germ", "a", bucky.statsd.SET, 1.0),
+        ("my_key", 1, bucky.statsd.COUNTER, 1.0),
+    ])
+    t.eq(handler.parse("gorm:1|c"), [("gorm", 1, bucky.statsd.COUNTER, 1.0)])
+    handler.apply(samples)
+    t.eq(dict(handler.counters.items()), {"gorm": 2, "my_key": 1})
+    t.eq(list(handler.timers["gurm"]), [2.0, 3.0])
+    t.eq(dict(handler.gauges.items()), {"girm": 4.0, "garm": 5.0})
+    t.eq(handler.sets, {"germ": set(["a"])})
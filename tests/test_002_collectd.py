@@ -16,12 +16,16 @@
 
 import os
 import time
+import socket
 import struct
+import multiprocessing
 try:
     import queue
 except ImportError:
     import Queue as queue
 
+from functools import wraps
+
 import t
 import bucky.collectd
 from bucky import cfg
@@ -132,6 +136,113 @@ def test_simple_counter(q, s):
     check_samples(samples, seq, 9, 'test.squares.counter')
 
 
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25839)
+@t.set_cfg("collectd_workers", 3)
+@t.set_cfg("collectd_reuse_port", True)
+@t.udp_srv(bucky.collectd.getCollectDServer, close_timeout=3)
+def test_reuse_port_derive(q, s):
+    t.istype(s, bucky.collectd.CollectDServerReusePort)
+    # All packets come from one source address and port, so they have to
+    # reach the same worker for the DERIVE values to be computed
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    for pkt in pkts('collectd-squares.pkts'):
+        sock.sendto(pkt, (s.ip, s.port))
+    sock.close()
+    time.sleep(.1)
+    samples = []
+    while True:
+        try:
+            samples.append(q.get(True, .5))
+        except queue.Empty:
+            break
+    seq = lambda i: (2 * i + 1) / 2.
+    check_samples(samples, seq, 9, 'test.squares.derive')
+
+
+def mp_server(func):
+    @wraps(func)
+    def run():
+        q = t.SampleQueue()
+        s = bucky.collectd.CollectDServerMP(q, cfg)
+        s.start_workers()
+        try:
+            func(q, s)
+        finally:
+            s.pre_shutdown()
+            s.sock.close()
+    return run
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25840)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_rebalance_interval", 0)
+@mp_server
+def test_mp_migrate_source(q, s):
+    packets = list(pkts('collectd-squares.pkts'))
+    addr = ("10.0.0.1", 25826)
+    t.eq(len(packets), 2)
+    s.handle_batch([(packets[0], addr)])
+    src = s.route(addr[0])
+    dst = 1 - src
+    t.eq(s.migrate(addr[0], src, dst), True)
+    t.eq(s.route(addr[0]), dst)
+    s.handle_batch([(packets[1], addr)])
+    samples = []
+    while True:
+        try:
+            samples.append(q.get(True, .5))
+        except queue.Empty:
+            break
+    # The workers count the packets before they put the samples
+    stats = dict((name, (npkts, nsamples)) for name, npkts, nsamples in s.worker_stats())
+    t.eq(stats[s.workers[src][0].name][0], 1)
+    t.eq(stats[s.workers[dst][0].name][0], 1)
+    samples.sort(key=lambda sample: sample[3])
+    seq = lambda i: (2 * i + 1) / 2.
+    check_samples(samples, seq, 9, 'test.squares.derive')
+
+
+@cdtypes(TYPESDB)
+def test_worker_export_drops_state():
+    recv, send = multiprocessing.Pipe()
+    worker = bucky.collectd.CollectDWorker(recv, t.SampleQueue(), cfg)
+    worker.handler = bucky.collectd.CollectDHandler(cfg)
+    pkt = next(pkts('collectd-squares.pkts'))
+    worker.handle_message((bucky.collectd.MSG_PACKETS, [("10.0.0.1", pkt)]))
+    t.eq(worker.counters[0], 1)
+    t.ne(worker.handler.prev_samples, {})
+    worker.handle_message((bucky.collectd.MSG_EXPORT, "10.0.0.1"))
+    msg, (hosts, state) = send.recv()
+    t.eq(hosts, set(["machine_uuid"]))
+    t.ne(state, {})
+    t.eq(worker.sources, {})
+    t.eq(worker.handler.prev_samples, {})
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25841)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_rebalance_interval", 0)
+@mp_server
+def test_mp_rebalance(q, s):
+    # four sources that the hash ring puts on the same worker
+    ips = ["10.0.0.%d" % i for i in range(256)]
+    ips = [ip for ip in ips if s.route(ip) == 0][:4]
+    pkt = list(pkts('collectd-squares.pkts'))[0]
+    for ip in ips:
+        s.handle_batch([(pkt, (ip, 25826))] * 10)
+    s.rebalance()
+    routes = [s.route(ip) for ip in ips]
+    t.eq(routes.count(1), 1)
+    # loads are reset, an even load doesn't move anything
+    for ip in ips:
+        s.handle_batch([(pkt, (ip, 25826))] * 10)
+    s.rebalance()
+    t.eq([s.route(ip) for ip in ips], routes)
+
+
 @cdtypes("counters a:COUNTER:0:U, b:COUNTER:0:U\n")
 @t.set_cfg("collectd_port", 25830)
 @t.udp_srv(bucky.collectd.CollectDServer)
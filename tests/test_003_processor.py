@@ -17,7 +17,7 @@ def processor(func):
     @wraps(func)
     def run():
         inq = multiprocessing.Queue()
-        outq = multiprocessing.Queue()
+        outq = t.SampleQueue()
         proc = bucky.processor.CustomProcessor(inq, outq, cfg)
         proc.start()
         try:
@@ -47,8 +47,8 @@ def get_simple_data(times=100):
 
 
 def send_get_data(indata, inq, outq):
-    for sample in indata:
-        inq.put(sample)
+    for i in range(0, len(indata), 30):
+        inq.put(indata[i:i + 30])
     while True:
         try:
             sample = outq.get(True, 1.5)
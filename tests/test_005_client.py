@@ -0,0 +1,345 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import time
+import errno
+import socket
+import struct
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import multiprocessing
+from functools import wraps
+
+import t
+import bucky.carbon
+import bucky.client
+import bucky.names
+from bucky.errors import ConfigError
+from bucky.hashring import ConsistentHashRing
+
+
+class QueueClient(bucky.client.Client):
+    """Client that only implements `send`, like most custom clients"""
+
+    def __init__(self, pipe, queue):
+        super(QueueClient, self).__init__(pipe)
+        self.queue = queue
+
+    def send(self, host, name, value, time):
+        self.queue.put((host, name, value, time))
+
+
+def get_simple_data(times=10):
+    now = int(time.time())
+    return [("host-%d" % i, "metric-%d" % i, i, now) for i in range(times)]
+
+
+def test_send_only_client():
+    recv, send = multiprocessing.Pipe()
+    q = multiprocessing.Queue()
+    client = QueueClient(recv, q)
+    client.start()
+    try:
+        data = get_simple_data(10)
+        send.send(data[:5])
+        send.send(data[5:])
+        for sample in data:
+            t.eq(q.get(True, 1), sample)
+    finally:
+        send.send(None)
+        client.join(1)
+    t.eq(client.is_alive(), False)
+
+
+def listener():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(1)
+    return sock
+
+
+def flush_all(conn, timeout=2):
+    deadline = time.time() + timeout
+    while conn.buffer and time.time() < deadline:
+        conn.flush()
+        time.sleep(0.01)
+    t.eq(len(conn.buffer), 0)
+
+
+def read_all(sock):
+    sock.settimeout(2)
+    chunks = []
+    while True:
+        data = sock.recv(65536)
+        if not data:
+            return b"".join(chunks)
+        chunks.append(data)
+
+
+@t.set_cfg("debug", False)
+def test_connection_send():
+    server = listener()
+    conn = bucky.carbon.CarbonConnection("127.0.0.1", server.getsockname()[1], t.cfg)
+    try:
+        t.eq(conn.write(b"foo 1 2\n"), True)
+        t.eq(conn.write(b"bar 3 4\n"), True)
+        flush_all(conn)
+        t.eq(conn.connected, True)
+        peer, addr = server.accept()
+        conn.close()
+        t.eq(read_all(peer), b"foo 1 2\nbar 3 4\n")
+        peer.close()
+    finally:
+        server.close()
+
+
+@t.set_cfg("debug", False)
+@t.set_cfg("graphite_buffer_max", 10)
+def test_connection_drops_when_full():
+    conn = bucky.carbon.CarbonConnection("127.0.0.1", 1, t.cfg)
+    t.eq(conn.write(b"12345678"), True)
+    t.eq(conn.write(b"12345"), False)
+    t.eq(bytes(conn.buffer), b"12345678")
+    t.eq(conn.dropped, 5)
+
+
+@t.set_cfg("debug", False)
+@t.set_cfg("graphite_reconnect_delay", 1)
+@t.set_cfg("graphite_backoff_factor", 2)
+@t.set_cfg("graphite_backoff_max", 3)
+def test_connection_backoff():
+    server = listener()
+    port = server.getsockname()[1]
+    server.close()
+    conn = bucky.carbon.CarbonConnection("127.0.0.1", port, t.cfg)
+    conn.write(b"foo 1 2\n")
+    for delay in (2, 3, 3):
+        conn.next_connect = 0
+        deadline = time.time() + 2
+        while not conn.next_connect and time.time() < deadline:
+            conn.flush()
+            time.sleep(0.01)
+        t.eq(conn.delay, delay)
+        t.eq(conn.sock, None)
+        t.gt(conn.wait_time(), 0)
+    t.eq(bytes(conn.buffer), b"foo 1 2\n")
+
+
+class BreakingSocket(object):
+    """Accepts `limit` bytes, then fails like a connection reset by peer"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.data = b""
+
+    def send(self, data):
+        if self.limit <= 0:
+            raise socket.error(errno.EPIPE, "Broken pipe")
+        sent = min(len(data), self.limit)
+        self.limit -= sent
+        self.data += bytes(data[:sent])
+        return sent
+
+    def close(self):
+        pass
+
+
+@t.set_cfg("debug", False)
+def test_connection_restarts_partial_message():
+    conn = bucky.carbon.CarbonConnection("127.0.0.1", 1, t.cfg)
+    conn.write(b"foo 1 100\n")
+    conn.write(b"bar 1 100\nbaz 2 100\n")
+    conn.sock, conn.connected = BreakingSocket(16), True
+    conn.flush()
+    t.eq(conn.sock, None)
+    # The first message was written whole, the second starts over
+    t.eq(bytes(conn.buffer), b"bar 1 100\nbaz 2 100\n")
+    t.eq(conn.sent, 0)
+    sock = BreakingSocket(1000)
+    conn.sock, conn.connected = sock, True
+    conn.flush()
+    t.eq(sock.data, b"bar 1 100\nbaz 2 100\n")
+    t.eq(len(conn.buffer), 0)
+    t.eq(len(conn.lengths), 0)
+
+
+@t.set_cfg("debug", False)
+def test_connection_partial_sends():
+    conn = bucky.carbon.CarbonConnection("127.0.0.1", 1, t.cfg)
+    for i in range(5):
+        conn.write(("foo %d 100\n" % i).encode())
+    for limit in (3, 14, 1, 100):
+        sock = BreakingSocket(limit)
+        conn.sock, conn.connected = sock, True
+        conn.flush()
+        # Every connection starts at a line
+        t.eq(sock.data[:1], b"f")
+    t.eq(sock.data, b"foo 1 100\nfoo 2 100\nfoo 3 100\nfoo 4 100\n")
+    t.eq(len(conn.buffer), 0)
+
+
+@t.set_cfg("debug", False)
+def test_async_plaintext_client():
+    server = listener()
+    t.cfg.graphite_port, port = server.getsockname()[1], t.cfg.graphite_port
+    recv, send = multiprocessing.Pipe()
+    try:
+        client = bucky.carbon.AsyncPlaintextClient(t.cfg, recv)
+    finally:
+        t.cfg.graphite_port = port
+    client.start()
+    try:
+        data = get_simple_data(10)
+        send.send(data[:5])
+        send.send(data[5:])
+        send.send(None)
+        client.join(2)
+        t.eq(client.is_alive(), False)
+        peer, addr = server.accept()
+        lines = read_all(peer).decode().splitlines()
+        peer.close()
+        expected = ["%s %s %s" % (bucky.names.statname(host, name), value, mtime)
+                    for host, name, value, mtime in data]
+        t.eq(lines, expected)
+    finally:
+        server.close()
+
+
+class FrameSocket(object):
+    """Collects the metrics of the pickles sent by a PickleClient"""
+
+    def __init__(self):
+        self.frames = []
+
+    def sendall(self, data):
+        size, = struct.unpack("!L", data[:4])
+        t.eq(len(data), size + 4)
+        self.frames.append(pickle.loads(data[4:]))
+
+
+def pickle_client():
+    client = bucky.carbon.PickleClient(t.cfg, None)
+    client.sock = FrameSocket()
+    return client
+
+
+@t.set_cfg("graphite_pickle_buffer_bytes", 200)
+def test_pickle_client_byte_budget():
+    client = pickle_client()
+    data = get_simple_data(20)
+    client.send_batch(data)
+    frames = client.sock.frames
+    t.gt(len(frames), 1)
+    for frame in frames:
+        size = sum(len(stat) + client.ENTRY_OVERHEAD for stat, point in frame)
+        t.eq(size >= 200, True)
+    client.pre_shutdown()
+    metrics = [metric for frame in client.sock.frames for metric in frame]
+    t.eq(len(metrics), 20)
+    t.eq(metrics[0][1], (data[0][3], data[0][2]))
+
+
+@t.set_cfg("graphite_pickle_buffer_size", 5)
+def test_pickle_client_buffer_size():
+    client = pickle_client()
+    client.send_batch(get_simple_data(12))
+    t.eq([len(frame) for frame in client.sock.frames], [5, 5])
+    t.eq(len(client.buffer), 2)
+
+
+@t.set_cfg("graphite_pickle_max_latency", 0.1)
+def test_pickle_client_max_latency():
+    client = pickle_client()
+    t.eq(client.poll_timeout(), None)
+    client.send_batch(get_simple_data(3))
+    t.eq(client.sock.frames, [])
+    timeout = client.poll_timeout()
+    t.gt(timeout, 0)
+    t.eq(timeout <= 0.1, True)
+    time.sleep(0.15)
+    t.eq(client.poll_timeout() <= 0, True)
+    client.tick()
+    t.eq([len(frame) for frame in client.sock.frames], [3])
+    t.eq(client.poll_timeout(), None)
+
+
+def test_parse_destinations():
+    t.eq(bucky.carbon.parse_destinations(["127.0.0.1:2003", "10.0.0.1:2004:a"]),
+         [("127.0.0.1", 2003, None), ("10.0.0.1", 2004, "a")])
+    t.raises(ConfigError, bucky.carbon.parse_destinations, ["127.0.0.1"])
+    t.raises(ConfigError, bucky.carbon.parse_destinations, ["127.0.0.1:foo"])
+
+
+def multi_carbon(func):
+    @wraps(func)
+    def run():
+        servers = [listener() for i in range(3)]
+        dests = ["127.0.0.1:%d:%s" % (server.getsockname()[1], name)
+                 for server, name in zip(servers, "abc")]
+        try:
+            t.set_cfg("graphite_destinations", dests)(func)(servers)
+        finally:
+            for server in servers:
+                server.close()
+    return run
+
+
+def received(client, servers):
+    client.pre_shutdown()
+    result = {}
+    for server, name in zip(servers, "abc"):
+        peer, addr = server.accept()
+        result[("127.0.0.1", name)] = read_all(peer)
+        peer.close()
+    return result
+
+
+@t.set_cfg("debug", False)
+@t.set_cfg("graphite_replication_factor", 2)
+@multi_carbon
+def test_multi_carbon_plaintext(servers):
+    client = bucky.carbon.MultiCarbonClient(t.cfg, None)
+    data = [("host", "metric-%d" % i, i, 1000) for i in range(50)]
+    client.send_batch(data)
+    ring = ConsistentHashRing([("127.0.0.1", name) for name in "abc"])
+    lines = received(client, servers)
+    for node, output in lines.items():
+        lines[node] = output.decode().splitlines()
+    for host, name, value, mtime in data:
+        stat = bucky.names.statname(host, name)
+        line = "%s %s %s" % (stat, value, mtime)
+        nodes = ring.get_nodes(stat, 2)
+        for node in lines:
+            t.eq(line in lines[node], node in nodes)
+    t.eq(sum(len(node_lines) for node_lines in lines.values()), 100)
+
+
+@t.set_cfg("debug", False)
+@t.set_cfg("graphite_pickle_enabled", True)
+@multi_carbon
+def test_multi_carbon_pickle(servers):
+    client = bucky.carbon.MultiCarbonClient(t.cfg, None)
+    data = [("host", "metric-%d" % i, i, 1000) for i in range(50)]
+    client.send_batch(data[:25])
+    client.send_batch(data[25:])
+    metrics = []
+    for output in received(client, servers).values():
+        while output:
+            size, = struct.unpack("!L", output[:4])
+            metrics.extend(pickle.loads(output[4:size + 4]))
+            output = output[size + 4:]
+    t.eq(sorted(metrics), sorted((bucky.names.statname(host, name), (mtime, value))
+                                 for host, name, value, mtime in data))
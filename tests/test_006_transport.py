@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import time
+import unittest
+import threading
+import multiprocessing
+from functools import wraps
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import t
+import bucky.transport
+
+
+def shm_only(func):
+    @wraps(func)
+    def run():
+        if bucky.transport.shared_memory is None:
+            raise unittest.SkipTest("multiprocessing.shared_memory not available")
+        return func()
+    return run
+
+
+def get_simple_data(times=100):
+    data = []
+    for i in range(times):
+        host = None if i % 3 else "tests.host-%d" % i
+        name = "metric-%d.%s" % (i % 10, "x" * i)
+        value = i if i % 2 else i + 0.5
+        data.append((host, name, value, int(time.time())))
+    return data
+
+
+def produce(ring, data):
+    for i in range(0, len(data), 7):
+        ring.put(data[i:i + 7])
+    ring.put(None)
+
+
+@shm_only
+def test_ring_roundtrip():
+    # Small ring so that writes wrap around and wait for the consumer
+    ring = bucky.transport.ShmRing(16, 50)
+    data = get_simple_data(100)
+    proc = multiprocessing.Process(target=produce, args=(ring, data))
+    proc.start()
+    try:
+        samples = []
+        batch = ring.recv()
+        while batch is not None:
+            t.lt(len(batch), 51)
+            samples.extend(batch)
+            batch = ring.recv()
+        t.eq(samples, data)
+    finally:
+        proc.join(1)
+        ring.close()
+
+
+@shm_only
+def test_ring_empty():
+    ring = bucky.transport.ShmRing(16, 50)
+    try:
+        t.eq(ring.poll(0.05), False)
+        t.raises(queue.Empty, ring.get, True, 0.05)
+    finally:
+        ring.close()
+
+
+@shm_only
+def test_ring_column_types():
+    ring = bucky.transport.ShmRing(64, 50)
+    ints = [(None, "gorm", i, 100 + i) for i in range(5)]
+    floats = [("host", "gurm", i + 0.5, 100.5) for i in range(5)]
+    mixed = [(None, "garm", 1 << 70, 100), ("host", "garm", 1.5, 100.25)]
+    invalid = [("host", "gorm", "x", 100), ("host", ["gorm"], 1, 100)]
+    try:
+        ring.put(ints)
+        ring.put(floats + invalid[:1])
+        ring.put(invalid[1:] + mixed)
+        got = ring.get(True, 1)
+        t.eq(got, ints + floats + mixed)
+        t.eq([type(sample[2]) for sample in got], [int] * 5 + [float] * 5 + [int, float])
+        t.eq([type(sample[3]) for sample in got], [int] * 5 + [float] * 5 + [int, float])
+    finally:
+        ring.close()
+
+
+@shm_only
+def test_ring_full_timeout():
+    # Nobody reads, so the ring fills up and puts give up after the timeout
+    ring = bucky.transport.ShmRing(64, 50, timeout=0.1)
+    data = [(None, "gorm", i, 100 + i) for i in range(1000)]
+    try:
+        start = time.time()
+        ring.put(data)
+        ring.put(None)
+        t.lt(time.time() - start, 2)
+        # What did fit is read back in order, the stop fits again
+        samples = []
+        batch = ring.get(True, 1)
+        while batch is not None:
+            samples.extend(batch)
+            batch = ring.get(True, 1)
+        t.gt(len(samples), 0)
+        t.eq(samples, data[:len(samples)])
+        # Names are sent again after the dropped batch
+        ring.put(data[:10])
+        ring.put(None)
+        t.eq(ring.get(True, 1), data[:10])
+        t.eq(ring.get(True, 1), None)
+    finally:
+        ring.close()
+
+
+@shm_only
+def test_queue_producers():
+    shmq = bucky.transport.ShmQueue(2, 64, 50)
+    data = get_simple_data(100)
+    procs = [multiprocessing.Process(target=shmq.put, args=(data[i::2],))
+             for i in range(2)]
+    for proc in procs:
+        proc.start()
+    try:
+        samples = []
+        while len(samples) < len(data):
+            samples.extend(shmq.get(True, 1))
+        t.eq(sorted(samples, key=lambda s: s[1]), sorted(data, key=lambda s: s[1]))
+        shmq.put(None)
+        t.eq(shmq.get(True, 1), None)
+    finally:
+        for proc in procs:
+            proc.join(1)
+        shmq.close()
+
+
+@t.set_cfg("sample_transport", "queue")
+def test_queue_broadcast():
+    bcast, inboxes = bucky.transport.make_broadcast(t.cfg, 1, 2)
+    data = get_simple_data(10)
+    bcast.put(data)
+    bcast.put(None)
+    for inbox in inboxes:
+        t.eq(inbox.poll(1), True)
+        t.eq(inbox.recv(), data)
+        t.eq(inbox.recv(), None)
+    bcast.close()
+
+
+@t.set_cfg("sample_transport", "queue")
+def test_queue_inbox_poll_stop():
+    # A stop taken off the queue by poll() has to be returned by recv()
+    bcast, inboxes = bucky.transport.make_broadcast(t.cfg, 1, 1)
+    inbox = inboxes[0]
+    bcast.put(None)
+    t.eq(inbox.poll(1), True)
+    t.eq(inbox.poll(0), True)
+    t.eq(inbox.recv(), None)
+    t.eq(inbox.poll(0.1), False)
+    bcast.close()
+
+
+def consume(reader, samples):
+    batch = reader.recv()
+    while batch is not None:
+        samples.extend(batch)
+        batch = reader.recv()
+
+
+@shm_only
+def test_shm_broadcast():
+    shmq = bucky.transport.ShmQueue(1, 16, 50, 2)
+    data = get_simple_data(20)
+    got = [[], []]
+    # The producer has to wait for the slowest reader
+    readers = [threading.Thread(target=consume, args=(shmq.reader(i), got[i]))
+               for i in range(2)]
+    for reader in readers:
+        reader.start()
+    proc = multiprocessing.Process(target=produce, args=(shmq, data))
+    proc.start()
+    try:
+        for reader in readers:
+            reader.join(5)
+        t.eq(got[0], data)
+        t.eq(got[1], data)
+    finally:
+        proc.join(1)
+        shmq.close()
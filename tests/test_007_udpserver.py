@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import socket
+import unittest
+
+import t
+import bucky.udpserver
+
+
+def bound_socket():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 0))
+    return sock
+
+
+def send_packets(sock, count):
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    packets = [("packet-%d" % i).encode() * (i + 1) for i in range(count)]
+    for data in packets:
+        client.sendto(data, sock.getsockname())
+    return packets, client.getsockname()
+
+
+def check_receiver(receiver, sock):
+    packets, addr = send_packets(sock, 10)
+    got = []
+    while len(got) < len(packets):
+        batch = receiver()
+        t.lt(len(batch), 5)
+        got.extend(batch)
+    t.eq([data for data, _ in got], packets)
+    for _, src in got:
+        t.eq(src, ("127.0.0.1", addr[1]))
+
+
+def test_recv_into_receiver():
+    sock = bound_socket()
+    try:
+        check_receiver(bucky.udpserver.RecvIntoReceiver(sock, 4), sock)
+    finally:
+        sock.close()
+
+
+def test_recvmmsg_receiver():
+    recvmmsg = bucky.udpserver.get_recvmmsg()
+    if recvmmsg is None:
+        raise unittest.SkipTest("recvmmsg not available")
+    sock = bound_socket()
+    try:
+        check_receiver(bucky.udpserver.RecvmmsgReceiver(sock, 4, recvmmsg), sock)
+    finally:
+        sock.close()
+
+
+def test_recvmmsg_ipv6_addr():
+    if bucky.udpserver.get_recvmmsg() is None:
+        raise unittest.SkipTest("recvmmsg not available")
+    try:
+        sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        sock.bind(("::1", 0))
+    except socket.error:
+        raise unittest.SkipTest("IPv6 not available")
+    try:
+        receiver = bucky.udpserver.RecvmmsgReceiver(sock, 4, bucky.udpserver.get_recvmmsg())
+        client = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+        client.sendto(b"data", sock.getsockname())
+        t.eq(receiver(), [(b"data", ("::1", client.getsockname()[1]))])
+    finally:
+        sock.close()
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import t
+from bucky.hashring import ConsistentHashRing, compact_hash
+
+
+KEYS = ["10.0.0.%d" % i for i in range(200)]
+
+
+def test_compact_hash():
+    # first four hex digits of md5("foo") = acbd...
+    t.eq(compact_hash("foo"), 0xacbd)
+    t.eq(compact_hash(b"foo"), 0xacbd)
+
+
+def test_ring_size():
+    ring = ConsistentHashRing(range(3))
+    t.eq(len(ring.ring), 300)
+    t.eq(len(ring.positions), 300)
+
+
+def test_stable_nodes():
+    ring1 = ConsistentHashRing(range(4))
+    ring2 = ConsistentHashRing(range(4))
+    for key in KEYS:
+        t.eq(ring1.get_node(key), ring2.get_node(key))
+
+
+def test_spread():
+    ring = ConsistentHashRing(range(4))
+    counts = [0] * 4
+    for key in KEYS:
+        counts[ring.get_node(key)] += 1
+    for count in counts:
+        t.gt(count, 20)
+
+
+def test_add_node_moves_few_keys():
+    ring = ConsistentHashRing(range(4))
+    before = dict((key, ring.get_node(key)) for key in KEYS)
+    ring.add_node(4)
+    for key in KEYS:
+        node = ring.get_node(key)
+        if node != before[key]:
+            t.eq(node, 4)
+
+
+def test_remove_node():
+    ring = ConsistentHashRing(["a", "b", "c"])
+    before = dict((key, ring.get_node(key)) for key in KEYS)
+    ring.remove_node("b")
+    t.eq(len(ring.ring), 200)
+    for key in KEYS:
+        if before[key] != "b":
+            t.eq(ring.get_node(key), before[key])
+        else:
+            t.isin(ring.get_node(key), ["a", "c"])
+
+
+def test_get_nodes():
+    ring = ConsistentHashRing([("127.0.0.1", None), ("127.0.0.2", None), ("127.0.0.3", None)])
+    for key in KEYS:
+        nodes = ring.get_nodes(key, 2)
+        t.eq(len(nodes), 2)
+        t.ne(nodes[0], nodes[1])
+        t.eq(nodes[0], ring.get_node(key))
+    t.eq(len(ring.get_nodes("foo")), 3)
+    t.eq(ConsistentHashRing().get_nodes("foo"), [])
@@ -0,0 +1,113 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+from functools import wraps
+
+import t
+import bucky.names as names
+
+
+def reset_names(func):
+    @wraps(func)
+    def run():
+        names.reset()
+        try:
+            return func()
+        finally:
+            names.reset()
+    return run
+
+
+def test_default_names():
+    names.reset()
+    t.eq(names.statname(None, "foo.bar"), "foo.bar")
+    t.eq(names.statname("node.company.tld", "cpu.idle"), "tld.company.node.cpu.idle")
+    t.eq(names.statname("node", "node.load"), "node.load")
+
+
+@t.set_cfg("name_prefix", "pre.fix")
+@t.set_cfg("name_prefix_parts", ["a", "a.b"])
+@t.set_cfg("name_postfix_parts", ["c"])
+@t.set_cfg("name_postfix", "post")
+@reset_names
+def test_prefix_postfix():
+    t.eq(names.statname("a.host", "x.y"), "pre_fix.a.a_b.host.a.x.y.c.post")
+
+
+@t.set_cfg("name_replace_char", None)
+@t.set_cfg("name_strip_duplicates", False)
+@t.set_cfg("name_prefix", "pre.fix")
+@reset_names
+def test_no_replace_no_strip():
+    t.eq(names.statname("b.a", "a.a"), "pre.fix.a.b.a.a")
+
+
+@t.set_cfg("name_cache_size", 2)
+@reset_names
+def test_cache_stats():
+    t.eq(names.statname("host", "foo"), "host.foo")
+    t.eq(names.statname("host", "foo"), "host.foo")
+    t.eq(names.statname("host", "bar"), "host.bar")
+    stats = names.statname_stats()
+    t.eq(stats["hits"], 1)
+    t.eq(stats["misses"], 2)
+    t.eq(stats["size"], 2)
+    # a third name starts a new generation, the old names still hit
+    names.statname("host", "baz")
+    names.statname("host", "foo")
+    stats = names.statname_stats()
+    t.eq(stats["hits"], 2)
+    t.eq(stats["misses"], 3)
+    t.eq(stats["hit_rate"], 0.4)
+
+
+def test_generations():
+    built = []
+
+    def build(host, name):
+        built.append(name)
+        return name
+
+    cache = names.StatNameCache(build, 2)
+    for name in ["a", "b", "c", "a", "d", "e", "b"]:
+        t.eq(cache(None, name), name)
+    # "a" was still in the previous generation, "b" was dropped
+    t.eq(built, ["a", "b", "c", "d", "e", "b"])
+    t.eq(len(cache.current) + len(cache.previous), 3)
+
+
+@t.set_cfg("name_host_trim", ["company.tld", "tld", "other.company.tld", "a.b.c.d.e"])
+@reset_names
+def test_host_trim():
+    t.eq(names.hostname("node.company.tld"), ["node"])
+    # the first matching rule wins, even if a later one is longer
+    t.eq(names.hostname("node.other.company.tld"), ["other", "node"])
+    t.eq(names.hostname("node.example.tld"), ["example", "node"])
+    t.eq(names.hostname("node.example.org"), ["org", "example", "node"])
+    t.eq(names.hostname("company.tld"), [])
+    # rules longer than the host name don't match
+    t.eq(names.hostname("d.e"), ["e", "d"])
+    t.eq(names.statname("node.company.tld", "load"), "node.load")
+
+
+@t.set_cfg("name_host_trim", ["example.org"])
+@t.set_cfg("name_cache_size", 2)
+@reset_names
+def test_host_trim_memo():
+    trimmer = names._get_host_trim()
+    t.eq(trimmer("a.example.org"), ("a",))
+    t.eq(trimmer("b.example.org"), ("b",))
+    t.eq(sorted(trimmer.memo), ["a.example.org", "b.example.org"])
+    t.eq(trimmer("c.example.org"), ("c",))
+    t.eq(list(trimmer.memo), ["c.example.org"])
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import t
+import pickle
+import random
+
+from bucky.sketch import DDSketch, HyperLogLog
+
+
+def close(value, expected, accuracy):
+    assert abs(value - expected) <= accuracy * abs(expected), \
+        "%r is not within %r of %r" % (value, accuracy, expected)
+
+
+def test_ddsketch_exact_stats():
+    sketch = DDSketch(0.01)
+    values = [random.lognormvariate(3, 1) for i in range(1000)]
+    sketch.extend(values)
+    t.eq(len(sketch), 1000)
+    t.eq(sketch.lower, min(values))
+    t.eq(sketch.upper, max(values))
+    close(sketch.sum, sum(values), 1e-9)
+
+
+def test_ddsketch_accuracy():
+    sketch = DDSketch(0.01)
+    values = [random.lognormvariate(3, 2) for i in range(10000)]
+    sketch.extend(values)
+    values.sort()
+    ranks = [0, 100, 5000, 9000, 9900, 9999]
+    for rank, value in zip(ranks, sketch.values_at(ranks)):
+        close(value, values[rank], 0.01)
+    close(sketch.sum_lowest(9000), sum(values[:9000]), 0.01)
+
+
+def test_ddsketch_negative_and_zero():
+    sketch = DDSketch(0.01)
+    sketch.extend([-100.0, -1.0, 0.0, 0.0, 1.0, 100.0])
+    values = sketch.values_at([0, 1, 2, 3, 4, 5])
+    close(values[0], -100.0, 0.01)
+    close(values[1], -1.0, 0.01)
+    t.eq(values[2:4], [0.0, 0.0])
+    close(values[4], 1.0, 0.01)
+    close(values[5], 100.0, 0.01)
+
+
+def test_ddsketch_merge():
+    values = [random.uniform(1, 1000) for i in range(2000)]
+    merged = DDSketch(0.01)
+    merged.extend(values[:1000])
+    other = DDSketch(0.01)
+    other.extend(values[1000:])
+    merged.extend(pickle.loads(pickle.dumps(other)))
+    single = DDSketch(0.01)
+    single.extend(values)
+    t.eq(merged.count, 2000)
+    t.eq(merged.bins, single.bins)
+    t.eq(merged.lower, single.lower)
+    t.eq(merged.upper, single.upper)
+
+
+def test_ddsketch_max_bins():
+    sketch = DDSketch(0.01, max_bins=100)
+    values = [10 ** random.uniform(-3, 6) for i in range(10000)]
+    sketch.extend(values)
+    t.eq(len(sketch.bins), 100)
+    values.sort()
+    # Collapsing only costs accuracy for the smallest values
+    close(sketch.values_at([9990])[0], values[9990], 0.01)
+
+
+def test_hll_small_sets_exact():
+    hll = HyperLogLog(14)
+    for i in range(200):
+        hll.add("member%d" % (i % 100))
+    t.eq(hll.registers, None)
+    t.eq(len(hll), 100)
+
+
+def test_hll_estimate():
+    for count in (1000, 100000):
+        hll = HyperLogLog(14)
+        for i in range(count):
+            hll.add("member%d" % i)
+        t.eq(len(hll.registers), 16384)
+        # four times the standard error
+        close(len(hll), count, 4 * 1.04 / 128)
+
+
+def test_hll_merge():
+    merged = HyperLogLog(10)
+    merged.update("a%d" % i for i in range(5000))
+    other = HyperLogLog(10)
+    other.update("a%d" % i for i in range(2500, 7500))
+    small = HyperLogLog(10)
+    small.update(["b1", "b2"])
+    merged.update(pickle.loads(pickle.dumps(other)))
+    merged.update(small)
+    single = HyperLogLog(10)
+    single.update("a%d" % i for i in range(7500))
+    single.update(["b1", "b2"])
+    t.eq(merged.registers, single.registers)
+    close(len(merged), 7502, 4 * 1.04 / 32)
+
+
+def test_hll_precision_range():
+    t.raises(ValueError, HyperLogLog, 3)
+    t.raises(ValueError, HyperLogLog, 17)
+    hll = HyperLogLog(4)
+    hll.update(range(1000))
+    t.gt(len(hll), 0)
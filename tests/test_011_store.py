@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import t
+from bucky.store import Expiry, SlotStore, dirty_slots
+
+
+def test_add_and_set():
+    store = SlotStore()
+    store.add("gorm", 1)
+    store.add("gorm", 2)
+    store.set("gurm", 5)
+    t.eq(len(store), 2)
+    t.eq(store["gorm"], 3.0)
+    t.eq(store.get("gurm"), 5.0)
+    t.eq(store.get("garm", 0.0), 0.0)
+    t.isin("gorm", store)
+    t.isnotin("garm", store)
+    t.eq(sorted(store.items()), [("gorm", 3.0), ("gurm", 5.0)])
+
+
+def test_dirty_slots():
+    t.eq(list(dirty_slots(bytearray(b"\x00\x01\x01\x00\x01"))), [1, 2, 4])
+    t.eq(list(dirty_slots(bytearray(3))), [])
+
+
+def test_take():
+    store = SlotStore()
+    store.add("gorm", 1)
+    store.set("gurm", 2)
+    values, dirty = store.take()
+    t.eq(list(values), [1.0, 2.0])
+    t.eq(list(dirty_slots(dirty)), [0, 1])
+    store.add("gurm", 1)
+    t.eq(list(values), [1.0, 2.0])
+    t.eq(list(dirty_slots(store.dirty)), [1])
+    values, dirty = store.take(reset=True)
+    t.eq(list(values), [1.0, 3.0])
+    t.eq(list(store.values), [0.0, 0.0])
+    t.eq(list(dirty_slots(store.dirty)), [])
+
+
+def test_remove_reuses_slots():
+    store = SlotStore()
+    for key in ("gorm", "gurm", "garm"):
+        store.add(key, 1)
+    store.remove("gorm")
+    t.eq(store.keys, [None, "gurm", "garm"])
+    t.eq(store.free, [0])
+    t.isnotin("gorm", store)
+    store.add("girm", 4)
+    t.eq(store.keys, ["girm", "gurm", "garm"])
+    t.eq(store["girm"], 4.0)
+    t.eq(store.free, [])
+
+
+def test_expiry():
+    expiry = Expiry(1)
+    expiry.touch(["gorm", "gurm"])
+    t.eq(expiry.expire(), [])
+    expiry.touch(["gorm"])
+    t.eq(expiry.expire(), ["gurm"])
+    t.eq(expiry.expire(), ["gorm"])
+    t.eq(len(expiry), 0)
+
+
+def test_expiry_ttl():
+    expiry = Expiry(3)
+    expired = []
+    for generation in range(10):
+        # gorm is seen every other generation, gurm only at first
+        keys = ["gurm"] if generation == 0 else []
+        if generation % 2 == 0:
+            keys.append("gorm")
+        expiry.touch(keys)
+        expired.append(expiry.expire())
+    t.eq(expired, [[], [], [], ["gurm"], [], [], [], [], [], []])
+    t.eq(list(expiry.seen), ["gorm"])
+    # Only the keys due in a generation are looked at
+    t.eq(sum(len(keys) for keys in expiry.due.values()), 1)
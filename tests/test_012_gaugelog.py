@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import t
+import io
+import os
+import json
+import shutil
+import tempfile
+import functools
+
+import bucky.gaugelog
+from bucky.gaugelog import GaugeLog, read_gauges, write_gauges
+
+
+def tmpdir(func):
+    @functools.wraps(func)
+    def run():
+        path = tempfile.mkdtemp()
+        try:
+            func(path)
+        finally:
+            shutil.rmtree(path)
+    return run
+
+
+@tmpdir
+def test_snapshot(path):
+    filename = os.path.join(path, "gauges.save")
+    items = [("gorm", 1.5), (u"gürm", -2.0), ("a" * 1000, 3.0)]
+    write_gauges(filename, iter(items))
+    t.eq(list(read_gauges(filename)), items)
+    t.eq(os.listdir(path), ["gauges.save"])
+    write_gauges(filename, [("gorm", 2.0)])
+    t.eq(list(read_gauges(filename)), [("gorm", 2.0)])
+
+
+@tmpdir
+def test_legacy_json(path):
+    filename = os.path.join(path, "gauges.save")
+    with open(filename, "w") as f:
+        json.dump({"gorm": 5}, f)
+    t.eq(list(read_gauges(filename)), [("gorm", 5)])
+
+
+@tmpdir
+def test_log_replay(path):
+    glog = GaugeLog(os.path.join(path, "gauges.save.log"))
+    t.eq(list(glog.replay()), [])
+    glog.append([("gorm", 1.0), ("gurm", 2.0)])
+    glog.append([("gorm", 3.0)])
+    t.eq(list(glog.replay()), [("gorm", 1.0), ("gurm", 2.0), ("gorm", 3.0)])
+    glog.clear()
+    t.eq(glog.size, 0)
+    t.eq(os.listdir(path), [])
+
+
+@tmpdir
+def test_log_torn_record(path):
+    glog = GaugeLog(os.path.join(path, "gauges.save.log"))
+    glog.append([("gorm", 1.0), ("gurm", 2.0)])
+    with open(glog.filename, "ab") as f:
+        f.write(bucky.gaugelog.pack_records([("garm", 3.0)])[:-2])
+    t.eq(list(glog.replay()), [("gorm", 1.0), ("gurm", 2.0)])
+
+
+def test_streaming_chunks():
+    chunk_size = bucky.gaugelog.CHUNK_SIZE
+    bucky.gaugelog.CHUNK_SIZE = 7
+    try:
+        items = [("gorm%d" % i, float(i)) for i in range(100)]
+        data = bucky.gaugelog.pack_records(items)
+        t.eq(list(bucky.gaugelog.iter_records(io.BytesIO(data))), items)
+    finally:
+        bucky.gaugelog.CHUNK_SIZE = chunk_size
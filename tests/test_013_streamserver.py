@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import t
+import os
+import time
+import socket
+import tempfile
+import threading
+
+import bucky.streamserver as streamserver
+
+
+class Collector(object):
+    def __init__(self):
+        self.chunks = []
+        self.lock = threading.Lock()
+
+    def __call__(self, data):
+        with self.lock:
+            self.chunks.append(data)
+
+    def lines(self, count, timeout=3):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            with self.lock:
+                lines = b"\n".join(self.chunks).split(b"\n")
+            if len(lines) >= count:
+                return lines
+            time.sleep(0.01)
+        return lines
+
+
+def test_tcp_framing():
+    sock = streamserver.tcp_socket("127.0.0.1", 0)
+    collector = Collector()
+    listener = streamserver.StreamListener(sock, collector)
+    listener.start()
+    try:
+        clients = [socket.create_connection(sock.getsockname()) for i in range(3)]
+        # Lines may be split over several writes
+        for i, client in enumerate(clients):
+            client.sendall(("gorm%d:1|c\ngurm" % i).encode())
+        for i, client in enumerate(clients):
+            client.sendall(("%d:2|c\n" % i).encode())
+        clients[0].sendall(b"garm:3|c")
+        clients[0].close()
+        lines = collector.lines(7)
+        t.eq(sorted(lines), sorted([b"gorm0:1|c", b"gorm1:1|c", b"gorm2:1|c",
+                                    b"gurm0:2|c", b"gurm1:2|c", b"gurm2:2|c",
+                                    b"garm:3|c"]))
+        for client in clients[1:]:
+            client.close()
+    finally:
+        listener.close()
+        listener.join(3)
+    t.eq(listener.is_alive(), False)
+    t.eq(listener.conns, {})
+
+
+def test_tcp_long_line():
+    sock = streamserver.tcp_socket("127.0.0.1", 0)
+    collector = Collector()
+    listener = streamserver.StreamListener(sock, collector, max_line=100)
+    listener.start()
+    try:
+        client = socket.create_connection(sock.getsockname())
+        client.sendall(b"x" * 200)
+        client.settimeout(3)
+        # The connection is closed by the listener
+        t.eq(client.recv(1), b"")
+        t.eq(collector.chunks, [])
+    finally:
+        listener.close()
+
+
+def test_unix_stream():
+    path = os.path.join(tempfile.mkdtemp(), "statsd.sock")
+    sock = streamserver.unix_socket(path)
+    collector = Collector()
+    listener = streamserver.StreamListener(sock, collector)
+    listener.start()
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        client.connect(path)
+        client.sendall(b"gorm:1|c\ngurm:1|c\n")
+        t.eq(collector.lines(2), [b"gorm:1|c", b"gurm:1|c"])
+        client.close()
+    finally:
+        listener.close()
+    t.eq(os.path.exists(path), False)
+    os.rmdir(os.path.dirname(path))
+
+
+def test_unix_dgram():
+    path = os.path.join(tempfile.mkdtemp(), "statsd.sock")
+    # A stale socket file is replaced
+    streamserver.unix_socket(path, socket.SOCK_DGRAM).close()
+    sock = streamserver.unix_socket(path, socket.SOCK_DGRAM)
+    collector = Collector()
+    listener = streamserver.DatagramListener(sock, collector)
+    listener.start()
+    try:
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.sendto(b"gorm:1|c\ngurm:1|c", path)
+        t.eq(collector.lines(2), [b"gorm:1|c", b"gurm:1|c"])
+        client.close()
+    finally:
+        listener.close()
+    os.rmdir(os.path.dirname(path))